@@ -6,8 +6,12 @@ Flaskアプリケーションのインスタンスを作成し、設定を読み
 # os: オペレーティングシステムと対話するための機能を提供。ファイルパスの操作、ディレクトリの作成などに使用
 import os
 
+# time, threading: 起動時間の計測と、Elasticsearchクライアント・管理画面の遅延作成時の排他制御に使用
+import time
+import threading
+
 # Flask: ウェブアプリケーションの主要なフレームワーク
-from flask import Flask
+from flask import Flask, current_app
 
 # Bootstrap: FlaskアプリケーションでBootstrapフレームワークを使用するための拡張機能。CSSとJavaScriptを簡単に統合
 from flask_bootstrap import Bootstrap
@@ -15,124 +19,158 @@ from flask_bootstrap import Bootstrap
 # LoginManager: Flaskアプリケーションのログインプロセスを管理
 from flask_login import LoginManager
 
-# Admin: Flaskアプリケーションに管理インターフェースを追加するための拡張機能。データベースモデルの管理などが可能
-from flask_admin import Admin
-
-# ModelView: Flask-AdminでSQLAlchemyモデルを管理するためのビューを提供
-from flask_admin.contrib.sqla import ModelView
-
-# elasticsearch用
-from elasticsearch import Elasticsearch
-
-# markdown: MarkdownテキストをHTMLに変換するために使用。メモ帳アプリの主要な機能の一部(本アプリのメイン)
-import markdown
-
-# Markup: HTML文字列を「安全」としてマークするために使用。これにより、Jinja2テンプレートでエスケープされずに表示
-from markupsafe import Markup
+# DispatcherMiddleware: /admin 以下のリクエストを管理画面用のアプリケーションに渡すために使用
+from werkzeug.middleware.dispatcher import DispatcherMiddleware
 
-# pymdownx.tasklist: Markdownでタスクリスト（チェックボックス付きリスト）をサポートするための拡張機能
-from pymdownx.tasklist import TasklistExtension
-
-# markdown.extensions.fenced_code: Markdownでフェンス付きコードブロック（```python ... ```）をサポートするための拡張機能
-# markdown.extensions.tables: Markdownでテーブル（表）をサポートするための拡張機能
-# markdown.extensions.nl2br: Markdownで改行（new line）を `<br>` タグに変換するための拡張機能
-from markdown.extensions.fenced_code import FencedCodeExtension
-from markdown.extensions.tables import TableExtension
-from markdown.extensions.nl2br import Nl2BrExtension
+# Flask-Admin(管理画面)とelasticsearchパッケージは読み込みに時間がかかるため、最初に使用する時にインポートする
 
 # models.pyからdbオブジェクトとモデルクラスをインポート
-from .models import db, User, Note
+from .models import db
 # config.pyからConfigクラスをインポート
 from .config import Config
 
 # redisでセッション管理するために
-from flask_session import Session
 from redis import Redis
 
 
 # 各拡張機能のインスタンスを生成
 bootstrap = Bootstrap()
 login_manager = LoginManager()
-admin = Admin(name='ForgeGrid Admin', template_mode='bootstrap3')
-es = None # グローバル変数としてesを定義
-sess = Session()
+es = None # グローバル変数としてesを定義(get_es()で最初に使用する時に作成)
+_lazy_lock = threading.Lock()
 
-def create_app():
-    """アプリケーションインスタンスを作成するファクトリ関数"""
+
+def get_es():
+    """
+    Elasticsearchクライアントを取得する(ELASTICSEARCH_HOSTが未設定の場合はNone)
+    クライアントは最初に呼び出された時に作成するため、起動時にelasticsearchパッケージの読み込みや接続は行わない
+    """
     global es
-    
+    if es is None and current_app.config['ELASTICSEARCH_HOST']:
+        with _lazy_lock:
+            if es is None:
+                from elasticsearch import Elasticsearch
+                from . import metrics
+                client = Elasticsearch(
+                    hosts=[{'host': current_app.config['ELASTICSEARCH_HOST'], 'port': current_app.config['ELASTICSEARCH_PORT'], 'scheme': current_app.config['ELASTICSEARCH_SCHEME']}],
+                    ca_certs=current_app.config['CA_CERTS_PATH'],
+                    basic_auth=(current_app.config['ELASTICSEARCH_USER'], current_app.config['ELASTICSEARCH_PASSWORD']),
+                )
+                # Elasticsearchへの通信時間を計測する
+                metrics.instrument_elasticsearch(client)
+                es = client
+    return es
+
+
+class _LazyAdminApp:
+    """/admin へのリクエストが最初に来た時に管理画面用のアプリケーションを作成するWSGIアプリケーション"""
+
+    def __init__(self, app):
+        self.app = app
+        self.admin_app = None
+
+    def __call__(self, environ, start_response):
+        if self.admin_app is None:
+            with _lazy_lock:
+                if self.admin_app is None:
+                    from .admin_views import create_admin_app
+                    self.admin_app = create_admin_app(self.app)
+        return self.admin_app(environ, start_response)
+
+
+def create_app():
+    """
+    アプリケーションインスタンスを作成するファクトリ関数
+    データベースやElasticsearchへの接続は行わない(テーブルや検索インデックスの作成はデプロイ時に `flask provision` で行う)
+    各処理にかかった時間は app.extensions['startup_timings'] に記録され、`flask startup-report` で確認できる
+    """
+    timings = {}
+    last = time.perf_counter()
+
+    def mark(name):
+        nonlocal last
+        now = time.perf_counter()
+        timings[name] = now - last
+        last = now
+
     app = Flask(__name__)
+    app.extensions['startup_timings'] = timings
     
     # 設定クラスを読み込み
     app.config.from_object(Config)
 
-    # Flask-Sessionを初期化
+    # セッションをRedisに保存する(変更があった場合のみ書き込む。session_store.py を参照)
     app.config["SESSION_REDIS"] = Redis.from_url(app.config["SESSION_REDIS_URL"])
-    sess.init_app(app)
+    from . import session_store
+    session_store.init_app(app)
 
     # 各拡張機能をアプリケーションに初期化(紐付け)
     db.init_app(app)
     bootstrap.init_app(app)
     login_manager.init_app(app)
-    admin.init_app(app)
+    mark('extensions')
 
-    # Elasticsearchクライアントの初期化
-    es = Elasticsearch(
-        hosts=[{'host': app.config['ELASTICSEARCH_HOST'], 'port': app.config['ELASTICSEARCH_PORT'], 'scheme': app.config['ELASTICSEARCH_SCHEME']}],
-        ca_certs=app.config['CA_CERTS_PATH'],
-        basic_auth=(app.config['ELASTICSEARCH_USER'], app.config['ELASTICSEARCH_PASSWORD']),
-    )
+    # リクエストごとの処理時間(SQL・Elasticsearch・Markdown・テンプレート)の計測と /metrics を登録
+    # Elasticsearchクライアントは get_es() で最初に使用する時に作成し、その際に計測を組み込む
+    from . import metrics
+    metrics.init_app(app)
+    mark('metrics')
 
     # ログインしていない場合にリダイレクトするページを設定
     login_manager.login_view = 'views.login'
 
     # Flask-Loginのuser_loaderコールバック関数
+    # ログイン中のユーザー情報はキャッシュし、リクエストのたびにusersテーブルを読まないようにする
+    from . import user_cache
+    user_cache.init_app(app)
+
     @login_manager.user_loader
     def load_user(user_id):
-        return db.session.get(User, int(user_id))
-
-    # 管理画面にモデルを追加
-    admin.add_view(ModelView(User, db.session))
-    admin.add_view(ModelView(Note, db.session))
-
-    # Markdown変換フィルターを登録
-    @app.template_filter('markdown_to_html')
-    def markdown_to_html(text):
-        html = markdown.markdown(text, extensions=[
-            FencedCodeExtension(),
-            TableExtension(),
-            'nl2br',
-            TasklistExtension(),
-            'codehilite',
-        ])
-        return Markup(html)
+        return user_cache.load_user(user_id)
+    mark('login')
+
+    # 管理画面は /admin へのリクエストが最初に来た時に作成する
+    app.wsgi_app = DispatcherMiddleware(app.wsgi_app, {'/admin': _LazyAdminApp(app)})
+
+    # Markdown変換フィルターを登録(ブロック単位の変換結果キャッシュ付き。markdownパッケージは最初の変換時に読み込む)
+    from . import markdown_render
+    markdown_render.init_app(app)
+    mark('markdown')
+
+    # 検索バックエンド(Elasticsearch / PostgreSQL / SQLite)を設定に応じて選択
+    from . import search
+    with app.app_context():
+        search.init_app(app, get_es)
+    mark('search')
 
     # views.pyで定義したルート(Blueprint)を登録
     from . import views
     app.register_blueprint(views.bp, url_prefix='/')
-
-    with app.app_context():
-        # データベーステーブルを作成
-        db.create_all()
-        
-        # Elasticsearchのインデックスを作成
-        es_index_name = app.config['ELASTICSEARCH_INDEX']
-        if es and not es.indices.exists(index=es_index_name):
-            try:
-                # マッピングを定義
-                mapping = {
-                    "properties": {
-                        "id": {"type": "integer"},
-                        "title": {"type": "text"},
-                        "content": {"type": "text"},
-                        "date": {"type": "date"},
-                        "user_id": {"type": "integer"}
-                    }
-                }
-                # インデックス作成時にマッピングを適用
-                es.indices.create(index=es_index_name, body={"mappings": mapping})
-                print(f"Elasticsearch index '{es_index_name}' created.")
-            except Exception as e:
-                print(f"Error creating Elasticsearch index: {e}")
-
-    return app
\ No newline at end of file
+    mark('views')
+
+    # テーブル・検索インデックス・静的ファイルの作成(PROVISION_ON_STARTUPの場合のみ。通常は `flask provision` で行う)
+    if app.config['PROVISION_ON_STARTUP']:
+        from . import provisioning
+        with app.app_context():
+            provisioning.provision(app)
+        mark('provision')
+
+    # 静的ファイルをハッシュ付きのファイル名・圧縮済みのファイルで配信する
+    from . import assets
+    assets.init_app(app, views.bp)
+
+    # メモのリビジョン番号を使ったETagに含める、アプリケーションのバージョンを計算
+    from . import note_revisions
+    note_revisions.init_app(app)
+    mark('assets')
+
+    # メモの変更をElasticsearchへ非同期に送信するアウトボックスのドレイナーを登録
+    from . import search_outbox
+    search_outbox.init_app(app)
+
+    # flaskコマンドから実行する運用コマンドを登録
+    from . import commands
+    commands.init_app(app)
+    mark('commands')
+
+    return app
@@ -0,0 +1,188 @@
+"""
+管理画面(Flask-Admin)のビューを定義するモジュール。
+Flask-Adminは読み込みとビューの作成に時間がかかるため、このモジュールは /admin へのリクエストが最初に来た時にインポートされ、
+create_admin_app() で作成した管理画面用のアプリケーションが /admin 以下のリクエストを処理する。
+
+メモのテーブルは数百万行になるため、一覧は次のように表示する(作成時や管理画面のトップページではデータベースに問い合わせない)
+- 本文は読み込まず、先頭の ADMIN_PREVIEW_LENGTH 文字だけをデータベースで切り出して表示する
+- 件数は COUNT(*) で数えず、PostgreSQLではクエリプランの推定行数、それ以外では ADMIN_COUNT_LIMIT 件までの件数を表示する
+- ページ送りはIDの降順のキーセット方式(前のページの最後のIDより小さいものを取得)で、ページが進んでもOFFSETで読み飛ばさない
+- 絞り込みはインデックスのある列(ユーザー、作成日)に限り、並べ替えと部分一致の検索は行わない
+"""
+
+# Flask: 管理画面用のアプリケーションの作成に使用
+from flask import Flask, current_app, request
+
+# Admin: Flaskアプリケーションに管理インターフェースを追加するための拡張機能。データベースモデルの管理などが可能
+from flask_admin import Admin
+
+# ModelView: Flask-AdminでSQLAlchemyモデルを管理するためのビューを提供
+# filters: 一覧の絞り込み条件(インデックスのある列のみ指定する)
+from flask_admin.contrib.sqla import ModelView, filters
+from flask_admin.babel import lazy_gettext
+
+from sqlalchemy import func, inspect, select, text
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import with_expression
+
+from . import user_cache
+from .models import db, User, Note
+
+
+def estimate_count(query, model, limit):
+    """
+    一覧の件数を表示用の文字列で返す
+    PostgreSQLではEXPLAINの推定行数(実行はしない)、それ以外では limit 件までを数える
+    """
+    session = query.session
+    statement = query.with_entities(model.id).order_by(None).statement
+    dialect = session.get_bind().dialect
+    if dialect.name == 'postgresql':
+        try:
+            sql = statement.compile(dialect=dialect, compile_kwargs={'literal_binds': True})
+            plan = session.execute(text(f'EXPLAIN (FORMAT JSON) {sql}')).scalar()
+            return f"約 {int(plan[0]['Plan']['Plan Rows']):,} 件"
+        except SQLAlchemyError:
+            # 推定できない条件の場合は件数の上限まで数える
+            session.rollback()
+    count = session.execute(select(func.count()).select_from(statement.limit(limit + 1).subquery())).scalar()
+    return f"{limit:,} 件以上" if count > limit else f"{count:,} 件"
+
+
+class UsernameFilter(filters.BaseSQLAFilter):
+    """ユーザー名での絞り込み(ユーザー名からIDを求め、user_idのインデックスで絞り込む)"""
+
+    def apply(self, query, value, alias=None):
+        user_id = select(User.id).where(User.username == value).scalar_subquery()
+        return query.filter(self.get_column(alias) == user_id)
+
+    def operation(self):
+        return lazy_gettext('equals')
+
+
+class KeysetModelView(ModelView):
+    """
+    IDの降順のキーセット方式でページ送りし、件数は概算で表示する一覧
+    次のページへのリンクには、表示したページの最後のIDを after パラメータとして付ける
+    """
+
+    list_template = 'admin/keyset_list.html'
+    # 件数を数えない(Flask-Adminの「前へ・次へ」のみのページ送りの代わりに、テンプレートでキーセットのリンクを表示する)
+    simple_list_pager = True
+    column_default_sort = ('id', True)
+    column_sortable_list = ()
+    column_display_pk = True
+
+    def _get_list_extra_args(self):
+        # 絞り込みのフォームや他のリンクには、ページの位置(after)を引き継がない
+        view_args = super()._get_list_extra_args()
+        view_args.extra_args.pop('after', None)
+        return view_args
+
+    def _apply_pagination(self, query, page, page_size):
+        # ページ送りはget_listでキーセット方式で行う
+        return query
+
+    def get_list(self, page, sort_column, sort_desc, search, filters,
+                 execute=True, page_size=None):
+        _, query = super().get_list(page, sort_column, sort_desc, search, filters,
+                                    execute=False, page_size=page_size)
+        self._template_args['count_label'] = estimate_count(query, self.model, current_app.config['ADMIN_COUNT_LIMIT'])
+
+        page_size = page_size or self.page_size
+        after = request.args.get('after', type=int)
+        if after is not None:
+            query = query.filter(self.model.id < after)
+        query = query.limit(page_size)
+        if not execute:
+            return None, query
+
+        data = query.all()
+        args = request.args.to_dict(flat=False)
+        args.pop('after', None)
+        args.pop('page', None)
+        self._template_args['first_page_url'] = self.get_url('.index_view', **args) if after is not None else None
+        self._template_args['next_page_url'] = (
+            self.get_url('.index_view', after=data[-1].id, **args) if len(data) == page_size else None
+        )
+        return None, data
+
+
+class UserAdminView(KeysetModelView):
+    """ユーザーの管理画面。変更・削除の後はログイン中のユーザー情報のキャッシュを削除する"""
+
+    column_list = ('id', 'username', 'notes_revision')
+    column_filters = (
+        filters.IntEqualFilter(User.id, 'ID'),
+        filters.FilterEqual(User.username, 'ユーザー名'),
+    )
+    # 編集画面でユーザーのすべてのメモを選択肢として読み込まないようにする
+    # メモ一覧のリビジョン番号(ETagに使用)は、値を戻すと古い一覧が304で返されるため編集させない
+    # パスワードの変更回数は、パスワードを変更した時に自動で増やす(値を戻すとログアウトさせたセッションが有効に戻るため編集させない)
+    form_excluded_columns = ('notes', 'notes_revision', 'password_version')
+
+    def on_model_change(self, form, model, is_created):
+        if not is_created and inspect(model).attrs.password.history.has_changes():
+            # パスワードが変更された場合は、ログイン中のセッションをログアウトさせる
+            model.password_version += 1
+
+    def after_model_change(self, form, model, is_created):
+        if not is_created:
+            user_cache.invalidate(model.id)
+
+    def after_model_delete(self, model):
+        user_cache.invalidate(model.id)
+
+
+class NoteAdminView(KeysetModelView):
+    """メモの管理画面。一覧では本文を読み込まず、先頭部分のみ表示する(本文は詳細・編集画面で読み込む)"""
+
+    can_view_details = True
+    column_list = ('id', 'user_id', 'title', 'date', 'revision', 'content_head')
+    column_labels = {'user_id': 'ユーザーID', 'content_head': '本文(先頭)'}
+    column_details_exclude_list = ('content_head',)
+    column_filters = (
+        filters.IntEqualFilter(Note.user_id, 'ユーザーID'),
+        UsernameFilter(Note.user_id, 'ユーザー名'),
+        filters.DateBetweenFilter(Note.date, '作成日'),
+        filters.DateGreaterFilter(Note.date, '作成日'),
+        filters.DateSmallerFilter(Note.date, '作成日'),
+    )
+    column_formatters = {
+        'content_head': lambda view, context, model, name: (
+            model.content_head + '…' if len(model.content_head) >= view.preview_length else model.content_head
+        ),
+    }
+    # リビジョン番号(ETagと同時編集の検出に使用)は、保存のたびにSQLAlchemyが増やすため編集させない
+    form_excluded_columns = ('content_head', 'revision')
+    # 編集画面のユーザーの選択肢は、全件ではなく入力したユーザー名で検索して表示する
+    form_ajax_refs = {'user': {'fields': ('username',), 'page_size': 10}}
+
+    def __init__(self, model, session, preview_length, **kwargs):
+        self.preview_length = preview_length
+        super().__init__(model, session, **kwargs)
+
+    def get_query(self):
+        return super().get_query().options(
+            with_expression(Note.content_head, func.substr(Note.content, 1, self.preview_length))
+        )
+
+
+def create_admin_app(app):
+    """
+    管理画面用のアプリケーションを作成する
+    設定・セッション・検索バックエンドは本体のアプリケーションと共有し、/admin にマウントされる(URLは /admin/ 以下になる)
+    """
+    # 一覧のテンプレート(templates/admin/keyset_list.html)を読み込めるよう、本体と同じテンプレートのディレクトリを指定する
+    admin_app = Flask(__name__, static_folder=None, template_folder='templates')
+    admin_app.config.from_mapping(app.config)
+    admin_app.session_interface = app.session_interface
+    # メモの変更を検索インデックスへ反映するアウトボックスが参照する
+    admin_app.extensions['search_backend'] = app.extensions['search_backend']
+    db.init_app(admin_app)
+
+    admin = Admin(admin_app, name='ForgeGrid Admin', template_mode='bootstrap3', url='/')
+    # 管理画面にモデルを追加(ユーザーの変更・削除時はキャッシュを削除する)
+    admin.add_view(UserAdminView(User, db.session))
+    admin.add_view(NoteAdminView(Note, db.session, app.config['ADMIN_PREVIEW_LENGTH']))
+    return admin_app
@@ -0,0 +1,184 @@
+"""
+静的ファイル(CSS・JavaScript・フォント・画像)を配信用に変換するモジュール。
+内容のハッシュをファイル名に含めたコピーと、gzip・brotliで圧縮したファイルを static/dist に作成し、
+テンプレートの url_for('views.static', ...) をハッシュ付きのファイル名に置き換える。
+ファイル名は内容が変わると変わるため、ブラウザには1年間再検証せずにキャッシュさせる(Cache-Control: immutable)。
+"""
+
+# os: 静的ファイルの走査や作成に使用
+import os
+
+# re: CSS内のurl(...)の参照先をハッシュ付きのファイル名に書き換えるために使用
+import re
+
+# json: 元のファイル名とハッシュ付きのファイル名の対応(manifest.json)の保存に使用
+import json
+
+# gzip, hashlib: 圧縮ファイルの作成と内容のハッシュ計算に使用
+import gzip
+import hashlib
+
+# mimetypes: 圧縮ファイルを送信する際に、元のファイルのContent-Typeを設定するために使用
+import mimetypes
+
+from flask import request, send_from_directory
+
+# brotli: gzipより小さく圧縮できる形式。インストールされていない場合はgzipのみ作成する
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# 変換したファイルを置くディレクトリ(静的ファイルのディレクトリからの相対パス)
+DIST_DIR = 'dist'
+MANIFEST_NAME = 'manifest.json'
+# 変換の対象外とするファイル
+_SKIP_EXTENSIONS = {'.txt', '.gz', '.br'}
+# 圧縮して配信する(元々圧縮されていない)形式
+_COMPRESSIBLE_EXTENSIONS = {'.css', '.js', '.svg', '.ico', '.json', '.map'}
+# CSS内のurl(...)の参照(data: や外部URLは対象外)
+_CSS_URL_RE = re.compile(r'url\((["\']?)(?!data:|https?:|//|/)([^"\')?#]+)([?#][^"\')]*)?\1\)')
+
+_manifest = {}
+
+
+def _fingerprint(data):
+    return hashlib.sha256(data).hexdigest()[:12]
+
+
+def _hashed_name(name, data):
+    stem, ext = os.path.splitext(name)
+    return f"{stem}.{_fingerprint(data)}{ext}"
+
+
+def _write_if_changed(path, data):
+    """内容が同じファイルが既にある場合は書き込まない(ハッシュ付きのファイル名のため内容も同じ)"""
+    if os.path.exists(path):
+        return False
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'wb') as fh:
+        fh.write(data)
+    os.replace(path + '.tmp', path)
+    return True
+
+
+def _rewrite_css(name, data, manifest):
+    """CSSから参照しているファイル(フォントなど)をハッシュ付きのファイル名に書き換える"""
+    base = os.path.dirname(name)
+
+    def replace(match):
+        quote, target, suffix = match.group(1), match.group(2), match.group(3) or ''
+        resolved = os.path.normpath(os.path.join(base, target)).replace(os.sep, '/')
+        if resolved not in manifest:
+            return match.group(0)
+        # 変換後のCSSもdist以下に置かれるため、dist内での相対パスにする
+        hashed = os.path.relpath(manifest[resolved], os.path.join(DIST_DIR, base)).replace(os.sep, '/')
+        # ファイル名に内容のハッシュを含めるため、キャッシュ対策のクエリ文字列は不要
+        if suffix.startswith('?'):
+            suffix = ''
+        return f"url({quote}{hashed}{suffix}{quote})"
+
+    return _CSS_URL_RE.sub(replace, data.decode('utf-8')).encode('utf-8')
+
+
+def build(static_folder):
+    """
+    静的ファイルのハッシュ付きのコピーと圧縮ファイルを作成し、manifest.jsonを書き出す
+    元のファイル名とハッシュ付きのファイル名(静的ファイルのディレクトリからの相対パス)の対応を返す
+    """
+    dist = os.path.join(static_folder, DIST_DIR)
+    sources = []
+    for dirpath, dirnames, filenames in os.walk(static_folder):
+        if os.path.abspath(dirpath) == os.path.abspath(static_folder) and DIST_DIR in dirnames:
+            dirnames.remove(DIST_DIR)
+        for filename in filenames:
+            if os.path.splitext(filename)[1].lower() in _SKIP_EXTENSIONS:
+                continue
+            path = os.path.join(dirpath, filename)
+            sources.append(os.path.relpath(path, static_folder).replace(os.sep, '/'))
+
+    # CSSは参照先のファイル名を書き換えてからハッシュを計算するため、最後に処理する
+    sources.sort(key=lambda name: (name.endswith('.css'), name))
+    manifest = {}
+    for name in sources:
+        with open(os.path.join(static_folder, name), 'rb') as fh:
+            data = fh.read()
+        if name.endswith('.css'):
+            data = _rewrite_css(name, data, manifest)
+        hashed = f"{DIST_DIR}/{_hashed_name(name, data)}"
+        manifest[name] = hashed
+
+        path = os.path.join(static_folder, hashed)
+        _write_if_changed(path, data)
+        if os.path.splitext(name)[1].lower() in _COMPRESSIBLE_EXTENSIONS:
+            if not os.path.exists(path + '.gz'):
+                _write_if_changed(path + '.gz', gzip.compress(data, compresslevel=9, mtime=0))
+            if brotli is not None and not os.path.exists(path + '.br'):
+                _write_if_changed(path + '.br', brotli.compress(data, quality=11))
+
+    os.makedirs(dist, exist_ok=True)
+    manifest_path = os.path.join(dist, MANIFEST_NAME)
+    with open(manifest_path + '.tmp', 'w') as fh:
+        json.dump(manifest, fh, indent=2, sort_keys=True)
+    os.replace(manifest_path + '.tmp', manifest_path)
+    return manifest
+
+
+def load_manifest(static_folder):
+    """作成済みのmanifest.jsonを読み込む(なければ空)"""
+    try:
+        with open(os.path.join(static_folder, DIST_DIR, MANIFEST_NAME)) as fh:
+            return json.load(fh)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def _accepted_encoding(path):
+    """ブラウザが対応していて、作成済みの圧縮形式を返す"""
+    accepted = request.accept_encodings
+    for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+        if accepted[encoding] and os.path.exists(path + suffix):
+            return encoding, suffix
+    return None, ''
+
+
+def init_app(app, bp):
+    """
+    起動時に静的ファイルを変換し(ASSETS_BUILD_ON_STARTUP)、
+    url_forのファイル名の置き換えと、ハッシュ付きのファイルの配信をblueprintに登録する
+    """
+    global _manifest
+    static_folder = bp.static_folder
+    if app.config['ASSETS_BUILD_ON_STARTUP']:
+        try:
+            _manifest = build(static_folder)
+        except OSError as e:
+            # 読み取り専用のファイルシステムなどで作成できない場合は、作成済みのものを使用する
+            app.logger.warning(f"Static asset build failed: {e}")
+            _manifest = load_manifest(static_folder)
+    else:
+        _manifest = load_manifest(static_folder)
+
+    max_age = app.config['ASSETS_MAX_AGE']
+    endpoint = f"{bp.name}.static"
+
+    @app.url_defaults
+    def _fingerprinted_static(endpoint_name, values):
+        if endpoint_name == endpoint and values.get('filename') in _manifest:
+            values['filename'] = _manifest[values['filename']]
+
+    def send_static(filename):
+        """ハッシュ付きのファイルは圧縮済みのファイルを選んで長期間キャッシュさせ、それ以外は通常どおり送信する"""
+        if not filename.startswith(DIST_DIR + '/'):
+            return bp.send_static_file(filename)
+        encoding, suffix = _accepted_encoding(os.path.join(static_folder, filename))
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        response = send_from_directory(static_folder, filename + suffix, mimetype=mimetype, max_age=max_age)
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        response.vary.add('Accept-Encoding')
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        return response
+
+    app.view_functions[endpoint] = send_static
@@ -0,0 +1,262 @@
+"""
+検索(search_notes_async)と入力中の候補(suggest)を、asyncioで処理する検索サービス(ASGIアプリケーション)。
+uwsgiのワーカーではElasticsearchの応答を待つ間もスレッドが1つ占有されるため、同時に処理できる検索はスレッド数までだった。
+このサービスはAsyncElasticsearchを使用し、1つのイベントループで多数の検索を同時に待つことができる。
+
+- FlaskアプリケーションとURL(/ForgeGrid/search_notes_async, /ForgeGrid/suggest)・パラメータ・応答の形式が同じため、
+  nginxでこの2つのパスだけをこのサービスに振り分けて使用する(`uvicorn asgi:app` で起動)
+- ログイン状態はFlaskと共有しているRedisのセッションから読み取る(SECRET_KEYを同じ値に設定すること)。
+  セッションへの書き込みや有効期限の延長は行わない
+- Flask側(user_cache.py)と同じく、セッションに記録したパスワードの変更回数がユーザーの現在の値と一致しない場合
+  (ログインした後にパスワードが変更された場合)はログインしていないものとして扱う。
+  現在の値はFlask側がRedisにキャッシュしたユーザー情報から読み取り、キャッシュにない場合はデータベースから読み込む
+- 同じユーザーの同じ検索が処理中の場合は、Elasticsearchへ重ねて問い合わせず、処理中の検索の結果を共有する
+- 入力中の候補は、Flask側(suggestions.py)と同じ世代・キーでRedisにキャッシュし、キャッシュを共有する
+- Elasticsearchに問い合わせられない場合は500を返す(データベースでの代替検索はFlask側でのみ行う)
+"""
+
+# asyncio: 処理中の同じ検索の結果を共有するために使用
+import asyncio
+
+# json: リクエスト・応答の変換と、同じ検索かどうかの判定に使用
+import json
+
+import logging
+
+from http.cookies import SimpleCookie
+from urllib.parse import parse_qs
+
+import redis.asyncio
+
+from sqlalchemy import create_engine, select
+
+from .config import Config
+from . import search, session_store
+from . import suggestions, user_cache
+from .models import User
+
+logger = logging.getLogger(__name__)
+
+# フォームの最大サイズ(検索語とページ送りのカーソルのみのため小さくてよい)
+MAX_BODY_SIZE = 64 * 1024
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class AsyncSearchApp:
+    """Elasticsearchへの検索をasyncioで処理するASGIアプリケーション"""
+
+    def __init__(self, config):
+        self.config = config
+        # 検索のリクエストボディの作成と応答の変換は、Flask側のElasticsearchBackendと共通
+        self.backend = search.ElasticsearchBackend(None, config['ELASTICSEARCH_INDEX'], config['NOTE_PREVIEW_LENGTH'])
+        self.redis = redis.asyncio.Redis.from_url(config['SESSION_REDIS_URL'])
+        # ユーザー情報のキャッシュにない場合に、パスワードの変更回数を読み込むためのデータベース(接続は使用する時に作成される)
+        self.db = create_engine(config['SQLALCHEMY_DATABASE_URI'], **config.get('SQLALCHEMY_ENGINE_OPTIONS', {}))
+        self.es = None
+        # 処理中の検索(キー: (種類, ユーザーID, パラメータ) → asyncio.Task)
+        self._inflight = {}
+        self.routes = {
+            ('POST', '/ForgeGrid/search_notes_async'): self.search_notes,
+            ('GET', '/ForgeGrid/suggest'): self.suggest,
+        }
+
+    def get_es(self):
+        """AsyncElasticsearchクライアントを取得する(最初に使用する時にイベントループ内で作成)"""
+        if self.es is None:
+            from elasticsearch import AsyncElasticsearch
+            config = self.config
+            self.es = AsyncElasticsearch(
+                hosts=[{'host': config['ELASTICSEARCH_HOST'], 'port': config['ELASTICSEARCH_PORT'], 'scheme': config['ELASTICSEARCH_SCHEME']}],
+                ca_certs=config['CA_CERTS_PATH'],
+                basic_auth=(config['ELASTICSEARCH_USER'], config['ELASTICSEARCH_PASSWORD']),
+                # 同時に多数の検索を送信できるよう、Elasticsearchへの接続を多めに保持する
+                connections_per_node=config['ASYNC_SEARCH_CONNECTIONS'],
+            )
+        return self.es
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+
+        handler = self.routes.get((scope['method'], scope['path']))
+        try:
+            if handler is None:
+                raise HTTPError(404, 'Not Found')
+            user_id = await self._current_user_id(scope)
+            if user_id is None:
+                raise HTTPError(401, 'ログインしてください。')
+            status, payload = 200, await handler(scope, receive, user_id)
+        except HTTPError as e:
+            status, payload = e.status, {'error': str(e)}
+        except Exception as e:
+            logger.error(f"Search error: {e}")
+            status, payload = 500, {'error': f'検索中にエラーが発生しました: {e}'}
+
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [
+                (b'content-type', b'application/json'),
+                (b'content-length', str(len(body)).encode()),
+                (b'cache-control', b'no-store'),
+            ],
+        })
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self.es is not None:
+                    await self.es.close()
+                await self.redis.aclose()
+                self.db.dispose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _current_user_id(self, scope):
+        """
+        Redisのセッションからログイン中のユーザーIDを取得する
+        ログインしていない場合と、ログインした後にパスワードが変更された場合はNone
+        """
+        cookie = SimpleCookie()
+        for name, value in scope['headers']:
+            if name == b'cookie':
+                cookie.load(value.decode('latin-1'))
+        morsel = cookie.get(self.config['SESSION_COOKIE_NAME'])
+        if morsel is None:
+            return None
+        store_id = session_store.session_store_id(self.config, morsel.value)
+        if store_id is None:
+            return None
+        data = await self.redis.get(store_id)
+        values = session_store.decode_session(data) if data else None
+        if not values or '_user_id' not in values:
+            return None
+        user_id = int(values['_user_id'])
+        # 変更回数が記録されていないセッションは、Flask側で記録されるまで(次の画面の表示まで)受け付けない
+        expected = values.get(user_cache.SESSION_KEY)
+        if expected is None or expected != await self._password_version(user_id):
+            return None
+        return user_id
+
+    async def _password_version(self, user_id):
+        """ユーザーの現在のパスワードの変更回数(ユーザーが存在しない場合はNone)"""
+        value = await self.redis.get(user_cache.redis_key(user_id))
+        if value is not None:
+            return json.loads(value)['password_version']
+        # キャッシュへの書き込みはFlask側で行う(ここで書き込むと、パスワードの変更と同時の場合に古い値が残り得るため)
+        return await asyncio.to_thread(self._load_password_version, user_id)
+
+    def _load_password_version(self, user_id):
+        """usersテーブルからパスワードの変更回数を読み込む(イベントループを止めないようスレッドで実行する)"""
+        with self.db.connect() as connection:
+            return connection.execute(select(User.password_version).where(User.id == user_id)).scalar()
+
+    @staticmethod
+    def _query_params(scope):
+        return {k: v[0] for k, v in parse_qs(scope['query_string'].decode('latin-1')).items()}
+
+    @staticmethod
+    async def _form(scope, receive):
+        """application/x-www-form-urlencoded のフォームを読み込む"""
+        content_type = dict(scope['headers']).get(b'content-type', b'')
+        if content_type and not content_type.startswith(b'application/x-www-form-urlencoded'):
+            raise HTTPError(415, 'フォームの形式が正しくありません。')
+        body = b''
+        more = True
+        while more:
+            message = await receive()
+            body += message.get('body', b'')
+            more = message.get('more_body', False)
+            if len(body) > MAX_BODY_SIZE:
+                raise HTTPError(413, 'リクエストが大きすぎます。')
+        return {k: v[0] for k, v in parse_qs(body.decode('utf-8')).items()}
+
+    async def _coalesced(self, key, factory):
+        """同じキーの検索が処理中であればその結果を待ち、なければ新たに実行する"""
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self._inflight[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+        # 待っているリクエストの1つが切断されても、他のリクエストの検索は取り消さない
+        return await asyncio.shield(task)
+
+    def _forget(self, key, task):
+        self._inflight.pop(key, None)
+        # 待っていたリクエストがすべて切断された場合も、例外を取り出して警告を出さないようにする
+        if not task.cancelled():
+            task.exception()
+
+    async def search_notes(self, scope, receive, user_id):
+        config = self.config
+        form = await self._form(scope, receive)
+        params = self._query_params(scope)
+        per_page = params.get('per_page', '')
+        per_page = int(per_page) if per_page.isdigit() and int(per_page) > 0 else config['NOTES_PER_PAGE']
+        size = min(per_page, config['NOTES_MAX_PER_PAGE'])
+        query = form.get('search', '').strip()
+        cursor = form.get('after')
+        date_from, date_to = search.parse_date(form.get('date_from')), search.parse_date(form.get('date_to'))
+
+        async def run():
+            # 次ページの有無を判定するために1件多く取得する
+            body = self.backend.build_body(user_id, query, size + 1, search.decode_cursor(cursor), date_from, date_to)
+            res = await self.get_es().search(index=self.backend.index_name, body=body)
+            notes, next_cursor = self.backend.parse_search_response(res, size)
+            return {'notes': notes, 'next_after': next_cursor}
+
+        key = ('search', user_id, json.dumps([query, size, cursor, str(date_from), str(date_to)]))
+        return await self._coalesced(key, run)
+
+    async def suggest(self, scope, receive, user_id):
+        config = self.config
+        prefix = suggestions.normalize_query(self._query_params(scope).get('q', ''))[:config['SUGGEST_MAX_QUERY_LENGTH']]
+        if not prefix:
+            return {'suggestions': []}
+
+        async def run():
+            key, cacheable = None, False
+            try:
+                value = await self.redis.get(suggestions.generation_key(user_id))
+                generation, cacheable = suggestions.parse_generation(value, config['SUGGEST_CACHE_SETTLE_SECONDS'])
+                key = suggestions.cache_key(user_id, generation, prefix)
+                cached = await self.redis.get(key)
+            except Exception:
+                cached = None
+            if cached is not None:
+                return {'suggestions': json.loads(cached)}
+
+            body = self.backend.build_suggest_body(user_id, prefix, config['SUGGEST_LIMIT'])
+            res = await self.get_es().search(index=self.backend.index_name, body=body)
+            result = self.backend.parse_suggest_response(res)
+            if key is not None and cacheable:
+                try:
+                    await self.redis.set(key, json.dumps(result, ensure_ascii=False), ex=config['SUGGEST_CACHE_TTL'])
+                except Exception:
+                    pass
+            return {'suggestions': result}
+
+        return await self._coalesced(('suggest', user_id, prefix), run)
+
+
+def create_async_app(config=None):
+    """検索サービスのASGIアプリケーションを作成する(設定はFlaskアプリケーションと同じConfigクラスから読み込む)"""
+    if config is None:
+        config = {name: getattr(Config, name) for name in dir(Config) if name.isupper()}
+    config.setdefault('SESSION_COOKIE_NAME', 'session')
+    if not config.get('ELASTICSEARCH_HOST'):
+        raise RuntimeError("The async search service requires ELASTICSEARCH_HOST")
+    return AsyncSearchApp(config)
@@ -0,0 +1,247 @@
+"""
+`flask` コマンドから実行する運用向けのCLIコマンドを定義する。
+create_app()でアプリケーションに登録され、例えば `flask search drain-outbox` のように実行する。
+"""
+
+# time: 処理時間の計測や待機に使用
+import time
+
+# os, sys, json, subprocess: 起動時間の計測(別プロセスでアプリケーションを起動する)に使用
+import os
+import sys
+import json
+import subprocess
+
+# click: Flask CLIのコマンド定義に使用
+import click
+
+# AppGroup: アプリケーションコンテキスト内で実行されるコマンドグループ
+from flask import current_app
+from flask.cli import AppGroup, with_appcontext
+
+# 検索インデックス関連のコマンドグループ
+search_cli = AppGroup('search', help='検索インデックスの管理コマンド')
+
+
+@search_cli.command('drain-outbox')
+@click.option('--once', is_flag=True, help='送信待ちの行を送り切ったら終了する')
+@click.option('--batch-size', type=int, default=None, help='1回の_bulkで送信する件数')
+def drain_outbox(once, batch_size):
+    """アウトボックスの変更をElasticsearchへ送信する(専用プロセスとして常駐させることも可能)"""
+    from . import get_es
+    from .search_outbox import drain_once
+
+    es = get_es()
+    if es is None:
+        raise click.ClickException("ELASTICSEARCH_HOSTが設定されていません。")
+
+    app = current_app._get_current_object()
+    interval = app.config['SEARCH_OUTBOX_POLL_INTERVAL']
+    total = 0
+    while True:
+        processed = drain_once(app, es, batch_size)
+        total += processed
+        if processed:
+            continue
+        if once:
+            break
+        time.sleep(interval)
+    click.echo(f"{total} 件のアウトボックス行を処理しました。")
+
+
+@search_cli.command('reindex')
+@click.option('--workers', type=int, default=4, show_default=True, help='_bulkを並列に送信するスレッド数')
+@click.option('--chunk-size', type=int, default=500, show_default=True, help='1回の_bulkで送信する件数')
+@click.option('--fetch-size', type=int, default=1000, show_default=True, help='データベースから一度に読み込む件数')
+@click.option('--keep-old', is_flag=True, help='切り替え後も旧インデックスを削除しない')
+def reindex(workers, chunk_size, fetch_size, keep_old):
+    """PostgreSQLのメモから新しいインデックスを再構築し、エイリアスを無停止で切り替える"""
+    from . import get_es
+    from .search_index import reindex as run_reindex
+
+    es = get_es()
+    if es is None:
+        raise click.ClickException("ELASTICSEARCH_HOSTが設定されていません。")
+
+    run_reindex(
+        es, current_app.config['ELASTICSEARCH_INDEX'], current_app.config['SESSION_REDIS'],
+        workers=workers, chunk_size=chunk_size, fetch_size=fetch_size,
+        keep_old=keep_old, progress=click.echo,
+    )
+
+
+# アップロードファイル関連のコマンドグループ
+uploads_cli = AppGroup('uploads', help='アップロードファイルの管理コマンド')
+
+
+@uploads_cli.command('gc')
+def uploads_gc():
+    """どのユーザーからも参照されていない保存ファイルと、放置されたアップロードを削除する"""
+    from .uploads import collect_garbage
+
+    removed_objects, removed_sessions = collect_garbage(current_app.config, current_app.config['UPLOAD_INCOMING_MAX_AGE'])
+    click.echo(f"保存ファイル {removed_objects} 件、放置されたアップロード {removed_sessions} 件を削除しました。")
+
+
+# ファイル一覧(filesテーブル)関連のコマンドグループ
+files_cli = AppGroup('files', help='ファイル一覧の管理コマンド')
+
+
+@files_cli.command('reconcile')
+@click.option('--username', default=None, help='対象のユーザー名(省略時は全ユーザー)')
+def files_reconcile(username):
+    """アップロード用ディレクトリとfilesテーブルを突き合わせ、直接置かれたファイルや使用容量を反映する"""
+    from .user_files import reconcile
+
+    reconcile(current_app.config, username=username, progress=click.echo)
+
+
+# ユーザーのデータ(メモとファイル)関連のコマンドグループ
+data_cli = AppGroup('data', help='ユーザーのメモとファイルの書き出し・読み込みコマンド')
+
+
+def _get_user(username):
+    from .models import db, User
+
+    user = db.session.execute(db.select(User).where(User.username == username)).scalar()
+    if user is None:
+        raise click.ClickException(f"ユーザー '{username}' が見つかりません。")
+    return user
+
+
+@data_cli.command('export')
+@click.argument('username')
+@click.argument('output', type=click.File('wb'))
+def data_export(username, output):
+    """ユーザーのメモとファイルをzipファイルに書き出す(OUTPUTに - を指定すると標準出力)"""
+    from .user_archive import export_to_file
+
+    export_to_file(current_app.config, _get_user(username), output)
+
+
+@data_cli.command('import')
+@click.argument('username')
+@click.argument('archive', type=click.Path(exists=True, dir_okay=False))
+def data_import(username, archive):
+    """`flask data export` で書き出したzipファイルのメモとファイルを、ユーザーに追加する"""
+    from . import get_es
+    from .search import get_backend
+    from .user_archive import import_archive, ArchiveError
+
+    es = get_es() if get_backend().uses_outbox else None
+    start = time.perf_counter()
+    with open(archive, 'rb') as fh:
+        try:
+            counts = import_archive(current_app.config, _get_user(username), fh, es, progress=click.echo)
+        except ArchiveError as e:
+            raise click.ClickException(str(e))
+    click.echo(f"メモ {counts['notes']} 件、ファイル {counts['files']} 件を読み込みました"
+               f"(読み込まなかったもの {counts['skipped']} 件、{time.perf_counter() - start:.1f}秒)。")
+
+
+# データベース関連のコマンドグループ
+db_cli = AppGroup('db', help='データベースの管理コマンド')
+
+
+@db_cli.command('upgrade')
+def db_upgrade():
+    """テーブルを作成し、未適用のマイグレーション(既存のテーブルへの列の追加など)を適用する"""
+    from .migrations import upgrade
+    from .models import db
+
+    db.create_all()
+    done = upgrade(progress=click.echo)
+    if not done:
+        click.echo("適用するマイグレーションはありません。")
+
+
+# 静的ファイル関連のコマンドグループ
+assets_cli = AppGroup('assets', help='静的ファイルの管理コマンド')
+
+
+@assets_cli.command('build')
+def assets_build():
+    """静的ファイルのハッシュ付きのコピーとgzip・brotliの圧縮ファイルを作成する"""
+    from .assets import build
+    from .views import bp
+
+    manifest = build(bp.static_folder)
+    click.echo(f"{len(manifest)} 件の静的ファイルを作成しました。")
+
+
+@click.command('provision')
+@click.option('--skip-search', is_flag=True, help='検索インデックスを作成しない')
+@click.option('--skip-assets', is_flag=True, help='静的ファイルを作成しない')
+@with_appcontext
+def provision(skip_search, skip_assets):
+    """デプロイ時の準備(テーブルの作成・マイグレーション、検索インデックスと静的ファイルの作成)を行う"""
+    from .provisioning import provision as run_provision
+
+    timings = run_provision(current_app._get_current_object(), progress=click.echo,
+                            search=not skip_search, assets=not skip_assets)
+    for name, seconds in timings.items():
+        click.echo(f"{name:<10} {seconds:8.3f}s")
+    click.echo(f"{'total':<10} {sum(timings.values()):8.3f}s")
+
+
+# 別プロセスでアプリケーションを起動し、インポートとcreate_app()にかかった時間を出力するコード
+_STARTUP_PROBE = (
+    "import json, time\n"
+    "start = time.perf_counter()\n"
+    "from app import create_app\n"
+    "imported = time.perf_counter()\n"
+    "app = create_app()\n"
+    "print(json.dumps({'import': imported - start, 'total': time.perf_counter() - start,"
+    " 'steps': app.extensions['startup_timings']}))\n"
+)
+
+
+def _parse_importtime(stderr):
+    """`python -X importtime` の出力から (累積時間(秒), 階層, モジュール名) の一覧を作成する"""
+    entries = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip(' ')) - 1) // 2
+        entries.append((int(cumulative) / 1e6, depth, name.strip()))
+    return entries
+
+
+@click.command('startup-report')
+@click.option('--top', type=int, default=15, show_default=True, help='表示する時間のかかったインポートの件数')
+@with_appcontext
+def startup_report(top):
+    """新しいプロセスでアプリケーションを起動し、インポートと起動処理ごとの時間を表示する(ワーカーの起動時間の確認用)"""
+    project_root = os.path.dirname(current_app.root_path)
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', _STARTUP_PROBE],
+        cwd=project_root, capture_output=True, text=True,
+    )
+    if result.returncode != 0:
+        raise click.ClickException(f"アプリケーションの起動に失敗しました:\n{result.stderr[-2000:]}")
+    report = json.loads(result.stdout.strip().splitlines()[-1])
+
+    click.echo(f"import app  {report['import']:8.3f}s")
+    click.echo(f"create_app  {report['total'] - report['import']:8.3f}s")
+    for name, seconds in report['steps'].items():
+        click.echo(f"  {name:<10}{seconds:8.3f}s")
+    click.echo(f"total       {report['total']:8.3f}s")
+
+    # 階層の浅い(アプリケーションのモジュールと、そこから直接読み込まれた)インポートを時間の長い順に表示
+    entries = [e for e in _parse_importtime(result.stderr) if e[1] <= 1]
+    click.echo("slowest imports (cumulative):")
+    for seconds, depth, name in sorted(entries, reverse=True)[:top]:
+        click.echo(f"  {seconds:8.3f}s  {'  ' * depth}{name}")
+
+
+def init_app(app):
+    """CLIコマンドをアプリケーションに登録"""
+    app.cli.add_command(provision)
+    app.cli.add_command(startup_report)
+    app.cli.add_command(search_cli)
+    app.cli.add_command(uploads_cli)
+    app.cli.add_command(files_cli)
+    app.cli.add_command(data_cli)
+    app.cli.add_command(assets_cli)
+    app.cli.add_command(db_cli)
@@ -29,6 +29,11 @@ class Config:
     SQLALCHEMY_ENGINE_OPTIONS = {
         'pool_pre_ping': True
     }
+    # 起動時にテーブルの作成・マイグレーション・検索インデックスと静的ファイルの作成(`flask provision` と同じ処理)を行うか
+    # ワーカーの起動を軽くし、Elasticsearchの停止中でも起動できるよう、通常はデプロイ時に `flask provision` を実行する
+    PROVISION_ON_STARTUP = os.environ.get('PROVISION_ON_STARTUP', 'false').lower() == 'true'
+    # 大きなテーブルを変更するマイグレーションで、1回のトランザクションで更新する行数(主キーの範囲)
+    MIGRATION_BATCH_SIZE = int(os.environ.get('MIGRATION_BATCH_SIZE', 10000))
 
     # Redisの設定を追加
     SESSION_TYPE = 'redis'
@@ -38,8 +43,83 @@ class Config:
     SESSION_REDIS_URL = f"redis://{os.environ.get('REDIS_HOST', 'localhost')}:6379/0"
     PERMANENT_SESSION_LIFETIME = timedelta(days=30)
 
+    # パスワードのハッシュの方式とコスト(werkzeug.securityの形式)。異なる方式のハッシュはログイン時に作り直す
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD', 'pbkdf2:sha256:600000')
+    PASSWORD_SALT_LENGTH = 16
+    # ハッシュ計算を行うスレッド数(ワーカープロセスごと)と、実行中・待機中の件数の上限(超えた場合は503を返す)
+    PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', 2))
+    PASSWORD_HASH_QUEUE_LIMIT = int(os.environ.get('PASSWORD_HASH_QUEUE_LIMIT', 8))
+    # ハッシュ計算の結果を待つ最大の時間(秒)と、503の場合のRetry-After(秒)
+    PASSWORD_HASH_TIMEOUT = 10
+    PASSWORD_HASH_RETRY_AFTER = 5
+    # セッションが変更されていない場合に、有効期限(RedisのTTLとCookie)を延長する間隔(秒)
+    SESSION_TTL_REFRESH_INTERVAL = int(os.environ.get('SESSION_TTL_REFRESH_INTERVAL', 3600))
+
+    # 処理時間の計測の設定
+    # レスポンスにServer-Timingヘッダー(SQL・Elasticsearch・Markdown・テンプレートの処理時間)を付けるか
+    SERVER_TIMING_ENABLED = os.environ.get('SERVER_TIMING_ENABLED', 'true').lower() == 'true'
+    # /metrics へのアクセスに必要なトークン(Authorization: Bearer <トークン>)。未設定の場合は /metrics を公開しない(404)
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+    # トークンなしで /metrics を公開するか(外部から接続できない内部のネットワークでのみ使用する場合に true にする)
+    METRICS_PUBLIC = os.environ.get('METRICS_PUBLIC', 'false').lower() == 'true'
+
+    # ログイン中のユーザー情報のキャッシュの設定
+    # ワーカー内のキャッシュの有効期限(秒)と件数の上限。他のワーカーで変更された場合もこの秒数以内に反映される
+    USER_CACHE_TTL = int(os.environ.get('USER_CACHE_TTL', 30))
+    USER_CACHE_MAX_ENTRIES = 1024
+    # Redisに保存したキャッシュの有効期限(秒)
+    USER_CACHE_REDIS_TTL = 3600
+
+    # メモ一覧の1ページあたりの表示件数(per_pageパラメータで変更可能、上限はNOTES_MAX_PER_PAGE)
+    NOTES_PER_PAGE = int(os.environ.get('NOTES_PER_PAGE', 50))
+    NOTES_MAX_PER_PAGE = 200
+    # メモ一覧に表示する本文プレビューの文字数
+    NOTE_PREVIEW_LENGTH = 75
+
+    # 管理画面(Flask-Admin)の一覧の設定
+    # メモの一覧に表示する本文の先頭部分の文字数
+    ADMIN_PREVIEW_LENGTH = 100
+    # 件数を数える上限(PostgreSQL以外では件数をこの数まで数え、超える場合は「N件以上」と表示する)
+    ADMIN_COUNT_LIMIT = int(os.environ.get('ADMIN_COUNT_LIMIT', 10000))
+
+    # Markdown変換結果のブロックキャッシュの設定
+    # プロセス内のLRUキャッシュに保持するブロック数の上限
+    MARKDOWN_CACHE_MAX_ENTRIES = int(os.environ.get('MARKDOWN_CACHE_MAX_ENTRIES', 4096))
+    # Redisにもキャッシュしてワーカー間で共有するか、その保持期間(秒)
+    MARKDOWN_CACHE_USE_REDIS = os.environ.get('MARKDOWN_CACHE_USE_REDIS', 'false').lower() == 'true'
+    MARKDOWN_CACHE_REDIS_TTL = 7 * 24 * 3600
+
+    # 静的ファイルの設定
+    # 起動時にハッシュ付きのファイル名のコピーと圧縮ファイルを作成するか(通常は `flask provision` または `flask assets build` で作成する)
+    ASSETS_BUILD_ON_STARTUP = os.environ.get('ASSETS_BUILD_ON_STARTUP', 'false').lower() == 'true'
+    # ハッシュ付きのファイルをブラウザにキャッシュさせる秒数(内容が変わるとファイル名も変わるため長期間でよい)
+    ASSETS_MAX_AGE = 365 * 24 * 3600
+
     # ファイルアップロードの設定
     UPLOAD_FOLDER = os.path.abspath('./FILE-UPLOAD_DIR')
+    # nginxのX-Accel-Redirectでファイルを送信する場合の内部URLの接頭辞(例: /_forgegrid_files)
+    # nginx側でこの接頭辞をinternalなlocationとしてUPLOAD_FOLDERに割り当てる。未設定の場合はPython側で送信する
+    SEND_FILE_ACCEL_PREFIX = os.environ.get('SEND_FILE_ACCEL_PREFIX')
+    # Markdown内で参照される画像をブラウザにキャッシュさせる秒数
+    USER_IMAGE_MAX_AGE = 24 * 3600
+    # チャンクアップロードの1チャンクのサイズと、アップロードできるファイルサイズの上限(バイト)
+    UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+    UPLOAD_MAX_SIZE = int(os.environ.get('UPLOAD_MAX_SIZE', 100 * 1024 * 1024 * 1024))
+    # 途中で放置されたアップロードを削除するまでの秒数
+    UPLOAD_INCOMING_MAX_AGE = 7 * 24 * 3600
+    # メモとファイルの書き出し(エクスポート)・読み込み(インポート)の設定
+    # メモ・ファイルの一覧をデータベースから一度に読み込む件数(本文は含めず、メモ1件ずつ読み込む)と、
+    # メモのMarkdownの圧縮レベル(0〜9。低いほどCPUの使用が少ない)
+    EXPORT_BATCH_SIZE = 200
+    EXPORT_COMPRESS_LEVEL = int(os.environ.get('EXPORT_COMPRESS_LEVEL', 6))
+    # 1回のINSERTとコミットで登録するメモの件数と、読み込むメモ1件の最大サイズ(バイト)
+    IMPORT_BATCH_SIZE = int(os.environ.get('IMPORT_BATCH_SIZE', 1000))
+    IMPORT_MAX_NOTE_SIZE = 16 * 1024 * 1024
+    # クリップボードから貼り付けられる画像のサイズの上限(バイト)
+    PASTE_IMAGE_MAX_SIZE = int(os.environ.get('PASTE_IMAGE_MAX_SIZE', 50 * 1024 * 1024))
+    # 画像のWebP版・縮小版をバックグラウンドで作成するプロセス数と、WebPの画質(0〜100)
+    IMAGE_WORKERS = int(os.environ.get('IMAGE_WORKERS', 2))
+    IMAGE_WEBP_QUALITY = 80
     # 許可する拡張子
     ALLOWED_EXTENSIONS = {'zip','rdp','ttl','ovf','vmdk','html','txt', 'pdf', 'png', 'jpg', 'jpeg', 'gif','csv','docx','pptx','xlsm','xlsx','tar','gz','xls','tiff','bmp','ico','heic','m4v','mov','mp3','m4a','aiff','aifc','wav','m3u','rtf','m3u','rtfd','pub','py','json','jar','dif','doc','docm','iso','msi','pst','db'}
 
@@ -51,4 +131,35 @@ class Config:
     ELASTICSEARCH_USER = os.environ.get('ELASTICSEARCH_USER', 'elastic')
     ELASTICSEARCH_PASSWORD = os.environ.get('ELASTICSEARCH_PASSWORD')
     # Dockerコンテナ内のCA証明書のパス
-    CA_CERTS_PATH = os.environ.get('ELASTICSEARCH_CA')
\ No newline at end of file
+    CA_CERTS_PATH = os.environ.get('ELASTICSEARCH_CA')
+    # asyncioの検索サービス(async_search.py)がElasticsearchの各ノードに保持する接続数
+    ASYNC_SEARCH_CONNECTIONS = int(os.environ.get('ASYNC_SEARCH_CONNECTIONS', 32))
+
+    # 検索バックエンドの選択
+    # 'auto': ELASTICSEARCH_HOSTが設定されていればElasticsearch、なければデータベース(PostgreSQL / SQLite)の全文検索
+    # 'elasticsearch': Elasticsearchを使用 / 'database': データベースの全文検索を使用
+    SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND', 'auto')
+    # Elasticsearchで検索できない場合にデータベースの全文検索で代替するか
+    SEARCH_FALLBACK_TO_DATABASE = os.environ.get('SEARCH_FALLBACK_TO_DATABASE', 'true').lower() == 'true'
+    # PostgreSQLの全文検索で使用するテキスト検索設定
+    SEARCH_POSTGRES_TS_CONFIG = os.environ.get('SEARCH_POSTGRES_TS_CONFIG', 'simple')
+
+    # 入力中の候補(サジェスト)の設定
+    # 返す候補の件数、候補の検索に使用する入力の最大文字数
+    SUGGEST_LIMIT = 8
+    SUGGEST_MAX_QUERY_LENGTH = 50
+    # Redisに候補をキャッシュする秒数(メモが変更された場合は期限を待たずに参照されなくなる)
+    SUGGEST_CACHE_TTL = int(os.environ.get('SUGGEST_CACHE_TTL', 600))
+    # Elasticsearchへメモの変更を反映した直後、候補をキャッシュしない秒数(反映がElasticsearchのリフレッシュ(既定1秒)で検索できるようになるまでの猶予)
+    SUGGEST_CACHE_SETTLE_SECONDS = 2
+
+    # 検索インデックス反映用アウトボックスの設定
+    # 各uwsgiワーカー内でドレイナースレッドを動かすか(専用プロセスで `flask search drain-outbox` を動かす場合はFalse)
+    SEARCH_OUTBOX_DRAINER = os.environ.get('SEARCH_OUTBOX_DRAINER', 'true').lower() == 'true'
+    # 1回の_bulkで送信する最大件数
+    SEARCH_OUTBOX_BATCH_SIZE = 500
+    # 送信待ちがない場合に次の確認まで待つ秒数
+    SEARCH_OUTBOX_POLL_INTERVAL = 5
+    # 送信失敗時のバックオフ(秒)。失敗するたびに倍になり、上限で頭打ちになる
+    SEARCH_OUTBOX_BASE_BACKOFF = 2
+    SEARCH_OUTBOX_MAX_BACKOFF = 300
\ No newline at end of file
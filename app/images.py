@@ -0,0 +1,157 @@
+"""
+メモに貼り付けられた画像のWebP版・縮小版(派生ファイル)を作成するモジュール。
+変換はリクエストを処理するワーカーとは別のプロセスプールでバックグラウンドに行い、
+作成した派生ファイルは保存ファイルのハッシュごとに UPLOAD_FOLDER/.derived に置く。
+Markdownの変換時に画像へsrcsetを付け、ブラウザが表示サイズに合った派生ファイルを選べるようにする。
+"""
+
+# os: 派生ファイルの保存先の作成や存在確認に使用
+import os
+
+# json: 作成した派生ファイルの幅の一覧(manifest.json)の保存に使用
+import json
+
+# multiprocessing: プロセスプールの起動方法(forkserver)の指定に使用
+import multiprocessing
+
+# threading: プロセスプールの作成と変換中のハッシュの管理の排他制御に使用
+import threading
+
+# ProcessPoolExecutor: 画像の変換をリクエスト処理とは別のプロセスで行うために使用
+# BrokenProcessPool: 変換中のプロセスが異常終了し、プロセスプールが使用できなくなったことの検知に使用
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from flask import current_app
+
+from .uploads import derived_dir, object_path
+
+# 作成する縮小版の幅(px)。元の画像より小さいものだけを作成し、元の幅のWebP版も作成する
+# 変更した場合はmarkdown_render.RENDER_VERSIONも変更し、古いsrcsetのキャッシュを使わないようにする
+DERIVATIVE_WIDTHS = (320, 640, 1280)
+# 派生ファイルを作成する画像の拡張子(アニメーションを含み得るGIFは対象外)
+DERIVATIVE_EXTENSIONS = {'png', 'jpg', 'jpeg'}
+# Markdown内の画像から派生ファイルを参照するURL
+DERIVATIVE_URL = '/ForgeGrid/images/{filename}/{width}.webp'
+
+# ペーストされた画像のContent-Typeと保存時の拡張子の対応
+PASTE_CONTENT_TYPES = {
+    'image/png': 'png',
+    'image/jpeg': 'jpg',
+    'image/gif': 'gif',
+}
+
+_pool = None
+# プロセスプールを作成したプロセスID(uwsgiのフォーク後に各ワーカーで作成し直すため)
+_pool_pid = None
+# このプロセスで変換を依頼中のハッシュ(同じ画像の変換を重複して依頼しないため)
+_pending = set()
+_lock = threading.Lock()
+
+
+def has_derivatives(filename):
+    """派生ファイルを作成する対象の画像か"""
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in DERIVATIVE_EXTENSIONS
+
+
+def build_derivatives(source_path, target_dir, widths, quality):
+    """
+    画像からWebP版・縮小版を作成し、作成した幅の一覧をmanifest.jsonに保存する(プロセスプール内で実行)
+    作成した幅のリストを返す
+    """
+    # Pillowは変換を行うプロセスでのみ読み込む
+    from PIL import Image, ImageOps
+
+    os.makedirs(target_dir, exist_ok=True)
+    with Image.open(source_path) as opened:
+        # スマートフォンで撮影した画像などはEXIFの向きを反映してから縮小する
+        image = ImageOps.exif_transpose(opened)
+        if image.mode not in ('RGB', 'RGBA'):
+            has_alpha = 'A' in image.getbands() or 'transparency' in image.info
+            image = image.convert('RGBA' if has_alpha else 'RGB')
+
+        original_width, original_height = image.size
+        made = sorted({width for width in widths if width < original_width} | {original_width})
+        for width in made:
+            if width == original_width:
+                resized = image
+            else:
+                resized = image.resize((width, max(1, round(original_height * width / original_width))), Image.LANCZOS)
+            path = os.path.join(target_dir, f"{width}.webp")
+            resized.save(path + '.tmp', 'WEBP', quality=quality, method=4)
+            os.replace(path + '.tmp', path)
+
+    # manifest.jsonは全ての派生ファイルを書き終えてから作成し、作成途中のものは参照されないようにする
+    manifest_path = os.path.join(target_dir, 'manifest.json')
+    with open(manifest_path + '.tmp', 'w') as fh:
+        json.dump({'width': original_width, 'widths': made}, fh)
+    os.replace(manifest_path + '.tmp', manifest_path)
+    return made
+
+
+def load_manifest(config, digest):
+    """作成済みの派生ファイルの情報を返す(まだ作成されていなければNone)"""
+    try:
+        with open(os.path.join(derived_dir(config, digest), 'manifest.json')) as fh:
+            return json.load(fh)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def pick_width(manifest, width):
+    """要求された幅以上で最も小さい派生ファイルの幅を返す(なければ最大のもの)"""
+    widths = manifest['widths']
+    return next((w for w in widths if w >= width), widths[-1])
+
+
+def _get_pool(workers):
+    """このプロセスのプロセスプールを返す(初回、またはプールが使用できなくなった場合に作成)"""
+    global _pool, _pool_pid
+    pid = os.getpid()
+    with _lock:
+        if _pool_pid != pid or _pool is None:
+            # スレッドを持つワーカープロセスから直接フォークしないよう、forkserverで変換用のプロセスを起動する
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('forkserver'))
+            _pool_pid = pid
+            _pending.clear()
+        return _pool
+
+
+def schedule_derivatives(digest):
+    """保存ファイルの派生ファイルの作成をプロセスプールに依頼する(作成済み・依頼中の場合は何もしない)"""
+    global _pool
+    app = current_app._get_current_object()
+    config = app.config
+    if load_manifest(config, digest) is not None:
+        return
+    pool = _get_pool(config['IMAGE_WORKERS'])
+    with _lock:
+        if digest in _pending:
+            return
+        _pending.add(digest)
+
+    def _done(future):
+        global _pool
+        with _lock:
+            _pending.discard(digest)
+            # 壊れた画像などで変換プロセスが異常終了した場合は、次の依頼時にプールを作り直す
+            if isinstance(future.exception(), BrokenProcessPool) and _pool is pool:
+                _pool = None
+        error = future.exception()
+        if error is not None:
+            app.logger.warning(f"Image derivative error ({digest}): {error}")
+
+    try:
+        future = pool.submit(
+            build_derivatives, object_path(config, digest), derived_dir(config, digest),
+            DERIVATIVE_WIDTHS, config['IMAGE_WEBP_QUALITY'],
+        )
+    except Exception as e:
+        # 派生ファイルがなくても元の画像で表示できるため、依頼に失敗してもアップロードは成功させる
+        with _lock:
+            _pending.discard(digest)
+            if isinstance(e, BrokenProcessPool) and _pool is pool:
+                _pool = None
+        app.logger.warning(f"Image derivative error ({digest}): {e}")
+        return
+    future.add_done_callback(_done)
@@ -0,0 +1,259 @@
+"""
+MarkdownをHTMLに変換するモジュール(テンプレートフィルター markdown_to_html の本体)。
+メモをトップレベルのブロック(空行で区切られた段落・コードブロック・リストなど)に分割し、
+ブロックごとの変換結果を内容のハッシュをキーにしてLRUキャッシュ(必要に応じてRedisも)に保存する。
+巨大なメモの一部だけを編集した場合でも、変更されたブロックだけを変換し直せばよい。
+"""
+
+# hashlib: ブロックの内容からキャッシュキーを作成するために使用
+import hashlib
+
+# re: リンク参照定義や生のHTMLブロックなど、ブロック単位で変換できない記法を検出するために使用
+import re
+
+# threading: Markdownインスタンスをスレッドごとに再利用するため、またキャッシュの排他制御に使用
+import threading
+
+# OrderedDict: LRUキャッシュの実装に使用
+from collections import OrderedDict
+
+# Markup: HTML文字列を「安全」としてマークするために使用。これにより、Jinja2テンプレートでエスケープされずに表示
+from markupsafe import Markup
+
+# markdownと拡張機能(pymdownx.tasklistなど)は読み込みに時間がかかるため、最初に変換する時に _new_markdown() でインポートする
+from . import images, metrics
+
+# 変換の設定(拡張機能)を変えた場合はこの値を変更し、古いキャッシュを使わないようにする
+RENDER_VERSION = '2'
+
+_FENCE_RE = re.compile(r'^ {0,3}(`{3,}|~{3,})')
+_LIST_ITEM_RE = re.compile(r'^ {0,3}([*+-]|\d+[.)])\s')
+# ブロックをまたいで効果を持つ記法(リンク参照定義)や、空行を含み得る生のHTMLブロック
+_WHOLE_DOCUMENT_RE = re.compile(r'^ {0,3}(\[[^\]]+\]:\s|<[A-Za-z!/])', re.MULTILINE)
+# ユーザーのディレクトリにある画像を参照するsrc(ディレクトリやスキームを含まないファイル名のみ)
+_USER_IMAGE_SRC_RE = re.compile(r'^[\w.-]+$')
+
+_local = threading.local()
+
+
+def _add_image_srcset(root):
+    """ユーザーの画像にWebP版・縮小版のsrcsetを付け、画面外の画像は遅延読み込みにする"""
+    for img in root.iter('img'):
+        src = img.get('src', '')
+        if not _USER_IMAGE_SRC_RE.match(src) or not images.has_derivatives(src):
+            continue
+        img.set('srcset', ', '.join(
+            f"{images.DERIVATIVE_URL.format(filename=src, width=width)} {width}w"
+            for width in images.DERIVATIVE_WIDTHS
+        ))
+        img.set('sizes', f"(max-width: {images.DERIVATIVE_WIDTHS[-1]}px) 100vw, {images.DERIVATIVE_WIDTHS[-1]}px")
+        img.set('loading', 'lazy')
+        img.set('decoding', 'async')
+
+
+def _new_markdown():
+    """変換に使用するMarkdownインスタンスを作成"""
+    # markdown: MarkdownテキストをHTMLに変換するために使用。メモ帳アプリの主要な機能の一部(本アプリのメイン)
+    import markdown
+    # Extension, Treeprocessor: 変換後の画像タグにsrcsetを付ける独自の拡張機能の作成に使用
+    from markdown.extensions import Extension
+    # markdown.extensions.fenced_code: Markdownでフェンス付きコードブロック（```python ... ```）をサポートするための拡張機能
+    # markdown.extensions.tables: Markdownでテーブル（表）をサポートするための拡張機能
+    from markdown.extensions.fenced_code import FencedCodeExtension
+    from markdown.extensions.tables import TableExtension
+    from markdown.treeprocessors import Treeprocessor
+    # pymdownx.tasklist: Markdownでタスクリスト（チェックボックス付きリスト）をサポートするための拡張機能
+    from pymdownx.tasklist import TasklistExtension
+
+    class ImageSrcsetProcessor(Treeprocessor):
+        def run(self, root):
+            _add_image_srcset(root)
+
+    class ImageSrcsetExtension(Extension):
+        def extendMarkdown(self, md):
+            md.treeprocessors.register(ImageSrcsetProcessor(md), 'image_srcset', 0)
+
+    return markdown.Markdown(extensions=[
+        FencedCodeExtension(),
+        TableExtension(),
+        'nl2br',
+        TasklistExtension(),
+        'codehilite',
+        ImageSrcsetExtension(),
+    ])
+
+
+def _convert(text):
+    """スレッドごとに1つのMarkdownインスタンスを使い回して変換する"""
+    md = getattr(_local, 'md', None)
+    if md is None:
+        md = _local.md = _new_markdown()
+    md.reset()
+    return md.convert(text)
+
+
+def _continues(previous_block, first_line):
+    """空行をはさんでも前のブロックと一体として解釈される行か(リストの項目や引用の続き)"""
+    if _LIST_ITEM_RE.match(first_line) and _LIST_ITEM_RE.match(previous_block):
+        return True
+    return first_line.lstrip().startswith('>') and previous_block.lstrip().startswith('>')
+
+
+def split_blocks(text):
+    """
+    Markdownをトップレベルのブロックに分割する
+    コードブロック内の空行では分割せず、インデントされた行(リストの続きやインデントコード)や
+    連続するリスト・引用は前のブロックとまとめて、単独で変換しても結果が変わらない単位にする
+    """
+    blocks = []
+    current = []
+    fence = None
+
+    def flush():
+        if not current:
+            return
+        block = '\n'.join(current)
+        first = current[0]
+        if blocks and (first[:1] in (' ', '\t') or _continues(blocks[-1], first)):
+            blocks[-1] = blocks[-1] + '\n\n' + block
+        else:
+            blocks.append(block)
+        current.clear()
+
+    for line in text.split('\n'):
+        match = _FENCE_RE.match(line)
+        if fence is None:
+            if match:
+                fence = match.group(1)
+            elif not line.strip():
+                flush()
+                continue
+        elif match and match.group(1)[0] == fence[0] and len(match.group(1)) >= len(fence):
+            fence = None
+        current.append(line)
+    flush()
+    return blocks
+
+
+class RenderCache:
+    """
+    ブロックの変換結果を保持するキャッシュ
+    プロセス内のLRU(件数上限あり)を使用し、Redisが設定されている場合はワーカー間でも共有する
+    """
+
+    def __init__(self, max_entries=2048, redis_client=None, redis_ttl=86400):
+        self.max_entries = max_entries
+        self.redis = redis_client
+        self.redis_ttl = redis_ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.redis_hits = 0
+
+    @staticmethod
+    def key(block):
+        return 'md:' + RENDER_VERSION + ':' + hashlib.sha1(block.encode('utf-8')).hexdigest()
+
+    def get_many(self, keys):
+        """キーに対応する変換結果を取得する。見つからないキーは結果に含まれない"""
+        found = {}
+        with self._lock:
+            for key in keys:
+                html = self._entries.get(key)
+                if html is not None:
+                    self._entries.move_to_end(key)
+                    found[key] = html
+
+        missing = [key for key in keys if key not in found]
+        if missing and self.redis is not None:
+            try:
+                values = self.redis.mget(missing)
+            except Exception:
+                values = [None] * len(missing)
+            from_redis = {key: value.decode('utf-8') for key, value in zip(missing, values) if value is not None}
+            self._store_local(from_redis)
+            found.update(from_redis)
+            self.redis_hits += len(from_redis)
+
+        self.hits += len(found)
+        self.misses += len(set(keys)) - len(found)
+        return found
+
+    def set_many(self, items):
+        """変換結果を保存する"""
+        self._store_local(items)
+        if items and self.redis is not None:
+            try:
+                pipe = self.redis.pipeline(transaction=False)
+                for key, html in items.items():
+                    pipe.set(key, html, ex=self.redis_ttl)
+                pipe.execute()
+            except Exception:
+                pass
+
+    def _store_local(self, items):
+        with self._lock:
+            for key, html in items.items():
+                self._entries[key] = html
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        """キャッシュのヒット・ミスの回数と現在の件数"""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'redis_hits': self.redis_hits,
+            'entries': len(self._entries),
+            'max_entries': self.max_entries,
+        }
+
+
+_cache = RenderCache()
+
+
+def render(text, cache=None):
+    """MarkdownをHTMLに変換する(変更のないブロックはキャッシュから取得)"""
+    cache = cache or _cache
+    text = (text or '').replace('\r\n', '\n').replace('\r', '\n')
+
+    # ブロックをまたぐ記法を含む場合は、文書全体を1つのブロックとして扱う
+    blocks = [text] if _WHOLE_DOCUMENT_RE.search(text) else split_blocks(text)
+    keys = [cache.key(block) for block in blocks]
+    found = cache.get_many(keys)
+
+    rendered = {}
+    parts = []
+    for key, block in zip(keys, blocks):
+        html = found.get(key) or rendered.get(key)
+        if html is None:
+            html = rendered[key] = _convert(block)
+        parts.append(html)
+    if rendered:
+        cache.set_many(rendered)
+    return '\n'.join(parts)
+
+
+def markdown_to_html(text):
+    """Markdown変換のテンプレートフィルター"""
+    with metrics.phase('md'):
+        return Markup(render(text))
+
+
+def cache_stats():
+    """ブロックキャッシュの統計情報"""
+    return _cache.stats()
+
+
+def init_app(app):
+    """設定に応じてキャッシュを作成し、テンプレートフィルターを登録する"""
+    global _cache
+    redis_client = app.config['SESSION_REDIS'] if app.config['MARKDOWN_CACHE_USE_REDIS'] else None
+    _cache = RenderCache(
+        max_entries=app.config['MARKDOWN_CACHE_MAX_ENTRIES'],
+        redis_client=redis_client,
+        redis_ttl=app.config['MARKDOWN_CACHE_REDIS_TTL'],
+    )
+    app.add_template_filter(markdown_to_html, 'markdown_to_html')
@@ -0,0 +1,257 @@
+"""
+リクエストごとの処理時間を計測するモジュール。
+データベース(SQL)、Elasticsearch、Markdown変換、テンプレートの描画にかかった時間と回数をエンドポイントごとに記録し、
+レスポンスの Server-Timing ヘッダーで返すとともに、Prometheus形式の /metrics で集計結果を公開する。
+
+uwsgiの複数のワーカープロセスの値を正しく合算するため、環境変数 PROMETHEUS_MULTIPROC_DIR が設定されている場合は
+prometheus_clientのマルチプロセスモード(各プロセスがディレクトリ内のファイルに書き込み、/metricsで合算する)を使用する。
+ファイルはプロセスIDごとに作られるため、max-requestsでワーカーが入れ替わるたびに増えていく。
+uwsgiのワーカーの終了時に、そのワーカーのカウンター・ヒストグラムの値を合算用のファイル(counter_archive.dbなど)に加えて削除し、
+ゲージは mark_process_dead で削除する(合算の途中のファイルを/metricsが読まないよう、ファイルロックで排他する)。
+"""
+
+# os: マルチプロセスモードの判定(PROMETHEUS_MULTIPROC_DIR)に使用
+import os
+
+# time: 処理時間の計測に使用
+import time
+
+# hmac: /metricsのトークンの比較に使用
+import hmac
+
+# fcntl: ワーカーの終了時の合算と/metricsの読み込みの排他に使用
+import fcntl
+
+from contextlib import contextmanager
+
+from flask import abort, g, has_request_context, request, template_rendered, before_render_template
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Histogram, REGISTRY, generate_latest, multiprocess,
+)
+from prometheus_client.mmap_dict import MmapedDict
+
+# 計測する処理の種類と、Server-Timingヘッダーでの説明
+PHASES = {
+    'db': 'SQL',
+    'es': 'Elasticsearch',
+    'md': 'Markdown',
+    'tpl': 'Template',
+}
+
+REQUEST_DURATION = Histogram(
+    'forgegrid_request_duration_seconds', 'リクエストの処理時間',
+    ['endpoint', 'method', 'status'],
+)
+PHASE_DURATION = Histogram(
+    'forgegrid_request_phase_duration_seconds', '1リクエスト内の処理の種類ごとの合計時間',
+    ['endpoint', 'phase'],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0),
+)
+PHASE_CALLS = Counter(
+    'forgegrid_request_phase_calls_total', '処理の種類ごとの呼び出し回数(SQLの実行回数など)',
+    ['endpoint', 'phase'],
+)
+
+
+def _timings():
+    """現在のリクエストの計測結果(リクエスト外で呼ばれた場合はNone)"""
+    if not has_request_context():
+        return None
+    timings = g.get('_phase_timings')
+    if timings is None:
+        timings = g._phase_timings = {}
+    return timings
+
+
+def record(phase, seconds):
+    """処理時間を現在のリクエストに加算する"""
+    timings = _timings()
+    if timings is None:
+        return
+    total, calls = timings.get(phase, (0.0, 0))
+    timings[phase] = (total + seconds, calls + 1)
+
+
+@contextmanager
+def phase(name):
+    """with文の中の処理時間を計測する"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+
+# --- SQLAlchemyのイベントでSQLの実行時間を計測 ---
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('_query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('_query_start')
+    if starts:
+        record('db', time.perf_counter() - starts.pop())
+
+
+@event.listens_for(Engine, "handle_error")
+def _handle_error(context):
+    starts = context.connection.info.get('_query_start') if context.connection is not None else None
+    if starts:
+        record('db', time.perf_counter() - starts.pop())
+
+
+def instrument_elasticsearch(es_client):
+    """Elasticsearchクライアントの通信(トランスポート)の時間を計測するようにする"""
+    transport = es_client.transport
+    perform_request = transport.perform_request
+
+    def timed_perform_request(*args, **kwargs):
+        with phase('es'):
+            return perform_request(*args, **kwargs)
+
+    transport.perform_request = timed_perform_request
+
+
+def _before_render(sender, template, context, **extra):
+    g.setdefault('_template_start', []).append(time.perf_counter())
+
+
+def _after_render(sender, template, context, **extra):
+    starts = g.get('_template_start')
+    if starts:
+        # テンプレート内で行われるMarkdown変換の時間も含む
+        record('tpl', time.perf_counter() - starts.pop())
+
+
+def server_timing_header(timings, total):
+    """計測結果をServer-Timingヘッダーの形式にする"""
+    parts = []
+    for name, description in PHASES.items():
+        if name in timings:
+            seconds, calls = timings[name]
+            parts.append(f'{name};dur={seconds * 1000:.1f};desc="{description} x{calls}"')
+    parts.append(f'total;dur={total * 1000:.1f}')
+    return ', '.join(parts)
+
+
+def _registry():
+    """/metricsで出力するレジストリ(マルチプロセスモードでは全プロセスの値を合算する)"""
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    return REGISTRY
+
+
+# 終了したワーカーの値を合算するファイルの種類(いずれも値を足し合わせればよい)
+_ARCHIVED_TYPES = ('counter', 'histogram', 'summary')
+
+
+@contextmanager
+def _multiprocess_lock(path, shared):
+    """マルチプロセスモードのディレクトリのロック(/metricsの読み込みは共有、ワーカーの終了時の合算は排他)"""
+    fd = os.open(os.path.join(path, '.lock'), os.O_CREAT | os.O_RDWR, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+
+def archive_process(pid=None):
+    """
+    終了するプロセスの計測値を合算用のファイルに加え、プロセスIDごとのファイルを削除する
+    uwsgiのワーカーの終了時(uwsgi.atexit)に呼び出される
+    """
+    path = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+    if not path or not os.path.isdir(path):
+        return
+    pid = pid or os.getpid()
+    with _multiprocess_lock(path, shared=False):
+        for typ in _ARCHIVED_TYPES:
+            filename = os.path.join(path, f'{typ}_{pid}.db')
+            if not os.path.exists(filename):
+                continue
+            archive = MmapedDict(os.path.join(path, f'{typ}_archive.db'))
+            try:
+                for key, value, timestamp, _ in MmapedDict.read_all_values_from_file(filename):
+                    total, _ = archive.read_value(key)
+                    archive.write_value(key, total + value, timestamp)
+            finally:
+                archive.close()
+            os.remove(filename)
+    multiprocess.mark_process_dead(pid, path)
+
+
+def _register_worker_exit():
+    """uwsgiで動作している場合、ワーカーの終了時に計測値のファイルを片付ける"""
+    if not os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        return
+    try:
+        import uwsgi
+    except ImportError:
+        return
+    previous = getattr(uwsgi, 'atexit', None)
+
+    def _atexit():
+        try:
+            archive_process()
+        finally:
+            if previous is not None:
+                previous()
+
+    uwsgi.atexit = _atexit
+
+
+def init_app(app):
+    """計測用のフックと /metrics を登録する"""
+    template_rendered.connect(_after_render, app)
+    before_render_template.connect(_before_render, app)
+    _register_worker_exit()
+
+    @app.before_request
+    def _start_timer():
+        g._request_start = time.perf_counter()
+
+    @app.after_request
+    def _record_request(response):
+        start = g.get('_request_start')
+        if start is None:
+            return response
+        total = time.perf_counter() - start
+        timings = g.get('_phase_timings', {})
+        endpoint = request.endpoint or 'unknown'
+        if endpoint == 'metrics':
+            return response
+        REQUEST_DURATION.labels(endpoint, request.method, response.status_code).observe(total)
+        for name, (seconds, calls) in timings.items():
+            PHASE_DURATION.labels(endpoint, name).observe(seconds)
+            PHASE_CALLS.labels(endpoint, name).inc(calls)
+        if app.config['SERVER_TIMING_ENABLED']:
+            response.headers['Server-Timing'] = server_timing_header(timings, total)
+        return response
+
+    def metrics():
+        """Prometheus形式で計測結果を返す(METRICS_TOKENが未設定の場合は、METRICS_PUBLICで明示しない限り公開しない)"""
+        token = app.config['METRICS_TOKEN']
+        if token:
+            expected = f"Bearer {token}"
+            if not hmac.compare_digest(request.headers.get('Authorization', ''), expected):
+                abort(401)
+        elif not app.config['METRICS_PUBLIC']:
+            abort(404)
+        path = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+        if path:
+            # 終了したワーカーの値を合算している途中のファイルを読まないようにする
+            with _multiprocess_lock(path, shared=True):
+                output = generate_latest(_registry())
+        else:
+            output = generate_latest(_registry())
+        return output, 200, {'Content-Type': CONTENT_TYPE_LATEST}
+
+    app.add_url_rule('/metrics', 'metrics', metrics)
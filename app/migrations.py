@@ -0,0 +1,200 @@
+"""
+既存のデータベースに対するテーブル定義の変更(マイグレーション)を管理するモジュール。
+db.create_all()は新しいテーブルしか作成しないため、既存のテーブルへの列の追加などはここに順番に定義し、
+適用済みのものはschema_migrationsテーブルに記録して二度実行しないようにする。
+
+大きなテーブルを変更するマイグレーションは @online を付け、全体を1つのトランザクションにせずにバッチごとにコミットする。
+書き込みを長時間止めないようにするためで、途中で中断した場合も再実行すれば続きから適用される。
+"""
+
+# time: バッチ処理の進捗(rows/s)の計測に使用
+import time
+
+from flask import current_app
+from sqlalchemy import inspect, insert, text, Date
+
+from .models import db, SchemaMigration
+
+
+def _add_column(connection, table, column, ddl):
+    """列が存在しなければ追加する(create_allで作成した新しいデータベースには既に存在する)"""
+    columns = {col['name'] for col in inspect(connection).get_columns(table)}
+    if column not in columns:
+        connection.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+
+
+def _note_revision(connection):
+    """メモのリビジョン番号と、ユーザーごとのメモ一覧のリビジョン番号を追加"""
+    _add_column(connection, 'notes', 'revision', 'INTEGER NOT NULL DEFAULT 1')
+    _add_column(connection, 'users', 'notes_revision', 'INTEGER NOT NULL DEFAULT 0')
+
+
+def online(migrate):
+    """
+    トランザクションを自分で管理するマイグレーションとして印を付ける
+    migrate(engine, progress) の形で呼び出され、各処理は再実行しても問題ないように作る
+    """
+    migrate.online = True
+    return migrate
+
+
+def _index_is_valid(connection, name):
+    """PostgreSQLのインデックスが存在し、有効か(CONCURRENTLYでの作成が中断されると無効なインデックスが残る)"""
+    row = connection.execute(text(
+        "SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid WHERE c.relname = :name"
+    ), {'name': name}).first()
+    return None if row is None else row.indisvalid
+
+
+def _create_index_concurrently(engine, name, ddl):
+    """書き込みを止めずにインデックスを作成する(PostgreSQL)。中断されて無効になったものは作り直す"""
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        if _index_is_valid(conn, name) is False:
+            conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+        conn.execute(text(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {ddl}"))
+
+
+def _backfill(engine, statement, progress, label):
+    """
+    主キーの範囲ごとにUPDATEを実行してコミットする(1回のロックは最大でもバッチ件数分の行のみ)
+    statementは :lo < id <= :hi の範囲の行を更新するSQL
+    """
+    batch_size = current_app.config['MIGRATION_BATCH_SIZE']
+    with engine.connect() as conn:
+        max_id = conn.execute(text("SELECT max(id) FROM notes")).scalar() or 0
+    started = time.perf_counter()
+    updated = 0
+    for lo in range(0, max_id, batch_size):
+        with engine.begin() as conn:
+            updated += conn.execute(text(statement), {'lo': lo, 'hi': lo + batch_size}).rowcount
+        if progress and (lo // batch_size) % 100 == 99:
+            progress(f"{label}: id {lo + batch_size}/{max_id}, {updated} rows ({updated / (time.perf_counter() - started):.0f} rows/s)")
+    if progress:
+        progress(f"{label}: {updated} rows updated in {time.perf_counter() - started:.1f}s")
+
+
+# 文字列の日付('YYYY-MM-DD' で始まるもの)をdate型に変換する式。形式が異なるものは1970-01-01にする
+_PG_PARSE_DATE = "CASE WHEN {col} ~ '^[0-9]{{4}}-[0-9]{{2}}-[0-9]{{2}}' THEN substring({col} from 1 for 10)::date ELSE DATE '1970-01-01' END"
+
+
+def _note_date_postgresql(engine, progress):
+    """
+    notes.dateを文字列からdate型に変換する(PostgreSQL)
+    ALTER COLUMN TYPEはテーブル全体を書き換える間ロックするため、新しい列を追加してバッチで値を移し、最後に列を入れ替える
+    移行中に書き込まれたメモはトリガーで新しい列にも反映する
+    """
+    with engine.connect() as conn:
+        columns = {col['name']: col for col in inspect(conn).get_columns('notes')}
+    if isinstance(columns['date']['type'], Date):
+        # create_allで作成したデータベース、または変換済み
+        return
+
+    with engine.begin() as conn:
+        # NULLを許可しデフォルト値もないため、列の追加でテーブルは書き換えられない
+        conn.execute(text("ALTER TABLE notes ADD COLUMN IF NOT EXISTS date_new date"))
+        conn.execute(text(f"""
+            CREATE OR REPLACE FUNCTION notes_date_sync() RETURNS trigger AS $$
+            BEGIN
+                NEW.date_new := {_PG_PARSE_DATE.format(col='NEW.date')};
+                RETURN NEW;
+            END
+            $$ LANGUAGE plpgsql
+        """))
+        conn.execute(text("DROP TRIGGER IF EXISTS notes_date_sync ON notes"))
+        conn.execute(text(
+            "CREATE TRIGGER notes_date_sync BEFORE INSERT OR UPDATE OF date ON notes FOR EACH ROW EXECUTE FUNCTION notes_date_sync()"
+        ))
+
+    _backfill(
+        engine,
+        f"UPDATE notes SET date_new = {_PG_PARSE_DATE.format(col='date')} WHERE id > :lo AND id <= :hi AND date_new IS NULL",
+        progress, 'notes.date',
+    )
+
+    # NOT NULLの確認(テーブル全体の走査)は、書き込みを止めないVALIDATE CONSTRAINTで事前に行っておく
+    with engine.begin() as conn:
+        exists = conn.execute(text("SELECT 1 FROM pg_constraint WHERE conname = 'notes_date_new_not_null'")).first()
+        if not exists:
+            conn.execute(text("ALTER TABLE notes ADD CONSTRAINT notes_date_new_not_null CHECK (date_new IS NOT NULL) NOT VALID"))
+    with engine.begin() as conn:
+        conn.execute(text("ALTER TABLE notes VALIDATE CONSTRAINT notes_date_new_not_null"))
+
+    # 列の入れ替え(検証済みの制約があるためSET NOT NULLは走査を行わず、DROP COLUMNも書き換えを行わない)
+    with engine.begin() as conn:
+        conn.execute(text("ALTER TABLE notes ALTER COLUMN date_new SET NOT NULL"))
+        conn.execute(text("DROP TRIGGER notes_date_sync ON notes"))
+        conn.execute(text("DROP FUNCTION notes_date_sync()"))
+        conn.execute(text("ALTER TABLE notes DROP COLUMN date"))
+        conn.execute(text("ALTER TABLE notes RENAME COLUMN date_new TO date"))
+        conn.execute(text("ALTER TABLE notes DROP CONSTRAINT notes_date_new_not_null"))
+
+
+def _note_date_sqlite(engine, progress):
+    """
+    notes.dateの値をdate型として読める 'YYYY-MM-DD' 形式にそろえる(SQLite)
+    SQLiteは列の型に関係なく値を保存するため、列の定義は変更せずに値のみを変換する
+    """
+    pattern = "'[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]'"
+    _backfill(
+        engine,
+        f"UPDATE notes SET date = CASE WHEN substr(date, 1, 10) GLOB {pattern} THEN substr(date, 1, 10) ELSE '1970-01-01' END "
+        f"WHERE id > :lo AND id <= :hi AND NOT (length(date) = 10 AND date GLOB {pattern})",
+        progress, 'notes.date',
+    )
+
+
+def _search_outbox_user(connection):
+    """アウトボックスにメモの所有者の列を追加(削除されたメモの所有者も送信後に分かるようにする)"""
+    _add_column(connection, 'search_outbox', 'user_id', 'INTEGER')
+
+
+@online
+def _note_date(engine, progress):
+    """メモの作成日をdate型にし、ユーザーごとの一覧・日付順の検索用のインデックスを追加"""
+    if engine.dialect.name == 'postgresql':
+        _note_date_postgresql(engine, progress)
+        _create_index_concurrently(engine, 'ix_notes_user_id', 'notes (user_id, id DESC)')
+        _create_index_concurrently(engine, 'ix_notes_user_date', 'notes (user_id, date DESC, id DESC)')
+    else:
+        _note_date_sqlite(engine, progress)
+        with engine.begin() as conn:
+            conn.execute(text("CREATE INDEX IF NOT EXISTS ix_notes_user_id ON notes (user_id, id DESC)"))
+            conn.execute(text("CREATE INDEX IF NOT EXISTS ix_notes_user_date ON notes (user_id, date DESC, id DESC)"))
+
+
+def _user_password_version(connection):
+    """パスワードの変更回数(セッションの無効化に使用)を追加"""
+    _add_column(connection, 'users', 'password_version', 'INTEGER NOT NULL DEFAULT 1')
+
+
+# (バージョン, 変更内容)を適用する順番に並べる。適用済みのものは変更せず、新しい変更は末尾に追加する
+MIGRATIONS = [
+    ('0001_note_revision', _note_revision),
+    ('0002_note_date', _note_date),
+    ('0003_search_outbox_user', _search_outbox_user),
+    ('0004_user_password_version', _user_password_version),
+]
+
+
+def upgrade(progress=None):
+    """未適用のマイグレーションを順番に適用し、適用したバージョンのリストを返す"""
+    applied = set(db.session.execute(db.select(SchemaMigration.version)).scalars())
+    db.session.rollback()
+    done = []
+    for version, migrate in MIGRATIONS:
+        if version in applied:
+            continue
+        if getattr(migrate, 'online', False):
+            # バッチごとにコミットするマイグレーション。完了後に適用済みとして記録する
+            migrate(db.engine, progress)
+            with db.engine.begin() as connection:
+                connection.execute(insert(SchemaMigration).values(version=version))
+        else:
+            # 変更ごとにトランザクションを分け、途中で失敗しても適用済みのものは記録されるようにする
+            with db.engine.begin() as connection:
+                migrate(connection)
+                connection.execute(insert(SchemaMigration).values(version=version))
+        if progress:
+            progress(f"{version} を適用しました。")
+        done.append(version)
+    return done
@@ -12,9 +12,17 @@ from flask_login import UserMixin
 # DeclarativeBase: SQLAlchemy ORMでモデルを定義するための基底クラス
 # Mapped, mapped_column: SQLAlchemy 2.0スタイルでカラムと関係をマップするために使用
 # relationship: データベーステーブル間の関係（例：一対多）を定義するために使用
-# Integer, String, Column, Text: SQLAlchemyでデータベースのカラム型を定義するために使用
-from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
-from sqlalchemy import Integer, String, Column, Text, ForeignKey
+# Integer, BigInteger, String, Text, Date, DateTime: SQLAlchemyでデータベースのカラム型を定義するために使用
+# Index, UniqueConstraint: 複数カラムのインデックスや一意制約を定義するために使用(text: インデックスの降順の指定に使用)
+# query_expression: 問い合わせごとに値を指定する列(管理画面の本文の先頭部分)を定義するために使用
+from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship, query_expression
+from sqlalchemy import text, Integer, BigInteger, String, Text, Date, DateTime, ForeignKey, Index, UniqueConstraint
+
+# datetime: アウトボックスの登録時刻やリトライ時刻を扱うために使用
+# date_type: メモの作成日の型ヒントに使用(Note.date列の名前と区別するため別名でインポート)
+# Optional: NULLを許可するカラムの型ヒントに使用
+from datetime import datetime, timezone, date as date_type
+from typing import Optional
 
 
 
@@ -26,6 +34,11 @@ class Base(DeclarativeBase):
 # model_classに先ほど定義したBaseクラスを指定することで、新しい宣言的スタイルを使用
 db = SQLAlchemy(model_class=Base)
 
+
+def utcnow():
+    """タイムゾーン情報を持たないUTCの現在時刻を返す(DateTimeカラムの保存形式に合わせる)"""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
 class User(UserMixin, db.Model):
     """
     ユーザー情報を格納するデータベースモデル
@@ -35,6 +48,11 @@ class User(UserMixin, db.Model):
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     username: Mapped[str] = mapped_column(String(250), unique=True, nullable=False)
     password: Mapped[str] = mapped_column(String(250), nullable=False)
+    # ユーザーのメモのいずれかが作成・更新・削除されるたびに増える値(メモ一覧のETagに使用)
+    notes_revision: Mapped[int] = mapped_column(Integer, nullable=False, default=0, server_default="0")
+    # パスワードが変更されるたびに増える値(ログイン中の他のセッションの無効化に使用)
+    # ログイン時のハッシュ方式の更新(作り直し)では増やさない
+    password_version: Mapped[int] = mapped_column(Integer, nullable=False, default=1, server_default="1")
     
     # UserとNoteのリレーションシップを定義
     notes = relationship("Note", back_populates="user")
@@ -44,13 +62,82 @@ class Note(db.Model):
     ユーザーに紐づけられる
     """
     __tablename__ = "notes"
+    __table_args__ = (
+        # ユーザーごとのメモ一覧(IDの降順)と、日付の新しい順の検索・日付の範囲での絞り込みに使用
+        Index("ix_notes_user_id", "user_id", text("id DESC")),
+        Index("ix_notes_user_date", "user_id", text("date DESC"), text("id DESC")),
+    )
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     title: Mapped[str] = mapped_column(String(250), nullable=False)
-    content: Mapped[str] = Column(Text, nullable=False)
-    date: Mapped[str] = mapped_column(String(250), nullable=False)
+    # 本文は数MBになり得るため遅延ロード(deferred)にし、一覧表示などで不要に読み込まないようにする
+    content: Mapped[str] = mapped_column(Text, nullable=False, deferred=True)
+    # 本文の先頭部分。with_expression()で指定した問い合わせでのみ読み込まれる(管理画面の一覧で使用、それ以外はNone)
+    content_head: Mapped[Optional[str]] = query_expression()
+    # 作成日(以前は文字列で保存していたもの。既存のデータベースはマイグレーション 0002_note_date で変換する)
+    date: Mapped[date_type] = mapped_column(Date, nullable=False, default=date_type.today)
     
     # usersテーブルのidを外部キーとして設定
     user_id: Mapped[int] = mapped_column(Integer, ForeignKey("users.id"))
     
     # UserとNoteのリレーションシップを定義
     user = relationship("User", back_populates="notes")
+
+    # 更新のたびに増えるリビジョン番号(ETagと、同時に編集された場合の上書き防止に使用)
+    # version_id_colに指定することで、SQLAlchemyがUPDATEのたびに値を増やし、
+    # 読み込んだ時点から他で更新されていた場合はStaleDataErrorになる
+    revision: Mapped[int] = mapped_column(Integer, nullable=False, default=1, server_default="1")
+    __mapper_args__ = {"version_id_col": revision}
+
+
+class SearchOutbox(db.Model):
+    """
+    検索インデックス(Elasticsearch)へ反映待ちのメモの変更を格納するアウトボックス
+    メモの変更と同じトランザクションで書き込まれ、バックグラウンドの送信処理がまとめてElasticsearchへ反映する
+    """
+    __tablename__ = "search_outbox"
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    note_id: Mapped[int] = mapped_column(Integer, nullable=False, index=True)
+    # メモの所有者(反映後にユーザーの候補のキャッシュを参照されなくするために使用。列の追加前に書き込まれた行はNone)
+    user_id: Mapped[Optional[int]] = mapped_column(Integer)
+    # 'index'(作成・更新) または 'delete'(削除)
+    operation: Mapped[str] = mapped_column(String(16), nullable=False)
+    # 送信の試行回数と、次に送信を試みてよい時刻(リトライ時のバックオフに使用)
+    attempts: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    available_at: Mapped[datetime] = mapped_column(DateTime, nullable=False, default=utcnow, index=True)
+    last_error: Mapped[Optional[str]] = mapped_column(Text)
+
+
+class UserFile(db.Model):
+    """
+    ユーザーがアップロードしたファイルの情報を格納するデータベースモデル
+    ファイル一覧の表示はディレクトリを走査せず、このテーブルへのインデックス付きの問い合わせで行う
+    """
+    __tablename__ = "files"
+    __table_args__ = (
+        UniqueConstraint("user_id", "filename", name="uq_files_user_filename"),
+        Index("ix_files_user_modified", "user_id", "modified_at", "id"),
+        Index("ix_files_user_size", "user_id", "size", "id"),
+    )
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    user_id: Mapped[int] = mapped_column(Integer, ForeignKey("users.id"), nullable=False)
+    filename: Mapped[str] = mapped_column(String(255), nullable=False)
+    size: Mapped[int] = mapped_column(BigInteger, nullable=False)
+    # アップロード日時(UTC)
+    modified_at: Mapped[datetime] = mapped_column(DateTime, nullable=False, default=utcnow)
+    # 内容のハッシュ(UPLOAD_FOLDER/.objects に保存された実体の名前)。ディレクトリに直接置かれたファイルはNone
+    digest: Mapped[Optional[str]] = mapped_column(String(64))
+
+
+class UserStorage(db.Model):
+    """ユーザーごとのファイル数と使用容量の合計(ファイルの追加・削除のたびに差分で更新する)"""
+    __tablename__ = "user_storage"
+    user_id: Mapped[int] = mapped_column(Integer, ForeignKey("users.id"), primary_key=True)
+    file_count: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    total_bytes: Mapped[int] = mapped_column(BigInteger, nullable=False, default=0)
+
+
+class SchemaMigration(db.Model):
+    """適用済みのデータベースの変更(migrations.py)を記録するテーブル"""
+    __tablename__ = "schema_migrations"
+    version: Mapped[str] = mapped_column(String(64), primary_key=True)
+    applied_at: Mapped[datetime] = mapped_column(DateTime, nullable=False, default=utcnow)
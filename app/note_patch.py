@@ -0,0 +1,49 @@
+"""
+メモの本文に差分(パッチ)を適用するモジュール。
+自動保存などで本文全体を送信せずに済むよう、ブラウザは編集前(ベースのリビジョン)の本文に対する置き換え操作のみを送る。
+
+操作は {"start": 開始位置, "end": 終了位置, "text": 置き換える文字列} のリストで、位置はブラウザのJavaScriptの文字列と同じ
+UTF-16のコード単位で数える(絵文字などは2単位)。改行は "\\n" にそろえた本文に対する位置とする
+(フォーム送信で保存した本文は "\\r\\n" を含むが、テキストエリアの値は "\\n" のため)。
+"""
+
+
+class PatchError(ValueError):
+    """パッチを適用できない(位置が範囲外、操作が重なっている、適用結果が想定と異なるなど)"""
+
+
+def normalize_newlines(text):
+    """改行を "\\n" にそろえる"""
+    return text.replace('\r\n', '\n')
+
+
+def apply_patch(text, ops, expected_length=None):
+    """
+    本文に置き換え操作を適用した結果を返す
+    操作は開始位置の昇順で、互いに重ならないこと。expected_lengthを指定した場合は適用後の長さ(UTF-16のコード単位)を確認する
+    """
+    data = text.encode('utf-16-le', 'surrogatepass')
+    length = len(data) // 2
+    parts = []
+    position = 0
+    for op in ops:
+        try:
+            start, end, replacement = int(op['start']), int(op['end']), op.get('text', '')
+        except (KeyError, TypeError, ValueError):
+            raise PatchError('invalid operation')
+        if not isinstance(replacement, str):
+            raise PatchError('invalid operation text')
+        if not position <= start <= end <= length:
+            raise PatchError('operation out of range or overlapping')
+        parts.append(data[position * 2:start * 2])
+        parts.append(replacement.encode('utf-16-le', 'surrogatepass'))
+        position = end
+    parts.append(data[position * 2:])
+    result = b''.join(parts)
+    if expected_length is not None and len(result) // 2 != expected_length:
+        raise PatchError('length mismatch')
+    try:
+        # サロゲートペアの途中で分割された場合はエラーにする
+        return result.decode('utf-16-le')
+    except UnicodeDecodeError:
+        raise PatchError('operation splits a character')
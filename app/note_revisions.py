@@ -0,0 +1,83 @@
+"""
+メモのリビジョン番号を使った条件付きGET(ETag / If-None-Match)を扱うモジュール。
+メモの作成・更新・削除のたびに、メモのリビジョン番号(Note.revision)とユーザーのメモ一覧のリビジョン番号(User.notes_revision)が増える。
+画面のETagをこの番号から作成し、ブラウザが持っているものと同じであれば本文の読み込みやMarkdownの変換を行わずに304を返す。
+"""
+
+# os, hashlib: テンプレートと静的ファイルの内容からアプリケーションのバージョンを計算するために使用
+import os
+import hashlib
+
+from flask import current_app, make_response, request, session
+from sqlalchemy import event, update
+from sqlalchemy.orm import Session
+
+from .models import Note, User
+
+# テンプレートや変換の設定が変わった場合に、以前のETagを使わないようにするための値(init_appで計算)
+_app_version = ''
+
+
+@event.listens_for(Session, "after_flush")
+def _bump_notes_revision(session, flush_context):
+    """メモが作成・更新・削除された場合に、そのユーザーのメモ一覧のリビジョン番号を増やす"""
+    user_ids = set()
+    for obj in session.new:
+        if isinstance(obj, Note):
+            user_ids.add(obj.user_id)
+    for obj in session.dirty:
+        if isinstance(obj, Note) and session.is_modified(obj, include_collections=False):
+            user_ids.add(obj.user_id)
+    for obj in session.deleted:
+        if isinstance(obj, Note):
+            user_ids.add(obj.user_id)
+    user_ids.discard(None)
+    if user_ids:
+        session.connection().execute(
+            update(User).where(User.id.in_(user_ids)).values(notes_revision=User.notes_revision + 1)
+        )
+
+
+def _compute_app_version(app):
+    """テンプレート・静的ファイル・Markdown変換の設定から、アプリケーションのバージョンを表す値を計算する"""
+    from . import assets, markdown_render
+
+    h = hashlib.sha1(markdown_render.RENDER_VERSION.encode())
+    template_folder = os.path.join(app.root_path, app.template_folder)
+    for dirpath, dirnames, filenames in os.walk(template_folder):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            with open(os.path.join(dirpath, filename), 'rb') as fh:
+                h.update(fh.read())
+    for name, hashed in sorted(assets.load_manifest(app.blueprints['views'].static_folder).items()):
+        h.update(f"{name}={hashed}".encode())
+    return h.hexdigest()[:12]
+
+
+def make_etag(*parts):
+    """ETagの値を作成する(アプリケーションのバージョンを含める)"""
+    return '-'.join(str(part) for part in parts + (_app_version,))
+
+
+def conditional_page(etag, render):
+    """
+    ブラウザのIf-None-MatchがETagと一致すれば304を返し、一致しなければrender()の結果にETagを付けて返す
+    flashメッセージの表示待ちがある場合は画面の内容が変わるため、ETagを使わずに表示する
+    """
+    if '_flashes' in session:
+        return render()
+    if request.if_none_match.contains(etag):
+        response = current_app.response_class(status=304)
+    else:
+        response = make_response(render())
+    response.set_etag(etag)
+    # ログインしたユーザー本人の画面のため共有キャッシュには保存させず、表示のたびにETagで確認させる
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+def init_app(app):
+    """ETagに含めるアプリケーションのバージョンを計算する"""
+    global _app_version
+    _app_version = _compute_app_version(app)
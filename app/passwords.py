@@ -0,0 +1,90 @@
+"""
+パスワードのハッシュ化と照合を行うモジュール。
+PBKDF2などのハッシュ計算は1回で数百ミリ秒かかるため、リクエストを処理するスレッドで直接行うと、
+ログインが集中した時にuwsgiのスレッドがすべてハッシュ計算で埋まり、メモの表示などの通常のリクエストまで止まってしまう。
+
+そのため、ハッシュ計算はワーカープロセスごとの専用のスレッドプール(PASSWORD_HASH_WORKERS)で行い、
+実行中・待機中の件数が PASSWORD_HASH_QUEUE_LIMIT を超える場合は待たずに PasswordHashBusy を送出して503を返す。
+(hashlibのPBKDF2・scryptは計算中にGILを解放するため、スレッドでも他のリクエストの処理は止まらない)
+
+ハッシュの方式とコストは PASSWORD_HASH_METHOD / PASSWORD_SALT_LENGTH に統一し、
+異なる方式で保存されているハッシュはログインに成功した時に作り直す(needs_upgrade)。
+"""
+
+# os, threading: ワーカープロセスごとのスレッドプールの作成と、実行中の件数の管理に使用
+import os
+import threading
+
+# ThreadPoolExecutor: ハッシュ計算を専用のスレッドで行うために使用
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+from flask import current_app
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+class PasswordHashBusy(Exception):
+    """ハッシュ計算の待ちが上限を超えている(503を返す)"""
+
+
+_lock = threading.Lock()
+_pool = None
+_pool_pid = None
+_slots = None
+_method_prefix = None
+
+
+def _get_pool(config):
+    """このプロセスのスレッドプールを返す(uwsgiのフォーク後に最初に使用する時に作成)"""
+    global _pool, _pool_pid, _slots
+    pid = os.getpid()
+    with _lock:
+        if _pool_pid != pid or _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=config['PASSWORD_HASH_WORKERS'], thread_name_prefix='password-hash')
+            _slots = threading.BoundedSemaphore(config['PASSWORD_HASH_QUEUE_LIMIT'])
+            _pool_pid = pid
+        return _pool, _slots
+
+
+def _run(func, *args):
+    """ハッシュ計算をスレッドプールで実行し、結果を待つ。待ちが上限を超えている場合はPasswordHashBusy"""
+    config = current_app.config
+    pool, slots = _get_pool(config)
+    if not slots.acquire(blocking=False):
+        raise PasswordHashBusy()
+    try:
+        future = pool.submit(func, *args)
+    except Exception:
+        slots.release()
+        raise
+    future.add_done_callback(lambda _: slots.release())
+    try:
+        return future.result(timeout=config['PASSWORD_HASH_TIMEOUT'])
+    except FutureTimeoutError:
+        future.cancel()
+        raise PasswordHashBusy()
+
+
+def hash_password(password):
+    """設定された方式でパスワードをハッシュ化する"""
+    config = current_app.config
+    return _run(generate_password_hash, password, config['PASSWORD_HASH_METHOD'], config['PASSWORD_SALT_LENGTH'])
+
+
+def verify_password(password_hash, password):
+    """パスワードがハッシュと一致するかを確認する"""
+    return _run(check_password_hash, password_hash, password)
+
+
+def needs_upgrade(password_hash):
+    """ハッシュの方式・コスト・ソルトの長さが設定と異なるか(ログインに成功した時に作り直す)"""
+    global _method_prefix
+    config = current_app.config
+    if _method_prefix is None:
+        # 'pbkdf2:sha256' のように省略された設定を、保存される形式('pbkdf2:sha256:600000')にそろえる
+        # 空のパスワードで1回だけハッシュ化して確認する(起動時ではなく最初のログイン時に行う)
+        _method_prefix = _run(generate_password_hash, '', config['PASSWORD_HASH_METHOD'], 1).split('$', 1)[0]
+    method, _, rest = password_hash.partition('$')
+    salt = rest.partition('$')[0]
+    return method != _method_prefix or len(salt) != config['PASSWORD_SALT_LENGTH']
+
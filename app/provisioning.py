@@ -0,0 +1,49 @@
+"""
+デプロイ時に1回だけ行う準備(プロビジョニング)をまとめたモジュール。
+テーブルの作成とマイグレーション、検索インデックスの作成、静的ファイルのハッシュ付きのコピーの作成を行う。
+以前はcreate_app()の中で行っていたが、uwsgiのワーカーを起動するたびにデータベースやElasticsearchへ問い合わせることになり、
+Elasticsearchが停止していると接続のタイムアウトまで起動が止まるため、`flask provision` として分離した。
+"""
+
+# time: 各処理にかかった時間の計測に使用
+import time
+
+from .models import db
+
+
+def provision(app, progress=print, search=True, assets=True):
+    """
+    テーブル・検索インデックス・静的ファイルを準備し、処理ごとの時間(秒)を返す
+    検索インデックスの作成に失敗した場合は表示だけを行い、データベースの準備は完了させる
+    """
+    from . import migrations
+
+    timings = {}
+
+    start = time.perf_counter()
+    # データベーステーブルを作成し、既存のテーブルへの変更(列の追加など)を適用
+    db.create_all()
+    migrations.upgrade(progress=progress)
+    timings['database'] = time.perf_counter() - start
+
+    if search:
+        # 検索用のインデックス(Elasticsearchのインデックスとエイリアス、データベースの全文検索インデックス)がなければ作成
+        # Elasticsearchのマッピング変更時などの再構築は `flask search reindex` で行う
+        start = time.perf_counter()
+        try:
+            if app.extensions['search_backend'].ensure_schema():
+                progress(f"Search index for '{app.extensions['search_backend'].name}' created.")
+        except Exception as e:
+            progress(f"Error creating search index: {e}")
+        timings['search'] = time.perf_counter() - start
+
+    if assets:
+        from .assets import build
+        start = time.perf_counter()
+        try:
+            build(app.blueprints['views'].static_folder)
+        except OSError as e:
+            progress(f"Static asset build failed: {e}")
+        timings['assets'] = time.perf_counter() - start
+
+    return timings
@@ -0,0 +1,466 @@
+"""
+メモの全文検索を行うサービス。
+ホーム画面(home)と非同期検索(search_notes_async)の両方から使用する。
+
+検索の実装(バックエンド)は差し替え可能で、SEARCH_BACKEND設定で選択する。
+- ElasticsearchBackend: Elasticsearchへの1回の問い合わせで一覧表示に必要な項目とハイライト済みのプレビューを取得する
+  (メモの変更はアウトボックス経由で反映)
+- PostgresSearchBackend: tsvectorの式に対するGINインデックスを使用する(インデックスはPostgreSQLが書き込み時に自動で更新)
+- SQLiteSearchBackend: FTS5の仮想テーブルを使用する(トリガーで書き込み時に自動で更新)
+Elasticsearchが停止している場合は、データベースのバックエンドに切り替えて検索を続けることができる。
+いずれのバックエンドもページ送りは(date, id)のカーソルで行い、作成日の範囲(date_from, date_to)で絞り込める。
+"""
+
+# json, base64: search_afterの値をURLに載せられるカーソル文字列に変換するために使用
+import json
+import base64
+
+# re: PostgreSQLのテキスト検索設定名の検証に使用
+import re
+
+# date: 作成日の範囲の指定とカーソルの日付の変換に使用
+from datetime import date
+
+# Markup: Elasticsearch側でHTMLエスケープ済みのハイライトを、テンプレートで再エスケープしないために使用
+# escape: データベースから取得したスニペットをHTMLエスケープするために使用
+from markupsafe import Markup, escape
+
+from flask import current_app
+from sqlalchemy import func, text, tuple_, or_, table, column
+
+from .models import db, Note
+
+# 検索結果のハイライトに使用するタグ
+HIGHLIGHT_PRE_TAG = '<mark>'
+HIGHLIGHT_POST_TAG = '</mark>'
+# ハイライト対象とする本文の最大文字数(これを超える巨大なメモでも検索がエラーにならないようにする)
+HIGHLIGHT_MAX_ANALYZED_OFFSET = 1000000
+
+# SQLiteのFTS5仮想テーブル(notes_fts列はMATCHやsnippetに使用する隠し列)
+_notes_fts = table('notes_fts', column('rowid'), column('notes_fts'))
+
+
+def encode_cursor(sort_values):
+    """search_afterの値をURLセーフな文字列に変換"""
+    raw = json.dumps(sort_values, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """encode_cursorで作成した文字列をsearch_afterの値に戻す。不正な値の場合はNone"""
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(raw)
+    except (ValueError, TypeError):
+        return None
+    return values if isinstance(values, list) else None
+
+
+def parse_date(value):
+    """'YYYY-MM-DD' 形式の文字列をdateに変換する。空や不正な値の場合はNone"""
+    if not value:
+        return None
+    try:
+        return date.fromisoformat(value)
+    except (ValueError, TypeError):
+        return None
+
+
+def date_range_condition(date_from, date_to):
+    """作成日の範囲で絞り込む条件のリスト((user_id, date)のインデックスを使用できる)"""
+    conditions = []
+    if date_from:
+        conditions.append(Note.date >= date_from)
+    if date_to:
+        conditions.append(Note.date <= date_to)
+    return conditions
+
+
+def make_preview(text, length):
+    """本文の先頭部分からプレビュー文字列を作成"""
+    return (text[:length] + "...") if len(text) > length else text
+
+
+def note_summary_columns(preview_length):
+    """
+    一覧表示用のメモの要約(id, title, date, 本文の先頭部分)の列
+    本文全体は読み込まず、SQLのsubstrで先頭部分だけを取得する
+    「...」を付けるか判定するため、プレビュー文字数+1文字分を取得する
+    """
+    return (
+        Note.id, Note.title, Note.date,
+        func.substr(Note.content, 1, preview_length + 1).label('content_head'),
+    )
+
+
+def note_summary(row, preview_length):
+    """note_summary_columnsで取得した行を一覧表示用の辞書に変換"""
+    return {
+        'id': row.id,
+        'title': row.title,
+        'date': row.date.isoformat(),
+        'content_preview': make_preview(row.content_head, preview_length),
+    }
+
+
+class SearchBackend:
+    """
+    検索バックエンドの基底クラス
+    search()はメモを検索し、(一覧表示用の辞書のリスト, 次ページのカーソル)を返す。次ページがない場合カーソルはNone
+    """
+    name = None
+    # メモの変更をアウトボックス経由で反映する必要があるか(データベースのバックエンドは書き込み時に自動で反映される)
+    uses_outbox = False
+
+    def __init__(self, preview_length):
+        self.preview_length = preview_length
+
+    def ensure_schema(self):
+        """検索に必要なテーブルやインデックスを作成する(既に存在する場合は何もしない)"""
+
+    def search(self, user_id, query, size, cursor=None, date_from=None, date_to=None):
+        raise NotImplementedError
+
+    def suggest(self, user_id, prefix, size):
+        """タイトルが入力で始まるメモの候補([{'id', 'title'}])を返す(入力中の候補表示用)"""
+        raise NotImplementedError
+
+
+class ElasticsearchBackend(SearchBackend):
+    """Elasticsearchを使用した検索バックエンド"""
+    name = 'elasticsearch'
+    uses_outbox = True
+
+    def __init__(self, get_client, index_name, preview_length):
+        super().__init__(preview_length)
+        # クライアントは最初に検索する時に作成する(起動時にelasticsearchパッケージを読み込まない)
+        self._get_client = get_client
+        self.index_name = index_name
+
+    @property
+    def es(self):
+        return self._get_client()
+
+    def ensure_schema(self):
+        from .search_index import ensure_index, index_version, NOTE_INDEX_VERSION
+        created = ensure_index(self.es, self.index_name)
+        version = index_version(self.es, self.index_name)
+        if version is not None and version < NOTE_INDEX_VERSION:
+            # 古いマッピングのインデックスでも検索はできるが、日本語の検索や前方一致の精度が低いため再構築を促す
+            current_app.logger.warning(
+                f"Elasticsearch index '{self.index_name}' uses mapping version {version} (current {NOTE_INDEX_VERSION}). "
+                f"Run `flask search reindex` to rebuild it."
+            )
+        return created
+
+    def build_body(self, user_id, query, size, search_after=None, date_from=None, date_to=None):
+        """メモ検索のリクエストボディを作成"""
+        filters = [{"term": {"user_id": user_id}}]
+        if date_from or date_to:
+            date_range = {}
+            if date_from:
+                date_range["gte"] = date_from.isoformat()
+            if date_to:
+                date_range["lte"] = date_to.isoformat()
+            filters.append({"range": {"date": date_range}})
+        if query:
+            # あいまい検索(fuzziness)は語の展開に時間がかかり、日本語ではほとんど効果がないため使用しない
+            # 検索語のすべての語(bigram)をタイトルか本文に含むもの、またはタイトルが検索語で始まる(edge n-gram)ものを検索する
+            search_query = {
+                "bool": {
+                    "filter": filters,
+                    "should": [
+                        {"multi_match": {"query": query, "fields": ["title", "content"], "type": "cross_fields", "operator": "and"}},
+                        {"match": {"title.prefix": {"query": query, "operator": "and"}}},
+                    ],
+                    "minimum_should_match": 1
+                }
+            }
+        else:
+            search_query = {"bool": {"filter": filters}}
+
+        body = {
+            "query": search_query,
+            # 一覧表示に必要な項目のみを返させ、本文全体(_source.content)は転送しない
+            "_source": ["id", "title", "date"],
+            # 日付の新しい順。同じ日付のメモはIDの降順で並べ、search_afterのページ送りを安定させる
+            "sort": [{"date": {"order": "desc"}}, {"id": {"order": "desc"}}],
+            "size": size,
+            "track_total_hits": False,
+            # 本文のプレビューはElasticsearch側で作成させる。一致箇所がない場合は先頭部分を返す
+            "highlight": {
+                "encoder": "html",
+                "pre_tags": [HIGHLIGHT_PRE_TAG],
+                "post_tags": [HIGHLIGHT_POST_TAG],
+                "max_analyzed_offset": HIGHLIGHT_MAX_ANALYZED_OFFSET,
+                "fields": {
+                    "content": {
+                        "fragment_size": self.preview_length,
+                        "number_of_fragments": 1,
+                        "no_match_size": self.preview_length,
+                    }
+                }
+            }
+        }
+        if search_after:
+            body["search_after"] = search_after
+        return body
+
+    def search(self, user_id, query, size, cursor=None, date_from=None, date_to=None):
+        # 次ページの有無を判定するために1件多く取得する
+        body = self.build_body(user_id, query, size + 1, decode_cursor(cursor), date_from, date_to)
+        return self.parse_search_response(self.es.search(index=self.index_name, body=body), size)
+
+    def parse_search_response(self, res, size):
+        """build_body(size + 1件)で検索した結果を、(一覧表示用の辞書のリスト, 次ページのカーソル)に変換"""
+        hits = res['hits']['hits']
+
+        notes = []
+        for hit in hits[:size]:
+            source = hit['_source']
+            fragments = hit.get('highlight', {}).get('content', [])
+            notes.append({
+                'id': source['id'],
+                'title': source['title'],
+                'date': source['date'],
+                'content_preview': Markup(fragments[0]) if fragments else '',
+            })
+
+        next_cursor = encode_cursor(hits[size - 1]['sort']) if len(hits) > size else None
+        return notes, next_cursor
+
+    def build_suggest_body(self, user_id, prefix, size):
+        """入力中の候補の検索のリクエストボディを作成"""
+        # 前方一致用のtitle.prefix(edge n-gram)のみを検索し、idとタイトルだけを返させる
+        return {
+            "query": {
+                "bool": {
+                    "filter": [{"term": {"user_id": user_id}}],
+                    "must": [{"match": {"title.prefix": {"query": prefix, "operator": "and"}}}],
+                }
+            },
+            "_source": ["id", "title"],
+            "sort": ["_score", {"date": {"order": "desc"}}, {"id": {"order": "desc"}}],
+            "size": size,
+            "track_total_hits": False,
+        }
+
+    @staticmethod
+    def parse_suggest_response(res):
+        return [{'id': hit['_source']['id'], 'title': hit['_source']['title']} for hit in res['hits']['hits']]
+
+    def suggest(self, user_id, prefix, size):
+        res = self.es.search(index=self.index_name, body=self.build_suggest_body(user_id, prefix, size))
+        return self.parse_suggest_response(res)
+
+
+class DatabaseSearchBackend(SearchBackend):
+    """データベースの全文検索機能を使用するバックエンドの共通処理"""
+
+    def _match_condition(self, query):
+        """検索語に一致するメモを絞り込む条件"""
+        raise NotImplementedError
+
+    def _preview(self, row):
+        return note_summary(row, self.preview_length)
+
+    def _extra_columns(self, query):
+        return ()
+
+    def search(self, user_id, query, size, cursor=None, date_from=None, date_to=None):
+        stmt = db.select(*note_summary_columns(self.preview_length), *self._extra_columns(query)).where(
+            Note.user_id == user_id, *date_range_condition(date_from, date_to),
+        )
+        if query:
+            stmt = stmt.where(self._match_condition(query))
+
+        # カーソルは(date, id)。Elasticsearchのカーソル(日付が数値)が渡された場合は先頭から表示する
+        after = decode_cursor(cursor)
+        if after and len(after) == 2 and isinstance(after[1], int) and parse_date(after[0]):
+            stmt = stmt.where(tuple_(Note.date, Note.id) < tuple_(parse_date(after[0]), after[1]))
+
+        # 次ページの有無を判定するために1件多く取得する
+        rows = db.session.execute(stmt.order_by(Note.date.desc(), Note.id.desc()).limit(size + 1)).all()
+        notes = [self._preview(row) for row in rows[:size]]
+        next_cursor = None
+        if len(rows) > size:
+            last = rows[size - 1]
+            next_cursor = encode_cursor([last.date.isoformat(), last.id])
+        return notes, next_cursor
+
+    def suggest(self, user_id, prefix, size):
+        escaped = prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        rows = db.session.execute(
+            db.select(Note.id, Note.title)
+            .where(Note.user_id == user_id, Note.title.ilike(f"{escaped}%", escape='\\'))
+            .order_by(Note.id.desc())
+            .limit(size)
+        ).all()
+        return [{'id': row.id, 'title': row.title} for row in rows]
+
+
+class PostgresSearchBackend(DatabaseSearchBackend):
+    """
+    PostgreSQLの全文検索(tsvector)を使用した検索バックエンド
+    to_tsvector(title || ' ' || content)の式に対するGINインデックスを使用し、インデックスはメモの書き込み時にPostgreSQLが更新する
+    """
+    name = 'postgresql'
+    INDEX_NAME = 'ix_notes_fulltext'
+
+    def __init__(self, preview_length, ts_config='simple'):
+        super().__init__(preview_length)
+        # テキスト検索設定名はSQLに埋め込むため、識別子として安全な文字のみ許可する
+        if not re.fullmatch(r'[a-z_][a-z0-9_]*', ts_config):
+            raise ValueError(f"Invalid text search configuration: {ts_config}")
+        self.ts_config = ts_config
+        # GINインデックスの式と検索時の式は完全に一致している必要がある
+        self.document_sql = f"to_tsvector('{ts_config}'::regconfig, coalesce(title, '') || ' ' || coalesce(content, ''))"
+
+    def ensure_schema(self):
+        # 書き込みを止めないようCONCURRENTLYで作成する(トランザクション外で実行する必要がある)
+        with db.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            conn.execute(text(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {self.INDEX_NAME} ON notes USING gin (({self.document_sql}))"))
+
+    def _match_condition(self, query):
+        return text(f"{self.document_sql} @@ websearch_to_tsquery('{self.ts_config}'::regconfig, :fulltext_query)").bindparams(fulltext_query=query)
+
+
+class SQLiteSearchBackend(DatabaseSearchBackend):
+    """
+    SQLiteのFTS5を使用した検索バックエンド
+    notesテーブルを参照する外部コンテンツ型の仮想テーブルをトリガーで同期する
+    トークナイザーにはtrigramを使用し、日本語のように単語の区切りがない文章でも部分一致で検索できるようにする
+    """
+    name = 'sqlite'
+    # スニペットの一致箇所を示す一時的な記号(HTMLエスケープ後に<mark>タグへ置き換える)
+    _SNIPPET_START = '\x02'
+    _SNIPPET_END = '\x03'
+
+    SCHEMA = [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS notes_fts USING fts5(title, content, content='notes', content_rowid='id', tokenize='trigram')",
+        """CREATE TRIGGER IF NOT EXISTS notes_fts_ai AFTER INSERT ON notes BEGIN
+            INSERT INTO notes_fts(rowid, title, content) VALUES (new.id, new.title, new.content);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS notes_fts_ad AFTER DELETE ON notes BEGIN
+            INSERT INTO notes_fts(notes_fts, rowid, title, content) VALUES ('delete', old.id, old.title, old.content);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS notes_fts_au AFTER UPDATE OF title, content ON notes BEGIN
+            INSERT INTO notes_fts(notes_fts, rowid, title, content) VALUES ('delete', old.id, old.title, old.content);
+            INSERT INTO notes_fts(rowid, title, content) VALUES (new.id, new.title, new.content);
+        END""",
+    ]
+
+    def ensure_schema(self):
+        with db.engine.begin() as conn:
+            exists = conn.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'notes_fts'")).first()
+            for statement in self.SCHEMA:
+                conn.execute(text(statement))
+            if not exists:
+                # 既存のメモを取り込む
+                conn.execute(text("INSERT INTO notes_fts(notes_fts) VALUES ('rebuild')"))
+
+    def _is_fulltext_query(self, query):
+        # trigramトークナイザーは3文字未満の語では検索できない
+        return len(query) >= 3
+
+    @staticmethod
+    def _fts_match(query):
+        """入力をフレーズとして扱い、FTS5のクエリ構文として解釈させない検索条件"""
+        phrase = '"' + query.replace('"', '""') + '"'
+        return _notes_fts.c.notes_fts.op('MATCH')(phrase)
+
+    def _match_condition(self, query):
+        if self._is_fulltext_query(query):
+            return Note.id.in_(db.select(_notes_fts.c.rowid).where(self._fts_match(query)))
+        return or_(func.instr(Note.title, query) > 0, func.instr(Note.content, query) > 0)
+
+    def _extra_columns(self, query):
+        if not query or not self._is_fulltext_query(query):
+            return ()
+        # 一致箇所を含む本文の一部をスニペットとして取得する
+        snippet = db.select(
+            func.snippet(_notes_fts.c.notes_fts, 1, self._SNIPPET_START, self._SNIPPET_END, '...', min(self.preview_length, 64))
+        ).where(self._fts_match(query), _notes_fts.c.rowid == Note.id).scalar_subquery()
+        return (snippet.label('snippet'),)
+
+    def _preview(self, row):
+        summary = super()._preview(row)
+        snippet = getattr(row, 'snippet', None)
+        if snippet:
+            escaped = str(escape(snippet))
+            summary['content_preview'] = Markup(
+                escaped.replace(self._SNIPPET_START, HIGHLIGHT_PRE_TAG).replace(self._SNIPPET_END, HIGHLIGHT_POST_TAG)
+            )
+        return summary
+
+
+class FallbackSearchBackend(SearchBackend):
+    """主バックエンド(Elasticsearch)で検索できない場合に、代替バックエンド(データベース)で検索する"""
+
+    def __init__(self, primary, fallback):
+        super().__init__(primary.preview_length)
+        self.primary = primary
+        self.fallback = fallback
+        self.name = primary.name
+        self.uses_outbox = primary.uses_outbox
+
+    def ensure_schema(self):
+        self.primary.ensure_schema()
+        self.fallback.ensure_schema()
+
+    def search(self, user_id, query, size, cursor=None, date_from=None, date_to=None):
+        try:
+            return self.primary.search(user_id, query, size, cursor, date_from, date_to)
+        except Exception as e:
+            current_app.logger.warning(f"{self.primary.name} search failed, falling back to {self.fallback.name}: {e}")
+            return self.fallback.search(user_id, query, size, cursor, date_from, date_to)
+
+    def suggest(self, user_id, prefix, size):
+        try:
+            return self.primary.suggest(user_id, prefix, size)
+        except Exception as e:
+            current_app.logger.warning(f"{self.primary.name} suggest failed, falling back to {self.fallback.name}: {e}")
+            return self.fallback.suggest(user_id, prefix, size)
+
+
+def create_database_backend(app, dialect):
+    """データベースの種類に応じた検索バックエンドを作成。対応していない場合はNone"""
+    preview_length = app.config['NOTE_PREVIEW_LENGTH']
+    if dialect == 'postgresql':
+        return PostgresSearchBackend(preview_length, app.config['SEARCH_POSTGRES_TS_CONFIG'])
+    if dialect == 'sqlite':
+        return SQLiteSearchBackend(preview_length)
+    return None
+
+
+def init_app(app, get_es):
+    """
+    SEARCH_BACKEND設定に応じて検索バックエンドを作成し、アプリケーションに登録する
+    'auto'の場合はElasticsearchが設定されていればElasticsearch、なければデータベースを使用する
+    get_es はElasticsearchクライアントを返す関数(接続はせず、最初の検索時に呼び出される)
+    """
+    es_configured = bool(app.config['ELASTICSEARCH_HOST'])
+    setting = app.config['SEARCH_BACKEND']
+    dialect = db.engine.dialect.name
+    database_backend = create_database_backend(app, dialect)
+
+    if setting == 'database' or (setting == 'auto' and not es_configured):
+        if database_backend is None:
+            raise RuntimeError(f"Full-text search is not supported for database '{dialect}'")
+        backend = database_backend
+    else:
+        if not es_configured:
+            raise RuntimeError("SEARCH_BACKEND is 'elasticsearch' but ELASTICSEARCH_HOST is not set")
+        backend = ElasticsearchBackend(get_es, app.config['ELASTICSEARCH_INDEX'], app.config['NOTE_PREVIEW_LENGTH'])
+        if app.config['SEARCH_FALLBACK_TO_DATABASE'] and database_backend is not None:
+            backend = FallbackSearchBackend(backend, database_backend)
+
+    app.extensions['search_backend'] = backend
+    return backend
+
+
+def get_backend():
+    """現在のアプリケーションの検索バックエンドを取得"""
+    return current_app.extensions['search_backend']
@@ -0,0 +1,262 @@
+"""
+Elasticsearchのインデックス管理を行うモジュール。
+メモのインデックスはバージョン付きの実インデックス(例: forgegrid_notes_index_v20240101120000)として作成し、
+アプリケーションはエイリアス(ELASTICSEARCH_INDEX)を通して読み書きする。
+再構築時は新しいインデックスへPostgreSQLの内容を流し込み、完了後にエイリアスを一括で切り替えるため、検索は停止しない。
+流し込み中に削除されたメモは、アウトボックスの送信処理がRedisに記録し、切り替えの前に新しいインデックスから削除する。
+"""
+
+# time: 再構築の進捗(docs/s)の計測に使用
+import time
+
+# ThreadPoolExecutor, wait: _bulkリクエストを複数スレッドで並列に送信するために使用
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import date, datetime
+
+from .models import db, Note
+
+# マッピング・アナライザーの版。変更した場合は値を増やし、`flask search reindex` で新しいインデックスに移行する
+NOTE_INDEX_VERSION = 2
+
+# メモのインデックスのアナライザー(Elasticsearch標準の機能のみを使用し、プラグインは不要)
+# - note_text: 全角・半角をそろえ、日本語などのCJK文字を2文字ずつ(bigram)に分割する。1文字の検索語でも一致するよう、登録時は1文字(unigram)も出力する
+# - note_prefix: タイトルの前方一致用に、単語の先頭から1〜20文字(edge n-gram)を登録する
+NOTE_INDEX_SETTINGS = {
+    "analysis": {
+        "filter": {
+            "note_bigram_index": {"type": "cjk_bigram", "output_unigrams": True},
+        },
+        "tokenizer": {
+            "note_edge_ngram": {"type": "edge_ngram", "min_gram": 1, "max_gram": 20, "token_chars": ["letter", "digit"]},
+        },
+        "analyzer": {
+            "note_text": {"type": "custom", "tokenizer": "standard", "filter": ["cjk_width", "lowercase", "note_bigram_index"]},
+            "note_text_search": {"type": "custom", "tokenizer": "standard", "filter": ["cjk_width", "lowercase", "cjk_bigram"]},
+            "note_prefix": {"type": "custom", "tokenizer": "note_edge_ngram", "filter": ["cjk_width", "lowercase"]},
+            "note_prefix_search": {"type": "custom", "tokenizer": "whitespace", "filter": ["cjk_width", "lowercase"]},
+        },
+    }
+}
+
+# メモのインデックスのマッピング
+NOTE_INDEX_MAPPING = {
+    "_meta": {"version": NOTE_INDEX_VERSION},
+    "properties": {
+        "id": {"type": "integer"},
+        "title": {
+            "type": "text", "analyzer": "note_text", "search_analyzer": "note_text_search",
+            "fields": {
+                "prefix": {"type": "text", "analyzer": "note_prefix", "search_analyzer": "note_prefix_search"},
+            },
+        },
+        "content": {"type": "text", "analyzer": "note_text", "search_analyzer": "note_text_search"},
+        "date": {"type": "date"},
+        "user_id": {"type": "integer"}
+    }
+}
+
+
+def note_document(note):
+    """Elasticsearchに登録するメモのドキュメントを作成(Noteオブジェクトでも列だけの行でもよい)"""
+    return {
+        'id': note.id,
+        'title': note.title,
+        'content': note.content,
+        'date': note.date.isoformat() if isinstance(note.date, date) else note.date, # 日付形式を適切に処理
+        'user_id': note.user_id
+    }
+
+
+def pending_alias_name(alias):
+    """再構築中の新しいインデックスを指すエイリアス名(アウトボックスの送信処理が二重書き込みに使用)"""
+    return f"{alias}_reindexing"
+
+
+def pending_deletes_key(alias):
+    """
+    再構築中に削除されたメモのIDを記録するRedisのキー(集合)
+    流し込み前のメモへの削除は新しいインデックスでは404になり、その後の流し込みで復活してしまうため、
+    アウトボックスの送信処理がここに記録し、再構築の最後に新しいインデックスから削除する
+    """
+    return f"{pending_alias_name(alias)}:deleted"
+
+
+def versioned_index_name(alias):
+    """エイリアスが指すバージョン付きインデックスの名前を作成"""
+    return f"{alias}_v{datetime.now().strftime('%Y%m%d%H%M%S')}"
+
+
+def write_targets(es_client, alias):
+    """メモの変更を書き込むべきインデックス(エイリアス)の一覧。再構築中は新しいインデックスにも書き込む"""
+    pending = pending_alias_name(alias)
+    if es_client.indices.exists_alias(name=pending):
+        return [alias, pending]
+    return [alias]
+
+
+def ensure_index(es_client, alias):
+    """
+    エイリアスもインデックスも存在しない場合に、バージョン付きインデックスとエイリアスを作成する
+    エイリアス導入前に作られた同名の実インデックスがある場合はそのまま使用する(再構築時に置き換わる)
+    """
+    if es_client.indices.exists(index=alias):
+        return False
+    index_name = versioned_index_name(alias)
+    es_client.indices.create(index=index_name, settings=NOTE_INDEX_SETTINGS, mappings=NOTE_INDEX_MAPPING, aliases={alias: {}})
+    return True
+
+
+def index_version(es_client, alias):
+    """エイリアスが指すインデックスのマッピングの版(版を記録する前に作成したインデックスは1)"""
+    mappings = es_client.indices.get_mapping(index=alias)
+    versions = [m['mappings'].get('_meta', {}).get('version', 1) for m in mappings.values()]
+    return min(versions) if versions else None
+
+
+def _current_indices(es_client, alias):
+    """
+    エイリアスが現在指しているインデックスの一覧と、エイリアス名の実インデックスが存在するかを返す
+    """
+    # 起動時にelasticsearchパッケージを読み込まないよう、使用する時にインポートする
+    from elasticsearch import NotFoundError
+
+    try:
+        return list(es_client.indices.get_alias(name=alias).keys()), False
+    except NotFoundError:
+        return [], bool(es_client.indices.exists(index=alias))
+
+
+def _bulk_create(es_client, index_name, docs):
+    """
+    1チャンク分のドキュメントを_bulkで登録し、(成功件数, エラー一覧)を返す
+    op_typeをcreateにすることで、再構築中にアウトボックス経由で書き込まれた新しい内容を古い内容で上書きしない
+    """
+    operations = []
+    for doc in docs:
+        operations.append({'create': {'_index': index_name, '_id': doc['id']}})
+        operations.append(doc)
+    res = es_client.bulk(operations=operations)
+    errors = []
+    for item in res['items']:
+        result = item['create']
+        # 409はアウトボックス経由ですでに新しい内容が書き込まれているため成功とみなす
+        if result.get('status', 500) >= 300 and result.get('status') != 409:
+            errors.append(result.get('error'))
+    return len(docs) - len(errors), errors
+
+
+def _apply_pending_deletes(es_client, redis_client, alias, index_name, chunk_size):
+    """流し込み中に削除されたメモを新しいインデックスから削除し、削除した件数を返す"""
+    note_ids = sorted(int(note_id) for note_id in redis_client.smembers(pending_deletes_key(alias)))
+    for start in range(0, len(note_ids), chunk_size):
+        operations = [{'delete': {'_index': index_name, '_id': note_id}} for note_id in note_ids[start:start + chunk_size]]
+        res = es_client.bulk(operations=operations)
+        # 流し込まれなかったメモ(404)は削除済みとみなす
+        errors = [item['delete'] for item in res['items'] if item['delete'].get('status', 500) >= 300 and item['delete'].get('status') != 404]
+        if errors:
+            raise RuntimeError(f"再構築中に削除されたメモを新しいインデックスから削除できませんでした: {errors[0].get('error')}")
+    return len(note_ids)
+
+
+def _iter_note_chunks(chunk_size, fetch_size):
+    """
+    メモをサーバーサイドカーソル(yield_per)で少しずつ読み込み、チャンクごとに返す
+    ORMオブジェクトではなく列だけを取得するため、セッションにオブジェクトが溜まらずメモリ使用量は一定に保たれる
+    """
+    result = db.session.execute(
+        db.select(Note.id, Note.title, Note.content, Note.date, Note.user_id)
+        .order_by(Note.id)
+        .execution_options(yield_per=fetch_size)
+    )
+    chunk = []
+    for row in result:
+        chunk.append(note_document(row))
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def reindex(es_client, alias, redis_client, workers=4, chunk_size=500, fetch_size=1000, keep_old=False, progress=print):
+    """
+    PostgreSQLの全メモを新しいバージョン付きインデックスへ流し込み、完了後にエイリアスを切り替える
+    再構築中のメモの変更は、アウトボックスの送信処理が新旧両方のインデックスへ書き込む
+    (削除されたメモは redis_client に記録され、切り替えの前に新しいインデックスから削除する)
+    作成したインデックス名を返す
+    """
+    new_index = versioned_index_name(alias)
+    pending = pending_alias_name(alias)
+    # 中断した以前の再構築の記録が残っていれば消しておく
+    redis_client.delete(pending_deletes_key(alias))
+
+    # 流し込みの間はリフレッシュとレプリカを止めて書き込みを高速化する
+    es_client.indices.create(index=new_index, settings=NOTE_INDEX_SETTINGS, mappings=NOTE_INDEX_MAPPING)
+    original_replicas = es_client.indices.get_settings(index=new_index)[new_index]['settings']['index'].get('number_of_replicas', '1')
+    es_client.indices.put_settings(index=new_index, settings={"index": {"refresh_interval": "-1", "number_of_replicas": 0}})
+    es_client.indices.update_aliases(actions=[{"add": {"index": new_index, "alias": pending}}])
+    progress(f"インデックス '{new_index}' を作成しました。メモの流し込みを開始します。")
+
+    started = time.monotonic()
+    last_report = started
+    indexed = 0
+    failed = 0
+
+    def collect(futures):
+        nonlocal indexed, failed
+        for future in futures:
+            ok, errors = future.result()
+            indexed += ok
+            failed += len(errors)
+            if errors:
+                progress(f"登録エラー: {errors[0]}")
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            in_flight = set()
+            for chunk in _iter_note_chunks(chunk_size, fetch_size):
+                # 送信待ちのチャンク数を制限し、読み込みが送信を追い越してメモリを使い切らないようにする
+                if len(in_flight) >= workers * 2:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    collect(done)
+                in_flight.add(pool.submit(_bulk_create, es_client, new_index, chunk))
+
+                now = time.monotonic()
+                if now - last_report >= 5:
+                    progress(f"{indexed} 件登録済み ({indexed / (now - started):.0f} docs/s)")
+                    last_report = now
+            collect(wait(in_flight).done)
+
+        elapsed = max(time.monotonic() - started, 1e-9)
+        progress(f"流し込み完了: {indexed} 件 / エラー {failed} 件 / {elapsed:.1f} 秒 ({indexed / elapsed:.0f} docs/s)")
+
+        # 流し込みより前に届いた削除を適用する(流し込みの完了後の削除は、送信処理が新しいインデックスから直接削除する)
+        deleted = _apply_pending_deletes(es_client, redis_client, alias, new_index, chunk_size)
+        if deleted:
+            progress(f"流し込み中に削除された {deleted} 件を新しいインデックスから削除しました。")
+    except BaseException:
+        # 途中で失敗した場合は作りかけのインデックスを削除し、既存のエイリアスには触れない
+        es_client.indices.delete(index=new_index, ignore_unavailable=True)
+        redis_client.delete(pending_deletes_key(alias))
+        raise
+
+    es_client.indices.put_settings(index=new_index, settings={"index": {"refresh_interval": None, "number_of_replicas": original_replicas}})
+    es_client.indices.refresh(index=new_index)
+
+    # エイリアスを一括で切り替える(切り替えの瞬間も検索は旧インデックスか新インデックスのどちらかに必ず届く)
+    old_indices, legacy_index = _current_indices(es_client, alias)
+    actions = [{"remove": {"index": new_index, "alias": pending}}]
+    if legacy_index:
+        # エイリアス導入前の同名の実インデックスは、エイリアスと名前が衝突するため切り替えと同時に削除する
+        actions.append({"remove_index": {"index": alias}})
+    actions += [{"remove": {"index": old, "alias": alias}} for old in old_indices]
+    actions.append({"add": {"index": new_index, "alias": alias}})
+    es_client.indices.update_aliases(actions=actions)
+    redis_client.delete(pending_deletes_key(alias))
+    progress(f"エイリアス '{alias}' を '{new_index}' に切り替えました。")
+
+    if not keep_old:
+        for old in old_indices:
+            es_client.indices.delete(index=old, ignore_unavailable=True)
+            progress(f"旧インデックス '{old}' を削除しました。")
+    return new_index
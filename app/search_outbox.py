@@ -0,0 +1,215 @@
+"""
+メモの変更をElasticsearchへ非同期に反映するためのトランザクショナル・アウトボックス。
+メモの作成・更新・削除と同じトランザクションでsearch_outboxテーブルへ行を書き込み、
+バックグラウンドの送信処理(ドレイナー)が_bulk APIでまとめてElasticsearchへ反映する。
+Elasticsearchが遅い・停止している場合でもメモの保存は待たされず、送信に失敗した変更はバックオフ付きで再送される。
+"""
+
+# os: フォーク後のプロセスでドレイナーを起動し直すため、プロセスIDの取得に使用
+import os
+
+# threading: リクエスト処理とは別スレッドでアウトボックスを送信するために使用
+import threading
+
+# timedelta: リトライ時のバックオフ時間の計算に使用
+from datetime import timedelta
+
+# event: SQLAlchemyのflushイベントをフックしてアウトボックスへ書き込むために使用
+from flask import current_app, has_app_context
+from sqlalchemy import event, insert
+from sqlalchemy.orm import Session, undefer
+
+from .models import db, Note, SearchOutbox, utcnow
+from .suggestions import bump_generations
+from .search_index import note_document, write_targets, pending_deletes_key
+
+# このプロセスでアウトボックスに書き込みがあったことをドレイナーに通知するためのイベント
+_wakeup = threading.Event()
+# ドレイナーを起動したプロセスID(uwsgiのフォーク後に各ワーカーで起動し直すため)
+_drainer_pid = None
+_drainer_lock = threading.Lock()
+
+
+@event.listens_for(Session, "after_flush")
+def _enqueue_note_changes(session, flush_context):
+    """
+    Noteの作成・更新・削除を検知し、同じトランザクション内でアウトボックスに行を追加する
+    flush後に実行されるため、新規作成したメモのIDも確定している
+    データベースの全文検索を使用している場合は書き込み時に自動で反映されるため何もしない
+    """
+    if not outbox_enabled():
+        return
+    rows = []
+    for obj in session.new:
+        if isinstance(obj, Note):
+            rows.append({'note_id': obj.id, 'user_id': obj.user_id, 'operation': 'index'})
+    for obj in session.dirty:
+        if isinstance(obj, Note) and session.is_modified(obj, include_collections=False):
+            rows.append({'note_id': obj.id, 'user_id': obj.user_id, 'operation': 'index'})
+    for obj in session.deleted:
+        if isinstance(obj, Note):
+            rows.append({'note_id': obj.id, 'user_id': obj.user_id, 'operation': 'delete'})
+    if rows:
+        session.connection().execute(insert(SearchOutbox), rows)
+        session.info['search_outbox_pending'] = True
+
+
+@event.listens_for(Session, "after_commit")
+def _notify_drainer(session):
+    """コミット後にドレイナーを起こし、変更をすぐに送信させる"""
+    if session.info.pop('search_outbox_pending', False):
+        _wakeup.set()
+
+
+@event.listens_for(Session, "after_rollback")
+def _clear_pending(session):
+    session.info.pop('search_outbox_pending', None)
+
+
+def outbox_enabled():
+    """現在の検索バックエンドがアウトボックス経由の反映を必要とするか"""
+    if not has_app_context():
+        return False
+    backend = current_app.extensions.get('search_backend')
+    return backend is not None and backend.uses_outbox
+
+
+def _backoff(app, attempts):
+    """試行回数に応じた指数バックオフの待ち時間を返す"""
+    seconds = app.config['SEARCH_OUTBOX_BASE_BACKOFF'] * (2 ** max(attempts - 1, 0))
+    return timedelta(seconds=min(seconds, app.config['SEARCH_OUTBOX_MAX_BACKOFF']))
+
+
+def drain_once(app, es_client, batch_size=None):
+    """
+    アウトボックスから送信可能な行を1バッチ分取り出し、Elasticsearchへ_bulkで反映する
+    送信の内容はアウトボックスの操作種別ではなく、その時点のデータベースの状態から決める
+    (メモが存在すればインデックス登録、存在しなければ削除)ため、何度送っても結果は同じになる
+    反映した後は、メモの所有者の候補(サジェスト)のキャッシュの世代を更新する
+    処理した行数を返す
+    """
+    batch_size = batch_size or app.config['SEARCH_OUTBOX_BATCH_SIZE']
+    index_name = app.config['ELASTICSEARCH_INDEX']
+    now = utcnow()
+
+    # 複数のワーカーが同時に送信しても同じ行を取り合わないよう、ロック済みの行は読み飛ばす
+    # (SQLiteではFOR UPDATEは無視される)
+    rows = db.session.execute(
+        db.select(SearchOutbox)
+        .where(SearchOutbox.available_at <= now)
+        .order_by(SearchOutbox.id)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+    ).scalars().all()
+    if not rows:
+        db.session.rollback()
+        return 0
+
+    rows_by_note = {}
+    for row in rows:
+        rows_by_note.setdefault(row.note_id, []).append(row)
+
+    notes = {
+        note.id: note
+        for note in db.session.execute(
+            db.select(Note).where(Note.id.in_(rows_by_note)).options(undefer(Note.content))
+        ).scalars()
+    }
+
+    failed = {}
+    try:
+        # 再構築中は新しいインデックスにも同じ変更を書き込む
+        targets = write_targets(es_client, index_name)
+        if len(targets) > 1:
+            # 新しいインデックスへまだ流し込まれていないメモの削除は404になり、後から流し込まれて復活するため、
+            # 送信の前に記録しておき、再構築の最後に新しいインデックスから削除させる
+            deleted = [note_id for note_id in rows_by_note if note_id not in notes]
+            if deleted:
+                app.config['SESSION_REDIS'].sadd(pending_deletes_key(index_name), *deleted)
+        operations = []
+        action_notes = []
+        for note_id in rows_by_note:
+            note = notes.get(note_id)
+            for target in targets:
+                if note is not None:
+                    operations.append({'index': {'_index': target, '_id': note_id}})
+                    operations.append(note_document(note))
+                else:
+                    operations.append({'delete': {'_index': target, '_id': note_id}})
+                action_notes.append(note_id)
+
+        res = es_client.bulk(operations=operations)
+        for note_id, item in zip(action_notes, res['items']):
+            action, result = next(iter(item.items()))
+            status = result.get('status', 500)
+            # 削除対象がすでに存在しない場合(404)は成功とみなす
+            if status >= 300 and not (action == 'delete' and status == 404):
+                failed[note_id] = str(result.get('error', status))
+    except Exception as e:
+        app.logger.warning(f"Elasticsearch bulk error: {e}")
+        failed = {note_id: str(e) for note_id in rows_by_note}
+
+    shipped_users = set()
+    for note_id, note_rows in rows_by_note.items():
+        for row in note_rows:
+            if note_id in failed:
+                row.attempts += 1
+                row.available_at = now + _backoff(app, row.attempts)
+                row.last_error = failed[note_id][:1000]
+            else:
+                # 所有者の列を追加する前に書き込まれた行は、メモが残っていればメモから求める
+                shipped_users.add(row.user_id if row.user_id is not None else getattr(notes.get(note_id), 'user_id', None))
+                db.session.delete(row)
+    db.session.commit()
+
+    try:
+        bump_generations(app.config['SESSION_REDIS'], shipped_users, app.config['SUGGEST_CACHE_TTL'])
+    except Exception as e:
+        app.logger.warning(f"Failed to invalidate suggestion cache: {e}")
+
+    if failed:
+        app.logger.error(f"Elasticsearch synchronization failed for {len(failed)} notes, will retry: {next(iter(failed.values()))}")
+    return len(rows)
+
+
+def _drain_forever(app):
+    """ドレイナースレッドの本体。行がなくなるまで送信し、なくなったら通知か一定時間を待つ"""
+    from . import get_es
+    interval = app.config['SEARCH_OUTBOX_POLL_INTERVAL']
+    while True:
+        _wakeup.clear()
+        try:
+            with app.app_context():
+                processed = drain_once(app, get_es())
+        except Exception as e:
+            app.logger.error(f"Search outbox drainer error: {e}")
+            processed = 0
+        if not processed:
+            _wakeup.wait(interval)
+
+
+def start_drainer(app):
+    """このプロセスでドレイナースレッドが動いていなければ起動する"""
+    global _drainer_pid
+    pid = os.getpid()
+    if _drainer_pid == pid:
+        return
+    with _drainer_lock:
+        if _drainer_pid == pid:
+            return
+        thread = threading.Thread(target=_drain_forever, args=(app,), name="search-outbox-drainer", daemon=True)
+        thread.start()
+        _drainer_pid = pid
+
+
+def init_app(app):
+    """
+    アプリケーションにドレイナーを登録する
+    uwsgiはマスタープロセスでアプリを読み込んでからフォークするため、スレッドは各ワーカーの最初のリクエスト時に起動する
+    """
+    if not app.config['SEARCH_OUTBOX_DRAINER'] or not app.extensions['search_backend'].uses_outbox:
+        return
+
+    @app.before_request
+    def _ensure_drainer():
+        start_drainer(app)
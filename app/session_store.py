@@ -0,0 +1,151 @@
+"""
+ログインセッションをRedisに保存するセッションインターフェース。
+Flask-Sessionの標準の動作では、セッションが変更されていなくてもリクエストのたびにRedisへ全体を書き直し(SET)、
+有効期限とCookieを更新するため、画像を多く埋め込んだメモを開くと画像の数だけ書き込みが発生していた。
+
+ここでは次のように動作を変える。
+- セッションの内容が変わった場合(ログイン、ログアウト、flashなど)のみRedisへ書き込む
+- 変わっていない場合は、前回の延長から SESSION_TTL_REFRESH_INTERVAL 秒以上経っている時だけ、EXPIREで有効期限とCookieを延長する
+  (経過時間は読み込み時に GET と同時に取得する残りの有効期限(TTL)から計算するため、追加の問い合わせは不要)
+- 静的ファイルへのリクエストではセッションを読み込まない
+- 保存形式はmsgpackのみとし、pickle形式のデータは読み込まない(読み込めないセッションは新しいセッションとして扱う)
+"""
+
+# msgspec: セッションの保存形式(msgpack)の変換に使用(Flask-Sessionが依存しているパッケージ)
+import msgspec
+
+from itsdangerous import BadSignature, Signer
+from werkzeug.exceptions import HTTPException
+
+from flask_session.defaults import Defaults
+from flask_session.redis import RedisSessionInterface
+
+
+_decoder = msgspec.msgpack.Decoder(dict)
+
+
+def decode_session(data):
+    """Redisに保存されたセッション(msgpack)を辞書に戻す。読み込めない場合(以前のpickle形式など)はNone"""
+    try:
+        return _decoder.decode(data)
+    except msgspec.DecodeError:
+        return None
+
+
+def session_store_id(config, cookie_value):
+    """
+    セッションのCookieの値から、Redisのキーを返す(署名が正しくない場合はNone)
+    Flask以外のサービス(async_search.py)からログイン状態を確認するために使用する
+    """
+    sid = cookie_value
+    if config.get('SESSION_USE_SIGNER', Defaults.SESSION_USE_SIGNER):
+        # Flask-Sessionと同じ署名(salt='flask-session')
+        signer = Signer(config['SECRET_KEY'], salt='flask-session', key_derivation='hmac')
+        try:
+            sid = signer.unsign(cookie_value).decode()
+        except BadSignature:
+            return None
+    return config.get('SESSION_KEY_PREFIX', Defaults.SESSION_KEY_PREFIX) + sid
+
+
+def _total_seconds(td):
+    return int(td.total_seconds())
+
+
+def _is_static(app, request):
+    """静的ファイルへのリクエストか(セッションを開く時点ではURLの照合前のため、ここで照合する)"""
+    try:
+        endpoint, _ = app.create_url_adapter(request).match()
+    except HTTPException:
+        return False
+    return endpoint.rsplit('.', 1)[-1] == 'static'
+
+
+class CompactRedisSessionInterface(RedisSessionInterface):
+    """変更があった場合のみ書き込み、有効期限の延長は一定間隔ごとのEXPIREで行うセッションインターフェース"""
+
+    def __init__(self, app, client, refresh_interval, **kwargs):
+        super().__init__(app, client, serialization_format='msgpack', **kwargs)
+        self.refresh_interval = refresh_interval
+
+    def _new_session(self):
+        return self.session_class(sid=self._generate_sid(self.sid_length), permanent=self.permanent)
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        # 静的ファイル(ハッシュ付きのファイル名で配信するCSS・JSなど)はセッションを使わないため、Redisに問い合わせない
+        if not sid or _is_static(app, request):
+            return self._new_session()
+        if self.use_signer:
+            try:
+                sid = self._unsign(app, sid)
+            except BadSignature:
+                return self._new_session()
+
+        # セッションの内容と残りの有効期限を1回の往復で取得する
+        store_id = self._get_store_id(sid)
+        pipe = self.client.pipeline(transaction=False)
+        pipe.get(store_id)
+        pipe.ttl(store_id)
+        data, ttl = pipe.execute()
+        values = decode_session(data) if data else None
+        if values is None:
+            return self._new_session()
+        session = self.session_class(values, sid=sid)
+        session.stored_ttl = ttl
+        return session
+
+    def should_set_storage(self, app, session):
+        # SESSION_REFRESH_EACH_REQUESTに関わらず、変更された場合のみ書き込む
+        return session.modified
+
+    def save_session(self, app, session, response):
+        if not session or session.modified:
+            # 新規作成・変更・削除は通常どおり書き込む
+            return super().save_session(app, session, response)
+
+        if session.accessed:
+            response.vary.add('Cookie')
+        lifetime = _total_seconds(app.permanent_session_lifetime)
+        ttl = getattr(session, 'stored_ttl', None)
+        if ttl is None:
+            return
+        if ttl < 0:
+            # 有効期限のないキー(-1)や、読み込んだ後に削除されたキー(-2)は書き直す
+            return self._upsert_and_set_cookie(app, session, response)
+        if lifetime - ttl < self.refresh_interval:
+            return
+        # 有効期限だけを延長し、Cookieの有効期限もそろえる
+        self.client.expire(self._get_store_id(session.sid), lifetime)
+        self._set_cookie(app, session, response)
+
+    def _upsert_and_set_cookie(self, app, session, response):
+        self._upsert_session(app.permanent_session_lifetime, session, self._get_store_id(session.sid))
+        self._set_cookie(app, session, response)
+
+    def _set_cookie(self, app, session, response):
+        response.set_cookie(
+            key=self.get_cookie_name(app),
+            value=self._sign(app, session.sid) if self.use_signer else session.sid,
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app),
+            domain=self.get_cookie_domain(app),
+            path=self.get_cookie_path(app),
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app),
+        )
+        response.vary.add('Cookie')
+
+
+def init_app(app):
+    """アプリケーションのセッションインターフェースを設定する"""
+    config = app.config
+    app.session_interface = CompactRedisSessionInterface(
+        app,
+        config['SESSION_REDIS'],
+        refresh_interval=config['SESSION_TTL_REFRESH_INTERVAL'],
+        key_prefix=config.get('SESSION_KEY_PREFIX', Defaults.SESSION_KEY_PREFIX),
+        use_signer=config.get('SESSION_USE_SIGNER', Defaults.SESSION_USE_SIGNER),
+        permanent=config.get('SESSION_PERMANENT', Defaults.SESSION_PERMANENT),
+        sid_length=config.get('SESSION_ID_LENGTH', Defaults.SESSION_ID_LENGTH),
+    )
@@ -0,0 +1,108 @@
+"""
+検索ボックスへの入力中に表示する候補(サジェスト)を扱うモジュール。
+候補はタイトルの前方一致で検索し(Elasticsearchではedge n-gramのtitle.prefixフィールド)、idとタイトルのみを返す。
+
+結果は正規化した入力をキーにしてRedisにユーザーごとにキャッシュする。
+キーにはユーザーの候補の世代を含めるため、メモが変更されると古いキャッシュは参照されなくなり(期限切れで消える)、キーの走査や削除は不要。
+同じ入力や、文字を消して戻った入力はElasticsearchに問い合わせずに返せる。
+
+世代は検索バックエンドによって異なる。
+- データベースの全文検索: ユーザーのメモ一覧のリビジョン番号(User.notes_revision。メモの変更と同時にコミットされる)
+- Elasticsearch: アウトボックスの送信処理がメモの変更をElasticsearchへ反映した後に、Redisの世代(反映した時刻)を更新する。
+  コミットの時点ではまだElasticsearchに反映されていないため、リビジョン番号を使うと古い候補が新しい世代でキャッシュされてしまう。
+  反映の直後もElasticsearchのリフレッシュまでは古い結果が返る可能性があるため、SUGGEST_CACHE_SETTLE_SECONDS の間はキャッシュしない。
+  Redisの世代は検索サービス(async_search.py)とも共有する
+"""
+
+# json: Redisに保存する候補の変換に使用
+import json
+
+# hashlib: 入力をキャッシュキーに使用できる長さにするために使用
+import hashlib
+
+# unicodedata: 全角・半角などの表記の揺れをそろえるために使用
+import unicodedata
+
+# time: 検索インデックスへ反映した時刻を世代として記録するために使用
+import time
+
+from flask import current_app
+
+from . import search
+from .models import db, User
+
+
+def normalize_query(query):
+    """入力を正規化する(NFKCで全角・半角をそろえ、小文字にし、連続する空白を1つにする)"""
+    return ' '.join(unicodedata.normalize('NFKC', query).lower().split())
+
+
+def cache_key(user_id, generation, query):
+    """候補のキャッシュのRedisのキー(検索サービス(async_search.py)と共通)"""
+    digest = hashlib.sha1(query.encode('utf-8')).hexdigest()[:16]
+    return f"suggest:{user_id}:{generation}:{digest}"
+
+
+def generation_key(user_id):
+    """Elasticsearchへの反映ごとに更新する、ユーザーの候補の世代のRedisのキー"""
+    return f"suggest:gen:{user_id}"
+
+
+def parse_generation(value, settle_seconds):
+    """
+    Redisに保存された世代から、(キャッシュキーに使う世代, 結果をキャッシュしてよいか)を返す
+    反映から settle_seconds 秒以内はElasticsearchで検索できるようになる前の可能性があるため、キャッシュしない
+    """
+    if not value:
+        return '0', True
+    generation = value.decode() if isinstance(value, bytes) else value
+    return generation, time.time() - float(generation) >= settle_seconds
+
+
+def bump_generations(redis_client, user_ids, cache_ttl):
+    """メモの変更をElasticsearchへ反映した後に呼び出し、ユーザーの候補のキャッシュを参照されなくする"""
+    user_ids = {user_id for user_id in user_ids if user_id is not None}
+    if not user_ids:
+        return
+    generation = f"{time.time():.6f}"
+    pipe = redis_client.pipeline(transaction=False)
+    for user_id in user_ids:
+        # 世代のキーが消えても、それより前にキャッシュした候補は期限切れで消えているよう、キャッシュより長く保持する
+        pipe.set(generation_key(user_id), generation, ex=cache_ttl * 2)
+    pipe.execute()
+
+
+def get_suggestions(user_id, query):
+    """入力に前方一致するメモの候補([{'id', 'title'}])を返す"""
+    config = current_app.config
+    query = normalize_query(query)[:config['SUGGEST_MAX_QUERY_LENGTH']]
+    if not query:
+        return []
+
+    redis_client = config['SESSION_REDIS']
+    backend = search.get_backend()
+    if backend.uses_outbox:
+        try:
+            generation, cacheable = parse_generation(redis_client.get(generation_key(user_id)), config['SUGGEST_CACHE_SETTLE_SECONDS'])
+        except Exception:
+            generation, cacheable = None, False
+    else:
+        generation, cacheable = db.session.execute(db.select(User.notes_revision).where(User.id == user_id)).scalar(), True
+    key = cache_key(user_id, generation, query)
+
+    cached = None
+    if generation is not None:
+        try:
+            cached = redis_client.get(key)
+        except Exception:
+            pass
+    if cached is not None:
+        return json.loads(cached)
+
+    suggestions = backend.suggest(user_id, query, config['SUGGEST_LIMIT'])
+    if cacheable:
+        try:
+            redis_client.set(key, json.dumps(suggestions, ensure_ascii=False), ex=config['SUGGEST_CACHE_TTL'])
+        except Exception:
+            pass
+    return suggestions
@@ -0,0 +1,362 @@
+"""
+ファイルのアップロードを処理するモジュール。
+大きなファイルは一定サイズのチャンクに分けて送信させ、チャンクごとにディスクへ書き込みながらハッシュを計算する。
+途中で通信が切れても、受信済みのチャンクを問い合わせて続きから再開できる。
+
+アップロードが完了したファイルは内容のハッシュを名前にして UPLOAD_FOLDER/.objects に1つだけ保存し、
+各ユーザーのディレクトリにはそのファイルへのハードリンクを作成する。
+同じファイルを複数のユーザーがアップロードしても、ディスクは1つ分しか使用しない。
+"""
+
+# os, shutil: ファイルやディレクトリの操作に使用
+import os
+import shutil
+
+# json: アップロード中の情報(ファイル名やサイズ)の保存に使用
+import json
+
+# time: 放置されたアップロードの削除に使用
+import time
+
+# hashlib: チャンクと完成したファイルのハッシュ計算に使用
+import hashlib
+
+# uuid: アップロードIDの生成に使用
+import uuid
+
+# mimetypes: X-Accel-Redirectで送信するファイルのContent-Typeを決めるために使用
+import mimetypes
+
+from datetime import datetime
+
+# quote: X-Accel-RedirectのパスやContent-Dispositionのファイル名をURLエンコードするために使用
+from urllib.parse import quote
+
+# send_from_directory: Python側でファイルを送信する場合に使用(Range・条件付きリクエストに対応)
+# safe_join: ユーザーのディレクトリの外を指すファイル名を拒否するために使用
+from flask import abort, current_app, send_from_directory
+from werkzeug.security import safe_join
+
+# ディスクへの書き込み・ハッシュ計算を行う単位
+_COPY_BUFFER_SIZE = 1024 * 1024
+
+
+class UploadError(Exception):
+    """アップロードの処理を続けられない場合の例外(メッセージはそのままユーザーに表示する)"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def _incoming_root(config):
+    return os.path.join(config['UPLOAD_FOLDER'], '.incoming')
+
+
+def _objects_root(config):
+    return os.path.join(config['UPLOAD_FOLDER'], '.objects')
+
+
+def _derived_root(config):
+    return os.path.join(config['UPLOAD_FOLDER'], '.derived')
+
+
+def _session_dir(config, upload_id):
+    # アップロードIDはuuid4の16進文字列のみ許可し、パスとして解釈されないようにする
+    if not (len(upload_id) == 32 and all(c in '0123456789abcdef' for c in upload_id)):
+        raise UploadError('アップロードが見つかりません。', 404)
+    return os.path.join(_incoming_root(config), upload_id)
+
+
+def object_digest(chunk_size, chunk_digests):
+    """
+    チャンクごとのSHA-256からファイル全体のハッシュを計算する
+    チャンクは複数のワーカーで受信されるため、ファイル全体を読み直さずにハッシュを確定できるようにしている
+    """
+    h = hashlib.sha256(f"{chunk_size}:".encode())
+    for digest in chunk_digests:
+        h.update(digest)
+    return h.hexdigest()
+
+
+def object_path(config, digest):
+    """ハッシュに対応する保存ファイルのパス"""
+    return os.path.join(_objects_root(config), digest[:2], digest)
+
+
+def derived_dir(config, digest):
+    """保存ファイルから作成した派生ファイル(画像のWebP版・縮小版)を置くディレクトリ"""
+    return os.path.join(_derived_root(config), digest[:2], digest)
+
+
+def _link_name(user_folder, filename):
+    """ユーザーのディレクトリ内で重複しない保存名を作成(既存のアップロードと同じく日時を先頭に付ける)"""
+    base = datetime.now().strftime("%Y%m%d_%H%M%S_") + filename
+    name = base
+    counter = 1
+    while os.path.exists(os.path.join(user_folder, name)):
+        stem, ext = os.path.splitext(base)
+        name = f"{stem}_{counter}{ext}"
+        counter += 1
+    return name
+
+
+def store_object(config, user_folder, filename, data_path, digest):
+    """
+    一時ファイルをハッシュ名で保存し、ユーザーのディレクトリにハードリンクを作成する
+    同じ内容のファイルが既にある場合は既存のファイルを共有し、リンクを作成した後で一時ファイルを削除する
+    (保存したファイル名, 重複していたか)を返す
+    """
+    path = object_path(config, digest)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.makedirs(user_folder, exist_ok=True)
+    while True:
+        name = _link_name(user_folder, filename)
+        link_path = os.path.join(user_folder, name)
+        try:
+            os.link(path, link_path)
+        except FileExistsError:
+            continue
+        except FileNotFoundError:
+            # 保存ファイルがない(他のリクエストの削除やgcで直前に削除された場合を含む)ため、一時ファイルを保存ファイルにする
+            # 先にユーザーのリンクを作成し、リンク数が1の状態を作らないことで、その間にgcに削除されないようにする
+            try:
+                os.link(data_path, link_path)
+            except FileExistsError:
+                continue
+            os.replace(data_path, path)
+            return name, False
+        os.remove(data_path)
+        return name, True
+
+
+def save_stream(config, user_folder, filename, stream, max_size=None):
+    """
+    フォームやリクエストボディで送信されたファイルを、チャンク単位でハッシュを計算しながら保存する
+    max_sizeを超えた場合はUploadErrorを送出する。(保存したファイル名, ハッシュ, 重複していたか)を返す
+    """
+    chunk_size = config['UPLOAD_CHUNK_SIZE']
+    os.makedirs(_incoming_root(config), exist_ok=True)
+    data_path = os.path.join(_incoming_root(config), f"{uuid.uuid4().hex}.part")
+    chunk_digests = []
+    total = 0
+    try:
+        with open(data_path, 'wb') as fh:
+            while True:
+                h = hashlib.sha256()
+                remaining = chunk_size
+                while remaining:
+                    data = stream.read(min(_COPY_BUFFER_SIZE, remaining))
+                    if not data:
+                        break
+                    total += len(data)
+                    if max_size is not None and total > max_size:
+                        raise UploadError('ファイルサイズが上限を超えています。', 413)
+                    h.update(data)
+                    fh.write(data)
+                    remaining -= len(data)
+                if remaining == chunk_size:
+                    break
+                chunk_digests.append(h.digest())
+                if remaining:
+                    break
+        digest = object_digest(chunk_size, chunk_digests)
+        name, deduplicated = store_object(config, user_folder, filename, data_path, digest)
+        return name, digest, deduplicated
+    except BaseException:
+        if os.path.exists(data_path):
+            os.remove(data_path)
+        raise
+
+
+def create_session(config, user_id, filename, size):
+    """チャンクアップロードを開始し、アップロードの情報を返す"""
+    if size < 0 or size > config['UPLOAD_MAX_SIZE']:
+        raise UploadError('ファイルサイズが上限を超えています。', 413)
+    upload_id = uuid.uuid4().hex
+    session_dir = _session_dir(config, upload_id)
+    os.makedirs(os.path.join(session_dir, 'chunks'))
+    meta = {
+        'user_id': user_id,
+        'filename': filename,
+        'size': size,
+        'chunk_size': config['UPLOAD_CHUNK_SIZE'],
+    }
+    with open(os.path.join(session_dir, 'meta.json'), 'w') as fh:
+        json.dump(meta, fh)
+    # 各チャンクを任意の順番・任意のワーカーで書き込めるよう、最終的なサイズのファイルを先に作成しておく
+    with open(os.path.join(session_dir, 'data.part'), 'wb') as fh:
+        fh.truncate(size)
+    return dict(meta, upload_id=upload_id, received=[])
+
+
+def load_session(config, upload_id, user_id):
+    """アップロードの情報と受信済みのチャンク番号を取得"""
+    session_dir = _session_dir(config, upload_id)
+    try:
+        with open(os.path.join(session_dir, 'meta.json')) as fh:
+            meta = json.load(fh)
+    except FileNotFoundError:
+        raise UploadError('アップロードが見つかりません。', 404)
+    if meta['user_id'] != user_id:
+        raise UploadError('アップロードが見つかりません。', 404)
+    received = sorted(int(name) for name in os.listdir(os.path.join(session_dir, 'chunks')) if name.isdigit())
+    return dict(meta, upload_id=upload_id, received=received)
+
+
+def _chunk_count(meta):
+    return -(-meta['size'] // meta['chunk_size'])
+
+
+def write_chunk(config, upload_id, user_id, index, stream):
+    """チャンクをディスクへ書き込みながらハッシュを計算し、受信済みとして記録する"""
+    meta = load_session(config, upload_id, user_id)
+    if not 0 <= index < _chunk_count(meta):
+        raise UploadError('チャンク番号が不正です。')
+    offset = index * meta['chunk_size']
+    expected = min(meta['chunk_size'], meta['size'] - offset)
+
+    session_dir = _session_dir(config, upload_id)
+    h = hashlib.sha256()
+    written = 0
+    with open(os.path.join(session_dir, 'data.part'), 'r+b') as fh:
+        fh.seek(offset)
+        while written < expected:
+            data = stream.read(min(_COPY_BUFFER_SIZE, expected - written))
+            if not data:
+                break
+            h.update(data)
+            fh.write(data)
+            written += len(data)
+    if written != expected or stream.read(1):
+        raise UploadError('チャンクのサイズが正しくありません。')
+
+    # チャンクのハッシュの書き込みが完了したものだけを受信済みとみなす
+    chunk_path = os.path.join(session_dir, 'chunks', str(index))
+    with open(chunk_path + '.tmp', 'wb') as fh:
+        fh.write(h.digest())
+    os.replace(chunk_path + '.tmp', chunk_path)
+
+
+def complete_session(config, upload_id, user_id, user_folder):
+    """すべてのチャンクを受信済みであれば、ファイルを保存してアップロードを終了する"""
+    meta = load_session(config, upload_id, user_id)
+    count = _chunk_count(meta)
+    if meta['received'] != list(range(count)):
+        raise UploadError('受信していないチャンクがあります。', 409)
+
+    session_dir = _session_dir(config, upload_id)
+    chunk_digests = []
+    for index in range(count):
+        with open(os.path.join(session_dir, 'chunks', str(index)), 'rb') as fh:
+            chunk_digests.append(fh.read())
+
+    digest = object_digest(meta['chunk_size'], chunk_digests)
+    name, deduplicated = store_object(config, user_folder, meta['filename'], os.path.join(session_dir, 'data.part'), digest)
+    shutil.rmtree(session_dir, ignore_errors=True)
+    return {'filename': name, 'size': meta['size'], 'digest': digest, 'deduplicated': deduplicated}
+
+
+def collect_garbage(config, incoming_max_age):
+    """
+    どのユーザーからも参照されなくなった保存ファイル(ハードリンク数が1)と、
+    一定時間以上放置されたアップロードを削除する。(削除したファイル数, 削除したアップロード数)を返す
+    """
+    removed_objects = 0
+    for dirpath, _, filenames in os.walk(_objects_root(config)):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            if os.stat(path).st_nlink == 1:
+                os.remove(path)
+                shutil.rmtree(derived_dir(config, name), ignore_errors=True)
+                removed_objects += 1
+
+    # 保存ファイルが削除済みの派生ファイルも削除する
+    for dirpath, dirnames, _ in os.walk(_derived_root(config)):
+        for name in list(dirnames):
+            if len(name) > 2 and not os.path.exists(object_path(config, name)):
+                shutil.rmtree(os.path.join(dirpath, name), ignore_errors=True)
+                dirnames.remove(name)
+
+    removed_sessions = 0
+    incoming = _incoming_root(config)
+    if os.path.isdir(incoming):
+        now = time.time()
+        for entry in os.scandir(incoming):
+            # チャンクを受信するたびにchunksディレクトリの更新日時が変わるため、それを最終更新日時とみなす
+            chunks_dir = os.path.join(entry.path, 'chunks')
+            mtime = os.stat(chunks_dir).st_mtime if os.path.isdir(chunks_dir) else entry.stat().st_mtime
+            if now - mtime > incoming_max_age:
+                if entry.is_dir():
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                else:
+                    os.remove(entry.path)
+                removed_sessions += 1
+    return removed_objects, removed_sessions
+
+
+def release_object(config, digest):
+    """ユーザーのファイルを削除した後、どのユーザーからも参照されなくなった保存ファイルを削除する"""
+    path = object_path(config, digest)
+    try:
+        if os.stat(path).st_nlink == 1:
+            os.remove(path)
+            shutil.rmtree(derived_dir(config, digest), ignore_errors=True)
+    except FileNotFoundError:
+        pass
+
+
+def content_disposition(filename):
+    """
+    ダウンロードさせるファイル名のContent-Dispositionヘッダーの値を作成する
+    ASCII以外の文字を含む場合は、filename*(RFC 5987)のUTF-8の名前と、対応していないブラウザ向けのASCIIだけの名前を付ける
+    (ヘッダーはlatin-1でしか送信できないため、日本語のファイル名をそのまま filename= に入れると送信できない)
+    """
+    fallback = filename.encode('ascii', 'ignore').decode().replace('"', '').replace('\\', '')
+    if fallback == filename:
+        return f'attachment; filename="{filename}"'
+    return f"attachment; filename=\"{fallback or 'download'}\"; filename*=UTF-8''{quote(filename)}"
+
+
+def _send_file(config, directory, filename, as_attachment=False, max_age=None):
+    """
+    UPLOAD_FOLDER内のdirectory(UPLOAD_FOLDERからの相対パス)にあるファイルを送信する
+    SEND_FILE_ACCEL_PREFIXが設定されている場合は、権限の確認だけを行いX-Accel-Redirectでnginxに送信を任せる
+    (uwsgiのワーカーは大きなファイルの転送中も占有されない)
+    設定されていない場合はPython側で送信し、Rangeリクエスト、ETag/Last-Modifiedによる304応答に対応する
+    """
+    folder = os.path.join(config['UPLOAD_FOLDER'], directory)
+    prefix = config['SEND_FILE_ACCEL_PREFIX']
+    if not prefix:
+        response = send_from_directory(folder, filename, as_attachment=as_attachment, max_age=max_age, conditional=True, etag=True)
+        if max_age:
+            # ログインしたユーザー本人のファイルのため、共有キャッシュ(プロキシ)には保存させない
+            response.cache_control.public = False
+            response.cache_control.private = True
+        return response
+
+    path = safe_join(folder, filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    response = current_app.response_class()
+    response.headers['X-Accel-Redirect'] = f"{prefix.rstrip('/')}/{quote(directory)}/{quote(filename)}"
+    response.mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    if as_attachment:
+        response.headers['Content-Disposition'] = content_disposition(filename)
+    if max_age:
+        response.cache_control.private = True
+        response.cache_control.max_age = max_age
+    else:
+        response.cache_control.no_cache = True
+    return response
+
+
+def send_user_file(config, username, filename, as_attachment=False, max_age=None):
+    """ユーザーのディレクトリにあるファイルを送信する"""
+    return _send_file(config, username, filename, as_attachment=as_attachment, max_age=max_age)
+
+
+def send_derived_file(config, digest, filename, max_age=None):
+    """保存ファイルから作成した派生ファイルを送信する"""
+    directory = os.path.relpath(derived_dir(config, digest), config['UPLOAD_FOLDER'])
+    return _send_file(config, directory, filename, max_age=max_age)
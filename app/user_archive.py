@@ -0,0 +1,323 @@
+"""
+ユーザーのメモとアップロードしたファイルをzipファイルとして書き出し(エクスポート)、読み込む(インポート)モジュール。
+
+zipファイルの構成
+- notes/<ID>_<タイトル>.md: メモ1件ずつのMarkdown。先頭にタイトルと作成日を記載する(front matter)
+- files/<ファイル名>: アップロードしたファイル(UPLOAD_FOLDER/<ユーザー名>)
+- manifest.json: 形式のバージョンと件数(最後に書き込む)
+
+エクスポートはzipファイルをメモリや一時ファイル上に作らず、作成しながら少しずつ送信する(iter_export)。
+メモとファイルの一覧はIDの範囲ごとに読み込み、メモの本文(数MBになり得る)は1件ずつ読み込むため、
+メモの件数や本文のサイズが大きくても、使用するメモリはメモ1件分程度になる。
+
+インポートはzipファイルの中央ディレクトリを参照して1件ずつ読み込み、メモはIMPORT_BATCH_SIZE件ごとに1回のINSERTとコミットで登録する。
+Elasticsearchを使用している場合は、登録したメモをバッチごとに_bulkでインデックスに登録する
+(失敗した場合はアウトボックスに追加し、後で送信させる)。
+"""
+
+# os: ファイルのパスや更新日時の取得に使用
+import os
+
+# json: front matterのタイトルとmanifest.jsonの変換に使用
+import json
+
+# re: エクスポートしたファイル名から、アップロード時に付けた日時を取り除くために使用
+import re
+
+# zipfile: zipファイルの作成と読み込みに使用
+import zipfile
+
+from datetime import date, datetime
+from types import SimpleNamespace
+
+from sqlalchemy import insert, update
+from werkzeug.utils import secure_filename
+
+from . import uploads, user_files
+from .models import db, Note, User, UserFile, SearchOutbox
+from .search_index import note_document, write_targets
+from .suggestions import bump_generations
+
+# zipファイルの形式のバージョン
+ARCHIVE_VERSION = 1
+# ファイルを読み書きする単位
+_COPY_BUFFER_SIZE = 1024 * 1024
+# 小さいメモを1件ずつ送信しないよう、このサイズ以上溜まってから送信する
+_SEND_SIZE = 64 * 1024
+# zipファイルに記録できる最も古い日時
+_ZIP_MIN_DATE = (1980, 1, 1, 0, 0, 0)
+
+
+class ArchiveError(Exception):
+    """インポートできないzipファイル(メッセージはそのままユーザーに表示する)"""
+
+
+class _StreamBuffer:
+    """
+    zipfileの書き込み先。書き込まれたデータを溜めておき、take()で取り出して送信する
+    tell()やseek()を持たないため、zipfileはサイズやCRCを各ファイルの後ろ(データディスクリプタ)に書き込む
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self.size = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        self.size = 0
+        return data
+
+
+def _zip_time(value):
+    """日付・日時をzipファイルに記録する形式に変換する(1980年より前は1980年1月1日とする)"""
+    if isinstance(value, datetime):
+        parts = value.timetuple()[:6]
+    else:
+        parts = (value.year, value.month, value.day, 0, 0, 0)
+    return max(tuple(parts), _ZIP_MIN_DATE)
+
+
+def note_filename(note_id, title):
+    """メモのzipファイル内のパス(タイトルは確認しやすいよう付けるだけで、読み込み時は使用しない)"""
+    stem = secure_filename(title)[:50]
+    return f"notes/{note_id}_{stem}.md" if stem else f"notes/{note_id}.md"
+
+
+def render_note(title, note_date, content):
+    """メモをfront matter付きのMarkdownに変換する"""
+    return f"---\ntitle: {json.dumps(title, ensure_ascii=False)}\ndate: {note_date.isoformat()}\n---\n{content}"
+
+
+def parse_note(text, default_title):
+    """front matter付きのMarkdownから(タイトル, 作成日, 本文)を取り出す。front matterがない場合は全体を本文とする"""
+    title, note_date = default_title, date.today()
+    if text.startswith('---\n') or text.startswith('---\r\n'):
+        header, sep, body = text.partition('\n---')
+        if sep:
+            # 区切りの行の改行を取り除く
+            text = body[2:] if body.startswith('\r\n') else body[1:]
+            for line in header.splitlines()[1:]:
+                key, _, value = line.partition(':')
+                value = value.strip()
+                if key == 'title':
+                    try:
+                        title = json.loads(value)
+                    except ValueError:
+                        title = value
+                elif key == 'date':
+                    try:
+                        note_date = date.fromisoformat(value)
+                    except ValueError:
+                        pass
+    return str(title)[:250] or default_title, note_date, text
+
+
+def _iter_notes(user_id, batch_size):
+    """
+    ユーザーのメモを(メモ, 本文)の形で返す
+    一覧(ID・タイトル・作成日)はIDの範囲ごとに読み込み、本文は1件ずつ読み込む(途中で削除されたメモは含めない)
+    """
+    last_id = 0
+    while True:
+        notes = db.session.execute(
+            db.select(Note.id, Note.title, Note.date)
+            .where(Note.user_id == user_id, Note.id > last_id)
+            .order_by(Note.id)
+            .limit(batch_size)
+        ).all()
+        if not notes:
+            return
+        for note in notes:
+            content = db.session.execute(db.select(Note.content).where(Note.id == note.id)).scalar()
+            if content is not None:
+                yield note, content
+        last_id = notes[-1].id
+
+
+def _iter_files(user_id, batch_size):
+    """ユーザーのファイルの一覧をIDの範囲ごとに読み込んで返す"""
+    last_id = 0
+    while True:
+        rows = db.session.execute(
+            db.select(UserFile.id, UserFile.filename)
+            .where(UserFile.user_id == user_id, UserFile.id > last_id)
+            .order_by(UserFile.id)
+            .limit(batch_size)
+        ).all()
+        if not rows:
+            return
+        yield from rows
+        last_id = rows[-1].id
+
+
+def iter_export(config, user_id, username):
+    """ユーザーのメモとファイルをzipファイルとして少しずつ作成し、作成したデータを順に返すジェネレーター"""
+    batch_size = config['EXPORT_BATCH_SIZE']
+    user_folder = os.path.join(config['UPLOAD_FOLDER'], username)
+    buffer = _StreamBuffer()
+    counts = {'notes': 0, 'files': 0}
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=config['EXPORT_COMPRESS_LEVEL']) as zf:
+        for note, content in _iter_notes(user_id, batch_size):
+            info = zipfile.ZipInfo(note_filename(note.id, note.title), date_time=_zip_time(note.date))
+            info.compress_type = zipfile.ZIP_DEFLATED
+            zf.writestr(info, render_note(note.title, note.date, content))
+            counts['notes'] += 1
+            if buffer.size >= _SEND_SIZE:
+                yield buffer.take()
+
+        for row in _iter_files(user_id, batch_size):
+            path = os.path.join(user_folder, row.filename)
+            try:
+                src = open(path, 'rb')
+            except OSError:
+                # ファイル一覧とディレクトリが食い違っている場合(`flask files reconcile` で修正できる)
+                continue
+            with src:
+                info = zipfile.ZipInfo(f"files/{row.filename}", date_time=_zip_time(datetime.fromtimestamp(os.fstat(src.fileno()).st_mtime)))
+                # アップロードされたファイルは圧縮済みの形式が多いため、圧縮せずに格納する
+                info.compress_type = zipfile.ZIP_STORED
+                with zf.open(info, 'w', force_zip64=True) as dest:
+                    while True:
+                        data = src.read(_COPY_BUFFER_SIZE)
+                        if not data:
+                            break
+                        dest.write(data)
+                        data = buffer.take()
+                        if data:
+                            yield data
+            counts['files'] += 1
+            data = buffer.take()
+            if data:
+                yield data
+
+        zf.writestr('manifest.json', json.dumps({'version': ARCHIVE_VERSION, 'username': username, **counts}, ensure_ascii=False))
+    yield buffer.take()
+
+
+def export_to_file(config, user, fileobj):
+    """ユーザーのメモとファイルをzipファイルとして書き出す(flaskコマンド用)"""
+    for data in iter_export(config, user.id, user.username):
+        fileobj.write(data)
+
+
+def _index_notes(es_client, index_name, notes):
+    """登録したメモを_bulkでElasticsearchに登録する。失敗したメモのIDの一覧を返す"""
+    operations = []
+    note_ids = []
+    for target in write_targets(es_client, index_name):
+        for note in notes:
+            operations.append({'index': {'_index': target, '_id': note['id']}})
+            operations.append(note_document(SimpleNamespace(**note)))
+            note_ids.append(note['id'])
+    res = es_client.bulk(operations=operations)
+    return {note_id for note_id, item in zip(note_ids, res['items']) if item['index'].get('status', 500) >= 300}
+
+
+class _Importer:
+    """zipファイルの内容をバッチごとにデータベースへ登録する"""
+
+    def __init__(self, config, user, es_client, progress):
+        self.config = config
+        # コミットのたびにセッションを空にするため、ユーザーのIDと名前だけを保持する
+        self.user_id = user.id
+        self.es_client = es_client
+        self.progress = progress
+        self.batch_size = config['IMPORT_BATCH_SIZE']
+        self.user_folder = os.path.join(config['UPLOAD_FOLDER'], user.username)
+        self.pending = []
+        self.counts = {'notes': 0, 'files': 0, 'skipped': 0}
+
+    def add_note(self, title, note_date, content):
+        self.pending.append({'user_id': self.user_id, 'title': title, 'date': note_date, 'content': content})
+        if len(self.pending) >= self.batch_size:
+            self.flush_notes()
+
+    def flush_notes(self):
+        """溜めたメモを1回のINSERTで登録してコミットし、Elasticsearchに登録する"""
+        if not self.pending:
+            return
+        rows = self.pending
+        self.pending = []
+        # ORMのflushを経由しないため、リビジョン番号の更新とアウトボックスへの追加はここで行う
+        ids = db.session.execute(insert(Note).returning(Note.id, sort_by_parameter_order=True), rows).scalars().all()
+        for row, note_id in zip(rows, ids):
+            row['id'] = note_id
+        db.session.execute(update(User).where(User.id == self.user_id).values(notes_revision=User.notes_revision + 1))
+
+        failed = set()
+        if self.es_client is not None:
+            try:
+                failed = self._index(rows)
+            except Exception as e:
+                self.progress(f"Elasticsearch bulk error: {e}")
+                failed = set(ids)
+        if failed:
+            # 登録できなかったメモはアウトボックス経由で後から登録する
+            db.session.execute(insert(SearchOutbox), [{'note_id': note_id, 'user_id': self.user_id, 'operation': 'index'} for note_id in failed])
+        db.session.commit()
+        db.session.expunge_all()
+        if self.es_client is not None and len(failed) < len(rows):
+            # Elasticsearchへ直接登録したため、アウトボックスの送信処理の代わりに候補のキャッシュの世代を更新する
+            try:
+                bump_generations(self.config['SESSION_REDIS'], [self.user_id], self.config['SUGGEST_CACHE_TTL'])
+            except Exception as e:
+                self.progress(f"Failed to invalidate suggestion cache: {e}")
+        self.counts['notes'] += len(rows)
+        self.progress(f"{self.counts['notes']} notes imported")
+
+    def _index(self, rows):
+        return _index_notes(self.es_client, self.config['ELASTICSEARCH_INDEX'], rows)
+
+    def add_file(self, name, stream):
+        # 保存時に改めて日時が付くため、アップロード時に付けた日時(YYYYmmdd_HHMMSS_)は取り除く
+        filename = secure_filename(re.sub(r'^\d{8}_\d{6}_', '', name))
+        if not filename or '.' not in filename or filename.rsplit('.', 1)[1].lower() not in self.config['ALLOWED_EXTENSIONS']:
+            self.counts['skipped'] += 1
+            return
+        stored, digest, _ = uploads.save_stream(self.config, self.user_folder, filename, stream, self.config['UPLOAD_MAX_SIZE'])
+        user_files.record_file(self.user_id, self.user_folder, stored, digest)
+        db.session.commit()
+        self.counts['files'] += 1
+
+
+def import_archive(config, user, fileobj, es_client=None, progress=print):
+    """
+    zipファイル(シーク可能なファイルオブジェクト)からメモとファイルを読み込み、ユーザーに追加する
+    es_clientを指定した場合は登録したメモをElasticsearchにも登録する。件数の辞書を返す
+    """
+    try:
+        zf = zipfile.ZipFile(fileobj)
+    except zipfile.BadZipFile:
+        raise ArchiveError('zipファイルを読み込めません。')
+
+    importer = _Importer(config, user, es_client, progress)
+    max_note_size = config['IMPORT_MAX_NOTE_SIZE']
+    with zf:
+        for info in zf.infolist():
+            if info.is_dir():
+                continue
+            folder, _, name = info.filename.partition('/')
+            if folder == 'notes' and name.endswith('.md') and '/' not in name:
+                if info.file_size > max_note_size:
+                    importer.counts['skipped'] += 1
+                    continue
+                with zf.open(info) as fh:
+                    text = fh.read(max_note_size + 1).decode('utf-8', errors='replace')
+                default_title = os.path.splitext(name)[0].partition('_')[2] or os.path.splitext(name)[0]
+                importer.add_note(*parse_note(text, default_title))
+            elif folder == 'files' and name and '/' not in name:
+                with zf.open(info) as fh:
+                    importer.add_file(name, fh)
+            elif info.filename != 'manifest.json':
+                importer.counts['skipped'] += 1
+        importer.flush_notes()
+    return importer.counts
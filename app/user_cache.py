@@ -0,0 +1,167 @@
+"""
+ログイン中のユーザー情報(Flask-Loginのuser_loaderで読み込むもの)をキャッシュするモジュール。
+リクエストのたびにusersテーブルを読まないよう、ワーカープロセス内のTTL付きLRUと、ワーカー間で共有するRedisの2段階でキャッシュする。
+パスワードの変更や管理画面での変更・削除の際は invalidate() で明示的に削除する。
+
+ログイン時にはパスワードの変更回数(usersテーブルのpassword_version)をセッションに記録し、
+読み込んだユーザーの値と一致しない場合(パスワードが変更された場合)はログインしていないものとして扱う。
+そのため、パスワードを変更すると、変更した画面以外のセッションはログアウトされる。
+ログイン時のハッシュ方式の更新ではハッシュが変わっても変更回数は増えないため、他のセッションはログアウトされない。
+"""
+
+# time: キャッシュの有効期限の判定に使用
+import time
+
+# json: Redisに保存するユーザー情報の変換に使用
+import json
+
+# threading: ワーカー内のキャッシュの排他制御に使用
+import threading
+
+from collections import OrderedDict
+
+from flask import session
+from flask_login import UserMixin
+
+from .models import db, User
+
+
+# ログイン時のパスワードの版を記録するセッションのキー
+SESSION_KEY = '_password_version'
+
+
+class AuthUser(UserMixin):
+    """
+    current_userとして使用する、ログイン中のユーザーの最小限の情報
+    データベースのセッションに紐付かないため、リクエストをまたいでキャッシュできる
+    パスワードの確認や変更など、usersテーブルの行が必要な場合は get_model() で読み込む
+    """
+
+    def __init__(self, id, username, password_version):
+        self.id = id
+        self.username = username
+        # パスワードの変更回数(パスワードが変更されると増える)
+        self.password_version = password_version
+
+    def get_model(self):
+        """usersテーブルの行を読み込む"""
+        return db.session.get(User, self.id)
+
+    def to_dict(self):
+        return {'id': self.id, 'username': self.username, 'password_version': self.password_version}
+
+
+def redis_key(user_id):
+    """Redisに保存するユーザー情報のキー(検索サービス(async_search.py)もパスワードの変更回数の確認に使用する)"""
+    return f"auth_user:{user_id}"
+
+
+class UserCache:
+    """ワーカー内のTTL付きLRUと、Redis(設定されている場合)の2段階のキャッシュ"""
+
+    def __init__(self, max_entries=1024, ttl=30, redis_client=None, redis_ttl=3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.redis = redis_client
+        self.redis_ttl = redis_ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                expires, user = entry
+                if expires > now:
+                    self._entries.move_to_end(user_id)
+                    return user
+                del self._entries[user_id]
+
+        if self.redis is not None:
+            try:
+                value = self.redis.get(redis_key(user_id))
+            except Exception:
+                value = None
+            if value is not None:
+                user = AuthUser(**json.loads(value))
+                self._store_local(user_id, user)
+                return user
+        return None
+
+    def set(self, user):
+        self._store_local(user.id, user)
+        if self.redis is not None:
+            try:
+                self.redis.set(redis_key(user.id), json.dumps(user.to_dict()), ex=self.redis_ttl)
+            except Exception:
+                pass
+
+    def delete(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+        if self.redis is not None:
+            try:
+                self.redis.delete(redis_key(user_id))
+            except Exception:
+                pass
+
+    def _store_local(self, user_id, user):
+        with self._lock:
+            self._entries[user_id] = (time.monotonic() + self.ttl, user)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+_cache = UserCache()
+
+
+def load_user(user_id):
+    """Flask-Loginのuser_loader。キャッシュになければusersテーブルから必要な列だけを読み込む"""
+    user_id = int(user_id)
+    user = _cache.get(user_id)
+    if user is None:
+        row = db.session.execute(
+            db.select(User.id, User.username, User.password_version).where(User.id == user_id)
+        ).first()
+        if row is None:
+            return None
+        user = AuthUser(row.id, row.username, row.password_version)
+        _cache.set(user)
+
+    expected = session.get(SESSION_KEY)
+    if expected is None:
+        # 版を記録する前に作られたセッションは、現在の版を記録して引き続き使用する
+        session[SESSION_KEY] = user.password_version
+    elif expected != user.password_version:
+        # ログインした後にパスワードが変更された
+        return None
+    return user
+
+
+def bind_session(user):
+    """
+    現在のパスワードの版をセッションに記録する(login_userの後と、パスワードを変更したセッションで呼び出す)
+    userはusersテーブルの行(User)
+    """
+    session[SESSION_KEY] = user.password_version
+
+
+def invalidate(user_id):
+    """
+    ユーザー情報のキャッシュを削除する(パスワードの変更、管理画面での変更・削除の後に呼び出す)
+    他のワーカー内のキャッシュはUSER_CACHE_TTL秒以内に期限切れになる
+    """
+    _cache.delete(int(user_id))
+
+
+def init_app(app):
+    """設定に応じてキャッシュを作成する"""
+    global _cache
+    _cache = UserCache(
+        max_entries=app.config['USER_CACHE_MAX_ENTRIES'],
+        ttl=app.config['USER_CACHE_TTL'],
+        redis_client=app.config['SESSION_REDIS'],
+        redis_ttl=app.config['USER_CACHE_REDIS_TTL'],
+    )
@@ -0,0 +1,146 @@
+"""
+アップロードされたファイルの情報(filesテーブル)とユーザーごとの使用容量(user_storageテーブル)を管理するモジュール。
+ファイルの追加・削除のたびにテーブルを更新し、ファイル一覧はディレクトリを走査せずにインデックス付きの問い合わせで取得する。
+ディレクトリに直接置かれたファイルなど、アプリケーションを経由しない変更は reconcile() で取り込む。
+"""
+
+# os: ファイル情報の取得やディレクトリの走査に使用
+import os
+
+from datetime import datetime, timezone
+
+from sqlalchemy import func, tuple_, update
+
+from .models import db, User, UserFile, UserStorage
+from .search import encode_cursor, decode_cursor
+
+# ファイル一覧で並び替えに使用できる列
+SORT_COLUMNS = {
+    'modified': UserFile.modified_at,
+    'name': UserFile.filename,
+    'size': UserFile.size,
+}
+
+
+def _adjust_usage(user_id, count_delta, bytes_delta):
+    """ユーザーの使用容量を差分で更新する(行がなければ作成)"""
+    result = db.session.execute(
+        update(UserStorage)
+        .where(UserStorage.user_id == user_id)
+        .values(file_count=UserStorage.file_count + count_delta, total_bytes=UserStorage.total_bytes + bytes_delta)
+    )
+    if result.rowcount == 0:
+        db.session.add(UserStorage(user_id=user_id, file_count=count_delta, total_bytes=bytes_delta))
+
+
+def record_file(user_id, user_folder, filename, digest=None):
+    """アップロードされたファイルをテーブルに登録する(呼び出し側でコミットする)"""
+    size = os.stat(os.path.join(user_folder, filename)).st_size
+    db.session.add(UserFile(user_id=user_id, filename=filename, size=size, digest=digest))
+    _adjust_usage(user_id, 1, size)
+
+
+def remove_file(user_id, filename):
+    """ファイルをテーブルから削除し、削除した行(登録されていなければNone)を返す(呼び出し側でコミットする)"""
+    user_file = db.session.execute(
+        db.select(UserFile).where(UserFile.user_id == user_id, UserFile.filename == filename)
+    ).scalar()
+    if user_file is not None:
+        db.session.delete(user_file)
+        _adjust_usage(user_id, -1, -user_file.size)
+    return user_file
+
+
+def get_usage(user_id):
+    """ユーザーのファイル数と使用容量の合計を返す"""
+    usage = db.session.get(UserStorage, user_id)
+    return (usage.file_count, usage.total_bytes) if usage else (0, 0)
+
+
+def list_files(user_id, sort='modified', order='desc', query=None, cursor=None, per_page=50):
+    """
+    ユーザーのファイルを1ページ分取得し、(ファイルのリスト, 次ページのカーソル)を返す
+    (user_id, 並び替えの列, id)のインデックスを使ったキーセットページネーションで取得する
+    """
+    column = SORT_COLUMNS.get(sort, UserFile.modified_at)
+    descending = order != 'asc'
+
+    stmt = db.select(UserFile).where(UserFile.user_id == user_id)
+    if query:
+        # ユーザー自身のファイルの範囲内でファイル名の部分一致検索を行う
+        escaped = query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        stmt = stmt.where(UserFile.filename.ilike(f"%{escaped}%", escape='\\'))
+
+    after = decode_cursor(cursor)
+    if after and len(after) == 2:
+        value = datetime.fromisoformat(after[0]) if column is UserFile.modified_at else after[0]
+        key = tuple_(column, UserFile.id)
+        stmt = stmt.where(key < tuple_(value, after[1]) if descending else key > tuple_(value, after[1]))
+
+    if descending:
+        stmt = stmt.order_by(column.desc(), UserFile.id.desc())
+    else:
+        stmt = stmt.order_by(column.asc(), UserFile.id.asc())
+
+    # 次ページの有無を判定するために1件多く取得する
+    files = db.session.execute(stmt.limit(per_page + 1)).scalars().all()
+    next_cursor = None
+    if len(files) > per_page:
+        files = files[:per_page]
+        last = files[-1]
+        value = getattr(last, column.key)
+        next_cursor = encode_cursor([value.isoformat() if isinstance(value, datetime) else value, last.id])
+    return files, next_cursor
+
+
+def reconcile(config, username=None, progress=print, batch_size=1000):
+    """
+    アップロード用ディレクトリの内容とfilesテーブルを突き合わせ、差分を反映する
+    ディレクトリに直接置かれたファイルの登録、存在しないファイルの削除、使用容量の再計算を行う
+    """
+    stmt = db.select(User.id, User.username).order_by(User.id)
+    if username:
+        stmt = stmt.where(User.username == username)
+    for user_id, name in db.session.execute(stmt).all():
+        user_folder = os.path.join(config['UPLOAD_FOLDER'], name)
+        on_disk = {}
+        if os.path.isdir(user_folder):
+            for entry in os.scandir(user_folder):
+                if entry.is_file():
+                    stat = entry.stat()
+                    on_disk[entry.name] = (stat.st_size, stat.st_mtime)
+
+        known = {
+            row.filename: row
+            for row in db.session.execute(db.select(UserFile).where(UserFile.user_id == user_id)).scalars()
+        }
+        added = removed = changed = pending = 0
+        for filename, (size, mtime) in on_disk.items():
+            row = known.pop(filename, None)
+            if row is None:
+                modified_at = datetime.fromtimestamp(mtime, timezone.utc).replace(tzinfo=None)
+                db.session.add(UserFile(user_id=user_id, filename=filename, size=size, modified_at=modified_at))
+                added += 1
+                pending += 1
+            elif row.size != size:
+                row.size = size
+                changed += 1
+                pending += 1
+            if pending >= batch_size:
+                db.session.commit()
+                pending = 0
+        for row in known.values():
+            db.session.delete(row)
+            removed += 1
+        db.session.flush()
+
+        # 使用容量はテーブルから数え直す
+        file_count, total_bytes = db.session.execute(
+            db.select(func.count(UserFile.id), func.coalesce(func.sum(UserFile.size), 0)).where(UserFile.user_id == user_id)
+        ).one()
+        usage = db.session.get(UserStorage, user_id) or UserStorage(user_id=user_id)
+        usage.file_count = file_count
+        usage.total_bytes = total_bytes
+        db.session.add(usage)
+        db.session.commit()
+        progress(f"{name}: 追加 {added} 件 / 更新 {changed} 件 / 削除 {removed} 件 (合計 {file_count} 件, {total_bytes} バイト)")
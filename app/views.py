@@ -9,6 +9,12 @@ import os
 # base64: バイナリデータをASCII文字列にエンコード/デコードするために使用。ファイルの埋め込みなどに使われる(本アプリでは画像のペーストで取り扱う)
 import base64
 
+# io: Base64形式で送信された画像を、ストリームとして保存処理に渡すために使用
+import io
+
+# SimpleNamespace: 保存できなかった編集内容を、メモと同じ形で編集画面に渡すために使用
+from types import SimpleNamespace
+
 # uuid: Universally Unique Identifier（普遍的識別子）を生成するために使用
 # 一意なファイル名やIDの生成(本アプリではスクリーンショットをペーストした際に自動保存される際に生成)
 import uuid
@@ -25,12 +31,11 @@ from datetime import date, datetime, timedelta, timezone
 # secure_filename: アップロードされたファイル名を安全にするために使用し、ファイル名に含まれる可能性のある悪意のある文字を除去
 from werkzeug.utils import secure_filename
 
-# generate_password_hash: パスワードをハッシュ化するために使用
-# check_password_hash: ハッシュ化されたパスワードと入力されたパスワードが一致するかどうかを確認するために使用
-from werkzeug.security import generate_password_hash, check_password_hash
 
-# elasticsearch用 エラー処理
-from elasticsearch import NotFoundError
+# undefer: 遅延ロード(deferred)に設定した本文を、必要な画面でのみ同時に読み込むために使用
+# StaleDataError: 編集中に他の画面でメモが更新されていた場合(リビジョン番号の不一致)の検知に使用
+from sqlalchemy.orm import undefer
+from sqlalchemy.orm.exc import StaleDataError
 
 # render_template: 指定されたJinja2テンプレートをレンダリングするために使用することでHTMLファイルを動的に生成
 # request: クライアントからのHTTPリクエストに関するデータ（フォームデータ、ファイルなど）を扱うために使用
@@ -43,9 +48,10 @@ from elasticsearch import NotFoundError
 # make_response: HTTPレスポンスを明示的に作成するために使用。カスタムヘッダーの設定などで使用
 # get_flashed_messages: flashで設定されたメッセージを取得するため
 # Blueprint: ルート定義をグループ化
+# Response, stream_with_context: 作成しながら送信するレスポンス(エクスポートのzipファイル)に使用
 from flask import (
     render_template, request, redirect, url_for, flash, send_from_directory,
-    session, jsonify, make_response, Blueprint, current_app
+    session, jsonify, make_response, Blueprint, current_app, Response, stream_with_context
 )
 
 # login_user: ユーザーをログイン状態にするために使用
@@ -54,9 +60,9 @@ from flask import (
 # logout_user: 現在のユーザーをログアウトするために使用
 from flask_login import login_user, login_required, current_user, logout_user
 
-# __init__.pyで初期化されたesと、models.pyのdbとモデルをインポート
-from . import es
-from .models import db, User, Note
+# 検索サービスと、models.pyのdbとモデルをインポート
+from . import search, markdown_render, uploads, user_files, images, note_revisions, user_cache, suggestions, note_patch, passwords, user_archive
+from .models import db, User, Note, UserFile
 from .forms import LoginForm, RegisterForm
 
 # Blueprintを作成
@@ -72,21 +78,33 @@ def allwed_file(filename):
            filename.rsplit('.', 1)[1].lower() in current_app.config['ALLOWED_EXTENSIONS']
 
 
-def sync_note_to_elasticsearch(note):
-    """メモをElasticsearchに同期するヘルパー関数"""
-    try:
-        es.index(index=current_app.config['ELASTICSEARCH_INDEX'], id=note.id, document={
-            'id': note.id,
-            'title': note.title,
-            'content': note.content,
-            'date': note.date.isoformat() if isinstance(note.date, date) else note.date, # 日付形式を適切に処理
-            'user_id': note.user_id
-        })
-        return True, "ノートがElasticsearchに同期されました。"
-    except Exception as e:
-        current_app.logger.error(f"Elasticsearch synchronization error: {e}")
-        return False, f"ノートの更新はできましたが、Elasticsearch同期中にエラーが発生しました: {e}"
+def _get_per_page():
+    """リクエストのper_pageパラメータから1ページあたりの件数を取得(上限あり)"""
+    per_page = request.args.get('per_page', type=int) or current_app.config['NOTES_PER_PAGE']
+    return max(1, min(per_page, current_app.config['NOTES_MAX_PER_PAGE']))
+
+def _get_date_range(values):
+    """リクエストのdate_from, date_toパラメータ('YYYY-MM-DD')から作成日の範囲を取得(不正な値は指定なしとする)"""
+    return search.parse_date(values.get('date_from')), search.parse_date(values.get('date_to'))
 
+def _date_range_args(date_from, date_to):
+    """ページ送りのURLに引き継ぐ作成日の範囲のパラメータ"""
+    args = {}
+    if date_from:
+        args['date_from'] = date_from.isoformat()
+    if date_to:
+        args['date_to'] = date_to.isoformat()
+    return args
+
+
+def _select_note_summaries(stmt):
+    """
+    一覧表示用にメモの要約(id, title, date, プレビュー)のみを取得するヘルパー関数
+    本文全体は読み込まず、SQLのsubstrで先頭部分だけを取得する
+    """
+    length = current_app.config['NOTE_PREVIEW_LENGTH']
+    stmt = stmt.add_columns(*search.note_summary_columns(length)).order_by(Note.id.desc())
+    return [search.note_summary(row, length) for row in db.session.execute(stmt)]
 
 # @bp.before_app_request
 # def before_request():
@@ -115,8 +133,14 @@ def login():
     login_form = LoginForm()
     if login_form.validate_on_submit():
         user_result = db.session.execute(db.select(User).where(User.username == login_form.username.data)).scalar()
-        if user_result and check_password_hash(user_result.password, login_form.password.data):
+        if user_result and passwords.verify_password(user_result.password, login_form.password.data):
+            if passwords.needs_upgrade(user_result.password):
+                # 以前の方式・コストで保存されたハッシュを、設定された方式で作り直す
+                # パスワード自体は変わらないため、変更回数(password_version)は増やさず、他のセッションもログアウトさせない
+                user_result.password = passwords.hash_password(login_form.password.data)
+                db.session.commit()
             login_user(user_result)
+            user_cache.bind_session(user_result)
             # current_app.permanent_session_lifetime = timedelta(weeks=48)
             # response = make_response(redirect(url_for('views.home')))
             # response.set_cookie('user_id', str(user_result.id), max_age=timedelta(days=365), httponly=True, samesite='Lax')
@@ -126,6 +150,12 @@ def login():
             flash("ユーザー名またはパスワードが正しくありません。", "danger")
     return render_template("login.html", form=login_form)
 
+@bp.errorhandler(passwords.PasswordHashBusy)
+def handle_password_hash_busy(e):
+    """パスワードのハッシュ計算が混み合っている場合は、待たせずに503を返す"""
+    return ("ただいまログインが混み合っています。しばらくしてからもう一度お試しください。", 503,
+            {'Retry-After': str(current_app.config['PASSWORD_HASH_RETRY_AFTER'])})
+
 @bp.route('/ForgeGrid/register', methods=['GET', 'POST'])
 def register():
     """ユーザー登録を処理するルート"""
@@ -138,11 +168,12 @@ def register():
         with current_app.app_context():
             new_user = User(
                 username=register_form.username.data,
-                password=generate_password_hash(register_form.password.data, method="pbkdf2", salt_length=8),
+                password=passwords.hash_password(register_form.password.data),
             )
             db.session.add(new_user)
             db.session.commit()
             login_user(new_user)
+            user_cache.bind_session(new_user)
             user_upload_folder = os.path.join(current_app.config['UPLOAD_FOLDER'], new_user.username)
             os.makedirs(user_upload_folder, exist_ok=True)
         flash("ユーザー登録が完了しました。", "success")
@@ -169,125 +200,201 @@ def home():
     os.makedirs(user_upload_folder, exist_ok=True)
     
     SearchText = request.args.get('search', '').strip()
-    notes_result = []
-
-    # 検索クエリがない場合は常にPostgreSQLからデータを取得
-    notes_result = db.session.execute(
-        db.select(Note)
-        .where(Note.user_id == current_user.id)
-        .order_by(Note.id.desc())
-    ).scalars().all()
-
-    # コンテンツプレビューの生成
-    for note in notes_result:
-        note.content_preview = (note.content[:75] + "...") if len(note.content) > 75 else note.content
+    per_page = _get_per_page()
+    # 作成日の範囲での絞り込み(検索・一覧のどちらも(user_id, date)のインデックスを使用)
+    date_from, date_to = _get_date_range(request.args)
+    range_args = _date_range_args(date_from, date_to)
+    next_url = None
+    first_url = None
 
     if SearchText:
-        # 検索クエリがある場合のみElasticsearchを使用
+        # 検索クエリがある場合のみ検索バックエンド(Elasticsearchなど)を使用(ページ送りはカーソルで行う)
+        cursor = request.args.get('after')
+        notes_result = []
         try:
-            search_body = {
-                "query": {
-                    "bool": {
-                        "must": [{"term": {"user_id": current_user.id}}],
-                        "should": [
-                            {"match": {"title": {"query": SearchText, "fuzziness": "AUTO"}}},
-                            {"match": {"content": {"query": SearchText, "fuzziness": "AUTO"}}}
-                        ],
-                        "minimum_should_match": 1
-                    }
-                },
-                "sort": [{"date": {"order": "desc"}}]
-            }
-            res = es.search(index=current_app.config['ELASTICSEARCH_INDEX'], body=search_body)
-            # Elasticsearchの結果は辞書形式なので、ORMオブジェクトに変換する
-            note_ids = [hit['_source']['id'] for hit in res['hits']['hits']]
-            if note_ids:
-                notes_result = db.session.execute(db.select(Note).where(Note.id.in_(note_ids)).order_by(Note.id.desc())).scalars().all()
-            
+            notes_result, next_cursor = search.get_backend().search(current_user.id, SearchText, per_page, cursor, date_from, date_to)
+            if next_cursor:
+                next_url = url_for('views.home', search=SearchText, after=next_cursor, per_page=per_page, **range_args)
         except Exception as e:
             flash(f"検索中にエラーが発生しました: {e}", "danger")
-
-    return render_template('home.html', note_data=notes_result, logged_in=current_user.is_authenticated, logged_user=current_user.username)
+        if cursor:
+            first_url = url_for('views.home', search=SearchText, per_page=per_page, **range_args)
+    else:
+        # 検索クエリがない場合はPostgreSQLから(user_id, id DESC)順に1ページ分だけ取得
+        # キーセットページネーション: 前ページ最後のメモIDより小さいIDを取得する(OFFSETを使わない)
+        before_id = request.args.get('before', type=int)
+        notes_revision = db.session.execute(db.select(User.notes_revision).where(User.id == current_user.id)).scalar()
+        etag = note_revisions.make_etag('notes', current_user.id, notes_revision, before_id or '', per_page,
+                                        date_from or '', date_to or '')
+
+        def render_list():
+            stmt = db.select().where(Note.user_id == current_user.id, *search.date_range_condition(date_from, date_to))
+            if before_id:
+                stmt = stmt.where(Note.id < before_id)
+            # 次ページの有無を判定するために1件多く取得する
+            notes_result = _select_note_summaries(stmt.limit(per_page + 1))
+            next_url = None
+            if len(notes_result) > per_page:
+                notes_result = notes_result[:per_page]
+                next_url = url_for('views.home', before=notes_result[-1]['id'], per_page=per_page, **range_args)
+            first_url = url_for('views.home', per_page=per_page, **range_args) if before_id else None
+            return render_template('home.html', note_data=notes_result, logged_in=current_user.is_authenticated, logged_user=current_user.username,
+                                   next_url=next_url, first_url=first_url)
+
+        # メモに変更がなければ一覧を取得せずに304を返す
+        return note_revisions.conditional_page(etag, render_list)
+
+    return render_template('home.html', note_data=notes_result, logged_in=current_user.is_authenticated, logged_user=current_user.username,
+                           next_url=next_url, first_url=first_url)
 
 
 @bp.route('/ForgeGrid/search_notes_async', methods=['POST'])
 @login_required
 def search_notes_async():
     """非同期でのメモ検索を処理するルート"""
-    if not es:
-        return jsonify({'error': 'Elasticsearchサービスが利用できません。'}), 503
     try:
-        search_term = request.form.get('search', '').strip()
-        
-        if search_term:
-            query_body = {
-                "query": {
-                    "bool": {
-                        "filter": [{"term": {"user_id": current_user.id}}],
-                        "should": [
-                            {"match": {"title": {"query": search_term, "fuzziness": "AUTO"}}},
-                            {"match": {"content": {"query": search_term, "fuzziness": "AUTO"}}}
-                        ],
-                        "minimum_should_match": 1
-                    }
-                },
-                "sort": [{"date": {"order": "desc"}}]
-            }
-        else:
-            query_body = {
-                "query": {"term": {"user_id": current_user.id}},
-                "sort": [{"date": {"order": "desc"}}]
-            }
-        
-        res = es.search(index=current_app.config['ELASTICSEARCH_INDEX'], body=query_body)
-        notes_data = []
-        for hit in res['hits']['hits']:
-            source = hit['_source']
-            notes_data.append({
-                'id': source['id'],
-                'title': source['title'],
-                'content_preview': (source['content'][:75] + '...') if len(source['content']) > 75 else source['content'],
-                'date': source['date']
-            })
-        return jsonify(notes_data)
+        notes_data, next_cursor = search.get_backend().search(
+            current_user.id, request.form.get('search', '').strip(), _get_per_page(), request.form.get('after'),
+            *_get_date_range(request.form),
+        )
+        return jsonify({'notes': notes_data, 'next_after': next_cursor})
     except Exception as e:
-        current_app.logger.error(f"Elasticsearch search error: {e}")
+        current_app.logger.error(f"Search error: {e}")
         return jsonify({'error': f'検索中にエラーが発生しました: {e}'}), 500
 
+@bp.route('/ForgeGrid/suggest')
+@login_required
+def suggest():
+    """検索ボックスへの入力中に表示する候補(タイトルの前方一致)を返すルート"""
+    try:
+        return jsonify({'suggestions': suggestions.get_suggestions(current_user.id, request.args.get('q', ''))})
+    except Exception as e:
+        current_app.logger.error(f"Suggest error: {e}")
+        return jsonify({'error': f'候補の取得中にエラーが発生しました: {e}'}), 500
+
+def _get_note_revision(note_id):
+    """メモの所有者とリビジョン番号のみを取得する(本文は読み込まない)。アクセスできない場合はNone"""
+    row = db.session.execute(db.select(Note.user_id, Note.revision).where(Note.id == note_id)).first()
+    if row is None or row.user_id != current_user.id:
+        return None
+    return row.revision
+
+def _save_note(note_result, template):
+    """
+    フォームの内容でメモを更新する
+    編集画面を開いた後に他の画面で更新されていた場合は保存せず、入力内容を残したまま編集画面を表示し直す(409)
+    """
+    expected = request.form.get('revision', type=int)
+    if note_result.title == request.form['title'] and note_result.content == request.form['content']:
+        # 内容が変わっていなければ、データベースへの書き込みも検索インデックスの更新も行わない
+        flash("ノートに変更はありません。", "info")
+        return None
+    if expected is None or expected == note_result.revision:
+        note_result.title = request.form['title']
+        note_result.content = request.form['content']
+        try:
+            # 検索インデックスへの反映はアウトボックス経由で非同期に行われる
+            db.session.commit()
+            flash("ノートが更新されました。", "success")
+            return None
+        except StaleDataError:
+            # 読み込んでから保存するまでの間に他で更新された
+            db.session.rollback()
+    current = db.session.get(Note, note_result.id)
+    if current is None:
+        flash("ノートが見つからないか、アクセス権がありません。", "danger")
+        return redirect(url_for('views.home'))
+    flash("このノートは別の画面で更新されています。最新の内容を確認してから保存し直してください。", "danger")
+    # 入力内容を残し、リビジョン番号は最新のものにして再度保存できるようにする
+    note_data = SimpleNamespace(id=current.id, title=request.form['title'], content=request.form['content'],
+                                date=current.date, revision=current.revision)
+    return render_template(template, note_data=note_data), 409
+
 @bp.route("/ForgeGrid/note_edit/<int:note_id>", methods=["GET", "POST"])
 @login_required
 def note_edit(note_id):
     """既存のメモを編集するためのルート"""
-    note_result = db.session.get(Note, note_id)
-    if not note_result or note_result.user_id != current_user.id:
+    revision = _get_note_revision(note_id)
+    if revision is None:
         flash("ノートが見つからないか、アクセス権がありません。", "danger")
         return redirect(url_for('views.home'))
     if request.method == 'GET':
-        return render_template('note.html', note_data=note_result)
+        # メモが変更されていなければ本文を読み込まずに304を返す
+        return note_revisions.conditional_page(
+            note_revisions.make_etag('note_edit', note_id, revision),
+            lambda: render_template('note.html', note_data=db.session.get(Note, note_id, options=[undefer(Note.content)])),
+        )
     else:
-        note_result.title = request.form['title']
-        note_result.content = request.form['content']
-        db.session.commit()
-        success, message = sync_note_to_elasticsearch(note_result)
-        flash(message, "success" if success else "danger")
+        note_result = db.session.get(Note, note_id, options=[undefer(Note.content)])
+        conflict = _save_note(note_result, 'note.html')
+        if conflict is not None:
+            return conflict
         return render_template('preview.html', note_data=note_result)
 
+@bp.route("/ForgeGrid/api/notes/<int:note_id>", methods=["PATCH"])
+@login_required
+def note_patch_api(note_id):
+    """
+    メモの差分保存(JSON)。ベースのリビジョンの本文に対する置き換え操作を受け取り、サーバー側で適用する
+    {"base_revision": 1, "title": "...", "ops": [{"start": 0, "end": 3, "text": "..."}], "length": 適用後の本文の長さ}
+    titleとopsは省略でき、内容が変わらない場合はデータベースへの書き込みも検索インデックスの更新も行わない
+    """
+    payload = request.get_json(silent=True)
+    if (not isinstance(payload, dict) or not isinstance(payload.get('base_revision'), int)
+            or not isinstance(payload.get('ops', []), list)):
+        return jsonify({'error': 'リクエストの形式が正しくありません。'}), 400
+    revision = _get_note_revision(note_id)
+    if revision is None:
+        return jsonify({'error': 'ノートが見つからないか、アクセス権がありません。'}), 404
+    if payload['base_revision'] != revision:
+        return jsonify({'error': 'このノートは別の画面で更新されています。', 'revision': revision}), 409
+
+    note_result = db.session.get(Note, note_id, options=[undefer(Note.content)])
+    title = payload.get('title', note_result.title)
+    if not isinstance(title, str) or not title.strip() or len(title) > 250:
+        return jsonify({'error': 'タイトルが正しくありません。'}), 400
+    content = note_result.content
+    if payload.get('ops'):
+        base = note_patch.normalize_newlines(note_result.content)
+        try:
+            patched = note_patch.apply_patch(base, payload['ops'], payload.get('length'))
+        except note_patch.PatchError as e:
+            return jsonify({'error': f'差分を適用できませんでした: {e}'}), 422
+        # 改行コードの違いだけの場合は変更なしとする
+        if patched != base:
+            content = patched
+
+    if title == note_result.title and content == note_result.content:
+        return jsonify({'id': note_id, 'revision': revision, 'changed': False})
+    note_result.title = title
+    note_result.content = content
+    try:
+        # 検索インデックスへの反映はアウトボックス経由で非同期に行われる
+        db.session.commit()
+    except StaleDataError:
+        db.session.rollback()
+        return jsonify({'error': 'このノートは別の画面で更新されています。', 'revision': _get_note_revision(note_id)}), 409
+    return jsonify({'id': note_id, 'revision': note_result.revision, 'changed': True})
+
 @bp.route("/ForgeGrid/preview/<int:note_id>", methods=["GET", "POST"])
 @login_required
 def preview(note_id):
     """メモのプレビュー表示を処理するルート"""
-    note_result = db.session.get(Note, note_id)
-    if not note_result or note_result.user_id != current_user.id:
+    revision = _get_note_revision(note_id)
+    if revision is None:
         flash("ノートが見つからないか、アクセス権がありません。", "danger")
         return redirect(url_for('views.home'))
     if request.method == 'GET':
-        return render_template('preview.html', note_data=note_result)
+        # メモが変更されていなければ本文の読み込みとMarkdownの変換を行わずに304を返す
+        return note_revisions.conditional_page(
+            note_revisions.make_etag('preview', note_id, revision),
+            lambda: render_template('preview.html', note_data=db.session.get(Note, note_id, options=[undefer(Note.content)])),
+        )
     else:
-        note_result.title = request.form['title']
-        note_result.content = request.form['content']
-        db.session.commit()
-        success, message = sync_note_to_elasticsearch(note_result)
-        flash(message, "success" if success else "danger")
+        note_result = db.session.get(Note, note_id, options=[undefer(Note.content)])
+        conflict = _save_note(note_result, 'note.html')
+        if conflict is not None:
+            return conflict
         return redirect(url_for('views.home'))
 
 @bp.route("/ForgeGrid/note_create", methods=["GET", "POST"])
@@ -302,11 +409,11 @@ def note_create():
                 title=request.form['title'],
                 content=request.form['content'],
                 date=date.today(), # dateオブジェクトとして保存
-                user=current_user)
+                user_id=current_user.id)
             db.session.add(new_note)
+            # 検索インデックスへの反映はアウトボックス経由で非同期に行われる
             db.session.commit()
-            success, message = sync_note_to_elasticsearch(new_note)
-            flash(message, "success" if success else "danger")
+            flash("ノートが作成されました。", "success")
         return redirect(url_for('views.home'))
 
 @bp.route("/ForgeGrid/note_delete/<int:note_id>", methods=["GET", "POST"])
@@ -318,40 +425,57 @@ def note_delete(note_id):
         flash("ノートが見つからないか、削除する権限がありません。", "danger")
         return redirect(url_for('views.home'))
 
+    # 削除もアウトボックス経由で検索インデックスへ反映される
     db.session.delete(note_to_delete)
     db.session.commit()
-    try:
-        es.delete(index=current_app.config['ELASTICSEARCH_INDEX'], id=note_id)
-        flash("ノートが削除され、Elasticsearchからも削除されました。", "success")
-    except NotFoundError:
-        flash("ノートは削除されましたが、Elasticsearchから見つかりませんでした。", "warning")
-    except Exception as e:
-        flash(f"ノートの削除はできましたが、Elasticsearchからの削除中にエラーが発生しました: {e}", "danger")
+    flash("ノートが削除されました。", "success")
     return redirect(url_for('views.home'))
 
+@bp.route('/ForgeGrid/markdown_cache_stats')
+@login_required
+def markdown_cache_stats():
+    """Markdown変換のブロックキャッシュのヒット・ミス回数を返すルート(このワーカープロセス分)"""
+    return jsonify(markdown_render.cache_stats())
+
 # --- ファイル操作関連 ---
 @bp.route('/ForgeGrid/file_upload')
 @login_required
 def file_upload():
-    """ファイルアップロード機能の操作画面を表示するルート"""
-    user_upload_folder = os.path.join(current_app.config['UPLOAD_FOLDER'], current_user.username)
-    os.makedirs(user_upload_folder, exist_ok=True)
-    
+    """ファイルアップロード機能の操作画面を表示するルート(filesテーブルからページ単位で取得)"""
+    sort = request.args.get('sort', 'modified')
+    if sort not in user_files.SORT_COLUMNS:
+        sort = 'modified'
+    order = 'asc' if request.args.get('order') == 'asc' else 'desc'
+    query = request.args.get('q', '').strip()
+    files, next_cursor = user_files.list_files(
+        current_user.id, sort=sort, order=order, query=query,
+        cursor=request.args.get('after'), per_page=_get_per_page(),
+    )
+
     directory_files = []
-    for file in os.listdir(user_upload_folder):
-        file_path = os.path.join(user_upload_folder, file)
-        if os.path.isfile(file_path):
-            stat = os.stat(file_path)
-            directory_files.append({
-                'filename': file,
-                'size': humanize.naturalsize(stat.st_size),
-                'modified_time': datetime.fromtimestamp(stat.st_mtime).strftime('%Y年%m月%d日 %H:%M:%S')
-            })
-    return render_template('file_index.html', directory_files=directory_files)
+    for file in files:
+        # 更新日時はUTCで保存しているため、サーバーのローカル時刻に変換して表示する
+        modified_time = file.modified_at.replace(tzinfo=timezone.utc).astimezone()
+        directory_files.append({
+            'filename': file.filename,
+            'size': humanize.naturalsize(file.size),
+            'modified_time': modified_time.strftime('%Y年%m月%d日 %H:%M:%S')
+        })
+
+    file_count, total_bytes = user_files.get_usage(current_user.id)
+    list_args = {'sort': sort, 'order': order}
+    if query:
+        list_args['q'] = query
+    next_url = url_for('views.file_upload', after=next_cursor, **list_args) if next_cursor else None
+    first_url = url_for('views.file_upload', **list_args) if request.args.get('after') else None
+    return render_template('file_index.html', directory_files=directory_files,
+                           file_count=file_count, total_size=humanize.naturalsize(total_bytes),
+                           sort=sort, order=order, query=query, next_url=next_url, first_url=first_url)
 
 @bp.route('/ForgeGrid/upload_file', methods=["POST"])
+@login_required
 def upload():
-    """ファイルのアップロードを処理するルート"""
+    """ファイルのアップロードを処理するルート(チャンクアップロードを使わないフォーム送信用)"""
     file = request.files.get('file')
     if not file or file.filename == '' or not allwed_file(file.filename):
         flash('無効なファイルがアップロードされました。', 'danger')
@@ -359,74 +483,197 @@ def upload():
     
     filename = secure_filename(file.filename)
     user_upload_folder = os.path.join(current_app.config['UPLOAD_FOLDER'], current_user.username)
-    save_path = os.path.join(user_upload_folder, datetime.now().strftime("%Y%m%d_%H%M%S_") + filename)
-    file.save(save_path)
+    # 上限を超えた場合はUploadError(413)となり、チャンクアップロードと同じくエラーを返す
+    name, digest, _ = uploads.save_stream(current_app.config, user_upload_folder, filename, file.stream,
+                                          max_size=current_app.config['UPLOAD_MAX_SIZE'])
+    user_files.record_file(current_user.id, user_upload_folder, name, digest)
+    db.session.commit()
+    if images.has_derivatives(name):
+        images.schedule_derivatives(digest)
     flash("ファイルがアップロードされました。", "success")
     return redirect(url_for('views.file_upload'))
 
+# --- チャンクアップロード(再開可能なアップロード)関連 ---
+@bp.errorhandler(uploads.UploadError)
+def handle_upload_error(e):
+    """アップロード処理のエラーをJSONで返す"""
+    return jsonify({'error': str(e)}), e.status
+
+@bp.route('/ForgeGrid/uploads', methods=['POST'])
+@login_required
+def upload_session_create():
+    """チャンクアップロードを開始するルート。ファイル名とサイズを受け取り、アップロードIDとチャンクサイズを返す"""
+    data = request.get_json(silent=True) or {}
+    filename = secure_filename(str(data.get('filename', '')))
+    size = data.get('size')
+    if not filename or not allwed_file(filename) or not isinstance(size, int):
+        return jsonify({'error': '無効なファイルがアップロードされました。'}), 400
+    return jsonify(uploads.create_session(current_app.config, current_user.id, filename, size)), 201
+
+@bp.route('/ForgeGrid/uploads/<upload_id>', methods=['GET'])
+@login_required
+def upload_session_status(upload_id):
+    """受信済みのチャンク番号を返すルート(中断したアップロードの再開に使用)"""
+    return jsonify(uploads.load_session(current_app.config, upload_id, current_user.id))
+
+@bp.route('/ForgeGrid/uploads/<upload_id>/chunks/<int:index>', methods=['PUT'])
+@login_required
+def upload_chunk(upload_id, index):
+    """チャンクを受信するルート。リクエストボディをそのままディスクへ書き込む"""
+    uploads.write_chunk(current_app.config, upload_id, current_user.id, index, request.stream)
+    return jsonify({'received': index})
+
+@bp.route('/ForgeGrid/uploads/<upload_id>/complete', methods=['POST'])
+@login_required
+def upload_session_complete(upload_id):
+    """すべてのチャンクを受信した後にファイルを保存するルート"""
+    user_upload_folder = os.path.join(current_app.config['UPLOAD_FOLDER'], current_user.username)
+    result = uploads.complete_session(current_app.config, upload_id, current_user.id, user_upload_folder)
+    user_files.record_file(current_user.id, user_upload_folder, result['filename'], result['digest'])
+    db.session.commit()
+    if images.has_derivatives(result['filename']):
+        images.schedule_derivatives(result['digest'])
+    flash("ファイルがアップロードされました。", "success")
+    return jsonify(result)
+
 @bp.route('/ForgeGrid/download/<string:file>')
 @login_required
 def download(file):
     """ファイルのダウンロードを処理するルート"""
-    user_upload_folder = os.path.join(current_app.config['UPLOAD_FOLDER'], current_user.username)
-    return send_from_directory(user_upload_folder, file, as_attachment=True)
+    return uploads.send_user_file(current_app.config, current_user.username, file, as_attachment=True)
 
 @bp.route('/ForgeGrid/delete/<string:file>')
 @login_required
 def delete(file):
     """ファイルを削除するルート"""
     user_upload_folder = os.path.join(current_app.config['UPLOAD_FOLDER'], current_user.username)
-    delete_file_path = os.path.join(user_upload_folder, secure_filename(file))
+    filename = secure_filename(file)
+    delete_file_path = os.path.join(user_upload_folder, filename)
+    removed = user_files.remove_file(current_user.id, filename)
     if os.path.exists(delete_file_path) and os.path.isfile(delete_file_path):
         os.remove(delete_file_path)
         flash("ファイルが削除されました。", "success")
     else:
         flash("ファイルが見つかりません。", "danger")
+    db.session.commit()
+    if removed is not None and removed.digest:
+        uploads.release_object(current_app.config, removed.digest)
     return redirect(url_for('views.file_upload'))
 
+def _send_markdown_image(filename):
+    """Markdown内で参照される画像を送信する(ブラウザにキャッシュさせ、再表示時は304で応答する)"""
+    return uploads.send_user_file(current_app.config, current_user.username, secure_filename(filename),
+                                  max_age=current_app.config['USER_IMAGE_MAX_AGE'])
+
 @bp.route('/ForgeGrid/preview/<filename>')
 @login_required
 def preview_Markdown_imagefile(filename):
     """Markdown内で参照される画像を直接表示するためのルート"""
-    user_upload_folder = os.path.join(current_app.config['UPLOAD_FOLDER'], current_user.username)
-    return send_from_directory(user_upload_folder, secure_filename(filename))
+    return _send_markdown_image(filename)
 
 @bp.route('/ForgeGrid/note_edit/<filename>')
 @login_required
 def note_edit_Markdown_imagefile(filename):
     """Markdown内で参照される画像を直接表示するためのルート"""
-    user_upload_folder = os.path.join(current_app.config['UPLOAD_FOLDER'], current_user.username)
-    return send_from_directory(user_upload_folder, secure_filename(filename))
+    return _send_markdown_image(filename)
 
 @bp.route('/ForgeGrid/<filename>')
 @login_required
 def Markdown_imagefile(filename):
     """Markdown内で参照される画像を直接表示するためのルート"""
-    user_upload_folder = os.path.join(current_app.config['UPLOAD_FOLDER'], current_user.username)
-    return send_from_directory(user_upload_folder, secure_filename(filename))
+    return _send_markdown_image(filename)
+
+@bp.route('/ForgeGrid/images/<filename>/<int:width>.webp')
+@login_required
+def image_derivative(filename, width):
+    """Markdown内の画像のsrcsetから参照される、WebP版・縮小版の画像を返すルート"""
+    filename = secure_filename(filename)
+    user_file = db.session.execute(
+        db.select(UserFile).where(UserFile.user_id == current_user.id, UserFile.filename == filename)
+    ).scalar()
+    manifest = None
+    if user_file is not None and user_file.digest and images.has_derivatives(filename):
+        manifest = images.load_manifest(current_app.config, user_file.digest)
+        if manifest is None:
+            images.schedule_derivatives(user_file.digest)
+    if manifest is None:
+        # 派生ファイルの作成前(またはアプリを経由せずに置かれたファイル)は元の画像を返す
+        return uploads.send_user_file(current_app.config, current_user.username, filename)
+    return uploads.send_derived_file(current_app.config, user_file.digest, f"{images.pick_width(manifest, width)}.webp",
+                                     max_age=current_app.config['USER_IMAGE_MAX_AGE'])
 
 @bp.route('/ForgeGrid/upload_image', methods=['POST'])
 @login_required
 def upload_image():
-    """クリップボードからペーストされた画像をBase64形式で受け取り、画像ファイルとして保存し、Markdown形式の画像タグを返すAPIエンドポイント"""
-    data = request.get_json()
-    if 'image' not in data:
-        return jsonify({'error': '画像データがありません。'}), 400
-    
-    base64_image = data['image']
-    image_data = base64.b64decode(base64_image.split(',')[1])
-    
-    filename = f"{uuid.uuid4()}.png"
+    """
+    クリップボードからペーストされた画像を保存し、Markdown形式の画像タグを返すAPIエンドポイント
+    画像はリクエストボディ(image/png などのバイナリ)またはmultipart形式で受け取り、メモリに読み込まずにディスクへ書き込む
+    """
+    if request.mimetype == 'multipart/form-data':
+        file = request.files.get('image') or request.files.get('file')
+        if file is None:
+            return jsonify({'error': '画像データがありません。'}), 400
+        content_type, stream = file.mimetype, file.stream
+    elif request.mimetype == 'application/json':
+        # 以前のバージョンの画面から送信されるBase64形式にも対応する
+        data = request.get_json(silent=True) or {}
+        if 'image' not in data:
+            return jsonify({'error': '画像データがありません。'}), 400
+        header, _, base64_image = data['image'].partition(',')
+        content_type = header.split(';')[0].removeprefix('data:')
+        stream = io.BytesIO(base64.b64decode(base64_image))
+    else:
+        content_type, stream = request.mimetype, request.stream
+
+    extension = images.PASTE_CONTENT_TYPES.get(content_type)
+    if extension is None:
+        return jsonify({'error': '対応していない画像形式です。'}), 415
+
     user_upload_folder = os.path.join(current_app.config['UPLOAD_FOLDER'], current_user.username)
-    os.makedirs(user_upload_folder, exist_ok=True)
-    filesave_path = os.path.join(user_upload_folder, filename)
-    
-    with open(filesave_path, "wb") as fh:
-        fh.write(image_data)
-        
+    filename, digest, _ = uploads.save_stream(current_app.config, user_upload_folder, f"{uuid.uuid4()}.{extension}", stream,
+                                              max_size=current_app.config['PASTE_IMAGE_MAX_SIZE'])
+    user_files.record_file(current_user.id, user_upload_folder, filename, digest)
+    db.session.commit()
+    if images.has_derivatives(filename):
+        images.schedule_derivatives(digest)
+
     markdown = f"![ScreenShot]({filename})"
     return jsonify({'markdown': markdown})
 
+# --- エクスポート・インポート関連 ---
+@bp.route('/ForgeGrid/export')
+@login_required
+def export_data():
+    """ログイン中のユーザーのメモとファイルをzipファイルでダウンロードするルート(zipファイルは作成しながら送信する)"""
+    archive = user_archive.iter_export(current_app.config, current_user.id, current_user.username)
+    response = Response(stream_with_context(archive), mimetype='application/zip')
+    # ユーザー名は日本語などを含み得るため、ASCIIの代替の名前とUTF-8の名前(filename*)を付ける
+    response.headers['Content-Disposition'] = uploads.content_disposition(
+        f"forgegrid_{current_user.username}_{date.today():%Y%m%d}.zip")
+    return response
+
+@bp.route('/ForgeGrid/import', methods=['GET', 'POST'])
+@login_required
+def import_data():
+    """エクスポートしたzipファイルのメモとファイルを読み込むルート"""
+    if request.method == 'POST':
+        file = request.files.get('archive')
+        if not file or not file.filename:
+            flash("zipファイルを選択してください。", "warning")
+            return redirect(url_for('views.import_data'))
+        from . import get_es
+        es = get_es() if search.get_backend().uses_outbox else None
+        try:
+            counts = user_archive.import_archive(current_app.config, current_user.get_model(), file.stream, es,
+                                                 progress=current_app.logger.info)
+        except (user_archive.ArchiveError, uploads.UploadError) as e:
+            db.session.rollback()
+            flash(str(e), "danger")
+            return redirect(url_for('views.import_data'))
+        flash(f"メモ{counts['notes']}件、ファイル{counts['files']}件を読み込みました。", "success")
+        return redirect(url_for('views.home'))
+    return render_template('data_transfer.html', logged_user=current_user.username)
+
 # --- パスワード変更関連 ---
 @bp.route('/ForgeGrid/change-password', methods=['GET', 'POST'])
 @login_required
@@ -436,7 +683,8 @@ def change_password():
         new_password = request.form.get('new_password')
         confirm_password = request.form.get('confirm_password')
 
-        if not check_password_hash(current_user.password, current_password):
+        user = current_user.get_model()
+        if not passwords.verify_password(user.password, current_password):
             flash('現在のパスワードが正しくありません。', category='danger')
             return redirect(url_for('views.change_password'))
 
@@ -448,8 +696,12 @@ def change_password():
             flash('パスワードは6文字以上で入力してください。', category='danger')
             return redirect(url_for('views.change_password'))
 
-        current_user.password = generate_password_hash(new_password, method='pbkdf2:sha256')
+        user.password = passwords.hash_password(new_password)
+        user.password_version += 1
         db.session.commit()
+        user_cache.invalidate(user.id)
+        # 変更したセッションはログインしたままにし、他のセッションはログアウトさせる
+        user_cache.bind_session(user)
         
         flash('パスワードが正常に変更されました。', category='success')
         return redirect(url_for('views.home'))
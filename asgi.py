@@ -0,0 +1,9 @@
+"""
+ForgeGridの検索サービス(asyncio)を起動させるためのpyファイル
+uvicorn asgi:app --host 0.0.0.0 --port 5001
+"""
+
+from app.async_search import create_async_app
+
+# 検索サービスのASGIアプリケーションを作成
+app = create_async_app()
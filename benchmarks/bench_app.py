@@ -0,0 +1,372 @@
+"""
+ForgeGridの負荷試験・ベンチマーク。
+外部のサービスを使わずに create_app() を起動し(データベースはSQLiteまたはローカルのPostgreSQL、Redisはfakeredis、
+全文検索はデータベースの全文検索)、合成したユーザー・メモ・アップロードファイルを投入した上で、
+主要なエンドポイントに複数のクライアントから同時にリクエストを送り、レイテンシ(p50/p95/p99)・スループット・
+最大メモリ使用量(RSS)をエンドポイントごとにJSONで保存する。
+
+実行例:
+    python benchmarks/bench_app.py --users 5 --notes-per-user 500 --clients 8 --output bench.json
+    python benchmarks/bench_app.py --baseline bench.json   # p95が基準より悪化した場合は終了コード1
+"""
+
+# argparse: コマンドライン引数の解析に使用
+import argparse
+
+# os, sys, tempfile, shutil: 一時ディレクトリの作成とアプリケーションのインポートに使用
+import os
+import sys
+import tempfile
+import shutil
+
+# json, platform, subprocess: 結果と実行環境の情報の保存に使用
+import json
+import platform
+import subprocess
+
+# random: 合成データの作成に使用(シードを固定して再現可能にする)
+import random
+
+# time, threading, resource: 時間・メモリ使用量の計測に使用
+import time
+import threading
+import resource
+
+# io: アップロードするファイルの作成に使用
+import io
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timezone
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ENDPOINTS = ['home', 'search_notes_async', 'preview', 'note_edit', 'note_edit_save', 'upload', 'download']
+
+# 合成するメモの単語(検索のヒット率を現実に近づけるため、一部の単語は頻出させる)
+WORDS = ['memo', 'python', 'flask', 'docker', 'nginx', 'redis', 'postgres', 'elastic', 'markdown', 'search',
+         'メモ', '設定', '手順', '障害', '対応', '議事録', '調査', '検索', '画像', 'サーバー']
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='ForgeGridのベンチマーク')
+    parser.add_argument('--users', type=int, default=4, help='作成するユーザー数')
+    parser.add_argument('--notes-per-user', type=int, default=200, help='ユーザーごとのメモの件数')
+    parser.add_argument('--note-size', type=int, default=4096, help='メモ本文のおおよそのサイズ(バイト)')
+    parser.add_argument('--files-per-user', type=int, default=20, help='ユーザーごとのアップロード済みファイル数')
+    parser.add_argument('--file-size', type=int, default=256 * 1024, help='アップロードファイルのサイズ(バイト)')
+    parser.add_argument('--clients', type=int, default=8, help='同時に実行するクライアント数')
+    parser.add_argument('--requests', type=int, default=200, help='エンドポイントごとのリクエスト数')
+    parser.add_argument('--warmup', type=int, default=10, help='計測前に送るリクエスト数(エンドポイントごと)')
+    parser.add_argument('--endpoints', default=','.join(ENDPOINTS), help='計測するエンドポイント(カンマ区切り)')
+    parser.add_argument('--database-uri', help='使用するデータベース(省略時は一時ディレクトリのSQLite)')
+    parser.add_argument('--seed', type=int, default=1, help='合成データの乱数シード')
+    parser.add_argument('--output', default='bench_output.json', help='結果を保存するJSONファイル')
+    parser.add_argument('--baseline', help='比較する以前の結果(JSON)。p95が悪化していれば終了コード1')
+    parser.add_argument('--threshold', type=float, default=0.2, help='p95の悪化を許容する割合(0.2 = 20%%)')
+    return parser.parse_args()
+
+
+def current_rss():
+    """現在のメモリ使用量(RSS, バイト)。/procが使えない環境では最大値で代用する"""
+    try:
+        with open('/proc/self/status') as fh:
+            for line in fh:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class RssSampler:
+    """計測中のメモリ使用量の最大値を一定間隔で記録する"""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, current_rss())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.peak = current_rss()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss())
+
+
+def percentile(sorted_values, p):
+    """最近傍順位法によるパーセンタイル"""
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, int(round(p / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def parse_server_timing(header):
+    """Server-Timingヘッダーから処理の種類ごとの時間(ミリ秒)を取り出す"""
+    result = {}
+    for part in (header or '').split(','):
+        fields = part.strip().split(';')
+        for field in fields[1:]:
+            if field.startswith('dur='):
+                result[fields[0]] = float(field[4:])
+    return result
+
+
+def random_text(rng, size):
+    """Markdownらしい合成テキスト(見出し・段落・リスト・コードブロック)を作成する"""
+    parts = []
+    length = 0
+    while length < size:
+        kind = rng.random()
+        if kind < 0.1:
+            block = '## ' + ' '.join(rng.choices(WORDS, k=4))
+        elif kind < 0.25:
+            block = '\n'.join('- ' + ' '.join(rng.choices(WORDS, k=5)) for _ in range(4))
+        elif kind < 0.35:
+            block = '```python\n' + '\n'.join(f"value_{i} = {rng.randint(0, 1000)}" for i in range(6)) + '\n```'
+        else:
+            block = ' '.join(rng.choices(WORDS, k=40))
+        parts.append(block)
+        length += len(block.encode('utf-8')) + 2
+    return '\n\n'.join(parts)
+
+
+def create_benchmark_app(workdir, database_uri):
+    """外部サービスの代わりにfakeredisとデータベースの全文検索を使ってアプリケーションを作成する"""
+    os.environ['SQLALCHEMY_DATABASE_URI'] = database_uri or f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ['SEARCH_BACKEND'] = 'database'
+    os.environ.pop('ELASTICSEARCH_HOST', None)
+    os.environ['SEARCH_OUTBOX_DRAINER'] = 'false'
+    os.environ['ASSETS_BUILD_ON_STARTUP'] = 'false'
+    os.environ['SERVER_TIMING_ENABLED'] = 'true'
+
+    # セッションとキャッシュのRedisをfakeredisに置き換える
+    import fakeredis
+    import redis
+    fake = fakeredis.FakeRedis()
+    redis.Redis.from_url = classmethod(lambda cls, *args, **kwargs: fake)
+
+    sys.path.insert(0, ROOT)
+    from app import create_app, provisioning
+    app = create_app()
+    app.config['UPLOAD_FOLDER'] = os.path.join(workdir, 'uploads')
+    # テーブルと全文検索インデックスを作成する(静的ファイルはリポジトリ内に作成されるため行わない)
+    with app.app_context():
+        provisioning.provision(app, assets=False)
+    return app
+
+
+def seed(app, args, rng):
+    """合成したユーザー・メモ・アップロードファイルを投入し、ユーザーごとのメモID・ファイル名を返す"""
+    from sqlalchemy import insert
+    from werkzeug.security import generate_password_hash
+    from app import uploads, user_files
+    from app.models import db, User, Note
+
+    fixtures = []
+    with app.app_context():
+        password = generate_password_hash('benchmark', method='pbkdf2:sha256')
+        for n in range(args.users):
+            user = User(username=f"bench{n}", password=password)
+            db.session.add(user)
+            db.session.commit()
+
+            rows = [
+                {'title': ' '.join(rng.choices(WORDS, k=3)), 'content': random_text(rng, args.note_size),
+                 'date': date.today(), 'user_id': user.id}
+                for _ in range(args.notes_per_user)
+            ]
+            for start in range(0, len(rows), 500):
+                db.session.execute(insert(Note), rows[start:start + 500])
+            db.session.commit()
+            note_ids = list(db.session.execute(db.select(Note.id).where(Note.user_id == user.id)).scalars())
+
+            user_folder = os.path.join(app.config['UPLOAD_FOLDER'], user.username)
+            filenames = []
+            for i in range(args.files_per_user):
+                data = rng.randbytes(args.file_size)
+                name, digest, _ = uploads.save_stream(app.config, user_folder, f"file{i}.zip", io.BytesIO(data))
+                user_files.record_file(user.id, user_folder, name, digest)
+                filenames.append(name)
+            db.session.commit()
+            fixtures.append({'user_id': user.id, 'note_ids': note_ids, 'files': filenames})
+    return fixtures
+
+
+def make_client(app, fixture):
+    """ログイン済みのテストクライアントを作成する"""
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['_user_id'] = str(fixture['user_id'])
+        sess['_fresh'] = True
+    return client
+
+
+def build_request(endpoint, fixture, rng, file_size):
+    """エンドポイントへのリクエスト(クライアントを受け取ってレスポンスを返す関数)を作成する"""
+    if endpoint == 'home':
+        return lambda c: c.get('/ForgeGrid')
+    if endpoint == 'search_notes_async':
+        word = rng.choice(WORDS)
+        return lambda c: c.post('/ForgeGrid/search_notes_async', data={'search': word})
+    if endpoint == 'preview':
+        note_id = rng.choice(fixture['note_ids'])
+        return lambda c: c.get(f'/ForgeGrid/preview/{note_id}')
+    if endpoint == 'note_edit':
+        note_id = rng.choice(fixture['note_ids'])
+        return lambda c: c.get(f'/ForgeGrid/note_edit/{note_id}')
+    if endpoint == 'note_edit_save':
+        note_id = rng.choice(fixture['note_ids'])
+        content = random_text(rng, 1024)
+        return lambda c: c.post(f'/ForgeGrid/note_edit/{note_id}', data={'title': 'bench', 'content': content})
+    if endpoint == 'upload':
+        data = rng.randbytes(file_size)
+        return lambda c: c.post('/ForgeGrid/upload_file', data={'file': (io.BytesIO(data), 'upload.zip')},
+                                content_type='multipart/form-data')
+    if endpoint == 'download':
+        filename = rng.choice(fixture['files'])
+        return lambda c: c.get(f'/ForgeGrid/download/{filename}')
+    raise ValueError(f"unknown endpoint: {endpoint}")
+
+
+def run_endpoint(app, endpoint, fixtures, args, rng):
+    """1つのエンドポイントに同時にリクエストを送り、計測結果を返す"""
+    clients = [make_client(app, fixtures[i % len(fixtures)]) for i in range(args.clients)]
+    client_fixtures = [fixtures[i % len(fixtures)] for i in range(args.clients)]
+
+    def one(i):
+        slot = i % args.clients
+        request = build_request(endpoint, client_fixtures[slot], random.Random(args.seed * 7919 + i), args.file_size)
+        start = time.perf_counter()
+        response = request(clients[slot])
+        elapsed = time.perf_counter() - start
+        response.close()
+        return elapsed, response.status_code, parse_server_timing(response.headers.get('Server-Timing'))
+
+    # クライアントごとのテストクライアントはスレッド間で共有しないよう、スロットごとに直列で実行する
+    locks = [threading.Lock() for _ in range(args.clients)]
+
+    def guarded(i):
+        with locks[i % args.clients]:
+            return one(i)
+
+    for i in range(args.warmup):
+        guarded(i)
+
+    with RssSampler() as sampler, ThreadPoolExecutor(max_workers=args.clients) as pool:
+        started = time.perf_counter()
+        results = list(pool.map(guarded, range(args.warmup, args.warmup + args.requests)))
+        wall = time.perf_counter() - started
+
+    latencies = sorted(r[0] * 1000 for r in results)
+    errors = sum(1 for r in results if r[1] >= 400)
+    phases = {}
+    for _, _, timing in results:
+        for name, value in timing.items():
+            phases.setdefault(name, []).append(value)
+    return {
+        'requests': len(results),
+        'errors': errors,
+        'statuses': sorted({r[1] for r in results}),
+        'throughput_rps': round(len(results) / wall, 2) if wall else None,
+        'latency_ms': {
+            'mean': round(sum(latencies) / len(latencies), 3),
+            'p50': round(percentile(latencies, 50), 3),
+            'p95': round(percentile(latencies, 95), 3),
+            'p99': round(percentile(latencies, 99), 3),
+            'max': round(latencies[-1], 3),
+        },
+        # Server-Timingヘッダーから集計した、処理の種類ごとの平均時間
+        'server_timing_mean_ms': {name: round(sum(v) / len(v), 3) for name, v in sorted(phases.items())},
+        'peak_rss_bytes': sampler.peak,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(result, baseline_path, threshold):
+    """基準の結果とp95を比較し、悪化したエンドポイントのリストを返す"""
+    with open(baseline_path) as fh:
+        baseline = json.load(fh)
+    regressions = []
+    for endpoint, current in result['endpoints'].items():
+        previous = baseline.get('endpoints', {}).get(endpoint)
+        if not previous:
+            continue
+        before, after = previous['latency_ms']['p95'], current['latency_ms']['p95']
+        if before and after > before * (1 + threshold):
+            regressions.append(f"{endpoint}: p95 {before:.1f}ms -> {after:.1f}ms")
+    return regressions
+
+
+def main():
+    args = parse_args()
+    rng = random.Random(args.seed)
+    endpoints = [e.strip() for e in args.endpoints.split(',') if e.strip()]
+    for endpoint in endpoints:
+        if endpoint not in ENDPOINTS:
+            sys.exit(f"unknown endpoint: {endpoint} (choose from {', '.join(ENDPOINTS)})")
+
+    workdir = tempfile.mkdtemp(prefix='forgegrid-bench-')
+    cwd = os.getcwd()
+    output = os.path.abspath(args.output)
+    try:
+        # 相対パスで作成されるファイル(SQLiteのデフォルトなど)は一時ディレクトリに置く
+        os.chdir(workdir)
+        app = create_benchmark_app(workdir, args.database_uri)
+        started = time.perf_counter()
+        fixtures = seed(app, args, rng)
+        print(f"seeded {args.users} users x {args.notes_per_user} notes, {args.files_per_user} files "
+              f"in {time.perf_counter() - started:.1f}s")
+
+        result = {
+            'meta': {
+                'timestamp': datetime.now(timezone.utc).isoformat(),
+                'git_revision': git_revision(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'database': app.config['SQLALCHEMY_DATABASE_URI'].split(':', 1)[0],
+                'args': {k: v for k, v in vars(args).items() if k not in ('output', 'baseline')},
+            },
+            'endpoints': {},
+        }
+        print(f"{'endpoint':<20}{'rps':>9}{'p50':>9}{'p95':>9}{'p99':>9}{'errors':>8}{'peak RSS':>11}")
+        for endpoint in endpoints:
+            stats = run_endpoint(app, endpoint, fixtures, args, rng)
+            result['endpoints'][endpoint] = stats
+            latency = stats['latency_ms']
+            print(f"{endpoint:<20}{stats['throughput_rps']:>9.1f}{latency['p50']:>9.1f}{latency['p95']:>9.1f}"
+                  f"{latency['p99']:>9.1f}{stats['errors']:>8}{stats['peak_rss_bytes'] / 2**20:>9.1f}MB")
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(output, 'w') as fh:
+        json.dump(result, fh, indent=2, ensure_ascii=False)
+    print(f"saved {output}")
+
+    if args.baseline:
+        regressions = compare(result, args.baseline, args.threshold)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+"""
+テストの共通の準備。
+外部のサービスを使わずにアプリケーションを作成する(データベースは一時ディレクトリのSQLite、Redisはfakeredis、
+全文検索はデータベースの全文検索)。設定はインポート時に環境変数から読み込まれるため、app をインポートする前に設定する。
+"""
+
+# os, sys: 環境変数の設定とアプリケーションのインポートに使用
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope='session')
+def redis_server():
+    """Flaskと検索サービス(async_search.py)で共有するfakeredisのサーバー"""
+    import fakeredis
+    return fakeredis.FakeServer()
+
+
+@pytest.fixture(scope='session')
+def app(tmp_path_factory, redis_server):
+    workdir = tmp_path_factory.mktemp('forgegrid')
+    os.environ['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{workdir / 'test.db'}"
+    os.environ['SEARCH_BACKEND'] = 'database'
+    os.environ.pop('ELASTICSEARCH_HOST', None)
+    os.environ['SEARCH_OUTBOX_DRAINER'] = 'false'
+    os.environ['ASSETS_BUILD_ON_STARTUP'] = 'false'
+    # ハッシュ計算に時間がかからないよう、テストでは反復回数を減らす
+    os.environ['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:1000'
+
+    # セッションとキャッシュのRedisをfakeredisに置き換える
+    import fakeredis
+    import redis
+    fake = fakeredis.FakeRedis(server=redis_server)
+    redis.Redis.from_url = classmethod(lambda cls, *args, **kwargs: fake)
+
+    sys.path.insert(0, ROOT)
+    from app import create_app, provisioning
+    app = create_app()
+    app.config.update(TESTING=True, WTF_CSRF_ENABLED=False, UPLOAD_FOLDER=str(workdir / 'uploads'))
+    # テーブルと全文検索インデックスを作成する(静的ファイルはリポジトリ内に作成されるため行わない)
+    with app.app_context():
+        provisioning.provision(app, assets=False)
+    return app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+def register(client, username, password='password123'):
+    """ユーザーを登録してログインする"""
+    return client.post('/ForgeGrid/register', data={
+        'username': username, 'password': password, 'confirm_password': password,
+    })
+
+
+def login(client, username, password='password123'):
+    """ログインする"""
+    return client.post('/ForgeGrid/login', data={'username': username, 'password': password})
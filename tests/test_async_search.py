@@ -0,0 +1,52 @@
+"""検索サービス(asyncio)のログイン状態の確認のテスト"""
+
+# asyncio: 検索サービスの処理の実行に使用
+import asyncio
+
+import pytest
+
+from conftest import register
+
+
+@pytest.fixture
+def async_app(app, redis_server, monkeypatch):
+    """Flaskと同じ設定・Redis・データベースを使用する検索サービス"""
+    import fakeredis.aioredis
+    import redis.asyncio
+    from app.async_search import AsyncSearchApp
+
+    fake = fakeredis.aioredis.FakeRedis(server=redis_server)
+    monkeypatch.setattr(redis.asyncio.Redis, 'from_url', classmethod(lambda cls, *args, **kwargs: fake))
+    return AsyncSearchApp(dict(app.config))
+
+
+def current_user_id(async_app, client):
+    cookie = client.get_cookie('session')
+    scope = {'headers': [(b'cookie', f"session={cookie.value}".encode('latin-1'))]}
+    return asyncio.run(async_app._current_user_id(scope))
+
+
+def test_password_change_logs_out_async_session(app, async_app):
+    """パスワードを変更すると、他のセッションは検索サービスでもログインしていないものとして扱われる"""
+    from app import user_cache
+    from app.models import db, User
+
+    first, second = app.test_client(), app.test_client()
+    register(first, 'async_user')
+    second.post('/ForgeGrid/login', data={'username': 'async_user', 'password': 'password123'})
+    with app.app_context():
+        user_id = db.session.execute(db.select(User.id).where(User.username == 'async_user')).scalar_one()
+
+    assert current_user_id(async_app, first) == user_id
+    # ユーザー情報のキャッシュがない場合はデータベースから読み込む
+    app.config['SESSION_REDIS'].delete(user_cache.redis_key(user_id))
+    assert current_user_id(async_app, second) == user_id
+
+    first.post('/ForgeGrid/change-password', data={
+        'current_password': 'password123', 'new_password': 'newpassword', 'confirm_password': 'newpassword',
+    })
+
+    assert current_user_id(async_app, first) == user_id
+    assert current_user_id(async_app, second) is None
+    app.config['SESSION_REDIS'].delete(user_cache.redis_key(user_id))
+    assert current_user_id(async_app, second) is None
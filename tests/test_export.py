@@ -0,0 +1,54 @@
+"""データのエクスポート(/ForgeGrid/export)のテスト"""
+
+# io, zipfile: ダウンロードしたアーカイブの確認に使用
+import io
+import zipfile
+
+from urllib.parse import quote
+
+from conftest import register
+
+
+def test_export_non_ascii_username(client):
+    """日本語のユーザー名でも、ファイル名をUTF-8(filename*)とASCIIの代替の名前で送信できる"""
+    assert register(client, '山田').status_code == 302
+
+    response = client.get('/ForgeGrid/export')
+
+    assert response.status_code == 200
+    disposition = response.headers['Content-Disposition']
+    disposition.encode('latin-1')
+    assert f"filename*=UTF-8''{quote('forgegrid_山田_')}" in disposition
+    assert 'filename="forgegrid__' in disposition
+    with zipfile.ZipFile(io.BytesIO(response.data)) as archive:
+        assert archive.namelist()
+
+
+def test_export_ascii_username(client):
+    """ASCIIだけのユーザー名はそのままファイル名にする"""
+    assert register(client, 'taro').status_code == 302
+
+    response = client.get('/ForgeGrid/export')
+
+    assert response.status_code == 200
+    assert response.headers['Content-Disposition'].startswith('attachment; filename="forgegrid_taro_')
+    assert 'filename*' not in response.headers['Content-Disposition']
+
+
+def test_export_notes_across_batches(app, client, monkeypatch):
+    """メモの一覧を複数回に分けて読み込んでも、すべてのメモを本文とともに書き出す"""
+    from app.models import db, Note, User
+
+    register(client, 'batch_user')
+    with app.app_context():
+        user_id = db.session.execute(db.select(User.id).where(User.username == 'batch_user')).scalar_one()
+        db.session.add_all(Note(title=f"メモ{n}", content=f"本文{n}", user_id=user_id) for n in range(5))
+        db.session.commit()
+    monkeypatch.setitem(app.config, 'EXPORT_BATCH_SIZE', 2)
+
+    response = client.get('/ForgeGrid/export')
+
+    with zipfile.ZipFile(io.BytesIO(response.data)) as archive:
+        notes = sorted(name for name in archive.namelist() if name.startswith('notes/'))
+        assert len(notes) == 5
+        assert all(archive.read(name).decode().endswith(f"本文{n}") for n, name in enumerate(notes))
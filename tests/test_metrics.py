@@ -0,0 +1,22 @@
+"""/metrics のアクセス制限のテスト"""
+
+
+def test_metrics_hidden_without_token(app, client, monkeypatch):
+    """METRICS_TOKENが未設定の場合は、METRICS_PUBLICで明示しない限り公開しない"""
+    monkeypatch.setitem(app.config, 'METRICS_TOKEN', None)
+    assert client.get('/metrics').status_code == 404
+
+    monkeypatch.setitem(app.config, 'METRICS_PUBLIC', True)
+    assert client.get('/metrics').status_code == 200
+
+
+def test_metrics_requires_token(app, client, monkeypatch):
+    """METRICS_TOKENを設定した場合は、Authorizationヘッダーのトークンが必要"""
+    monkeypatch.setitem(app.config, 'METRICS_TOKEN', 'secret')
+    monkeypatch.setitem(app.config, 'METRICS_PUBLIC', True)
+
+    assert client.get('/metrics').status_code == 401
+    assert client.get('/metrics', headers={'Authorization': 'Bearer wrong'}).status_code == 401
+    response = client.get('/metrics', headers={'Authorization': 'Bearer secret'})
+    assert response.status_code == 200
+    assert b'forgegrid' in response.data
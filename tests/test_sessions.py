@@ -0,0 +1,46 @@
+"""パスワードの変更とログイン中のセッションのテスト"""
+
+from conftest import register, login
+
+
+def is_logged_in(client):
+    return client.get('/ForgeGrid/change-password').status_code == 200
+
+
+def test_change_password_logs_out_other_sessions(app):
+    """パスワードを変更すると、変更したセッション以外はログアウトされる"""
+    first, second = app.test_client(), app.test_client()
+    register(first, 'change_user')
+    login(second, 'change_user')
+
+    response = first.post('/ForgeGrid/change-password', data={
+        'current_password': 'password123', 'new_password': 'newpassword', 'confirm_password': 'newpassword',
+    })
+
+    assert response.status_code == 302
+    assert is_logged_in(first)
+    assert not is_logged_in(second)
+
+
+def test_rehash_on_login_keeps_other_sessions(app, monkeypatch):
+    """ログイン時のハッシュ方式の更新では、先にログインしたセッションはログアウトされない"""
+    from app import passwords
+    from app.models import db, User
+
+    first, second = app.test_client(), app.test_client()
+    register(first, 'rehash_user')
+    with app.app_context():
+        version = db.session.execute(
+            db.select(User.password_version).where(User.username == 'rehash_user')).scalar_one()
+
+    # ハッシュの方式を変更すると、次のログインで作り直される
+    monkeypatch.setitem(app.config, 'PASSWORD_HASH_METHOD', 'pbkdf2:sha256:2000')
+    monkeypatch.setattr(passwords, '_method_prefix', None)
+    assert login(second, 'rehash_user').status_code == 302
+
+    with app.app_context():
+        user = db.session.execute(db.select(User).where(User.username == 'rehash_user')).scalar_one()
+        assert user.password.startswith('pbkdf2:sha256:2000$')
+        assert user.password_version == version
+    assert is_logged_in(first)
+    assert is_logged_in(second)
@@ -0,0 +1,28 @@
+"""ファイルのアップロードのテスト"""
+
+# io, os: アップロードするファイルの作成と、保存されたファイルの確認に使用
+import io
+import os
+
+from conftest import register
+
+
+def upload(client, filename, data):
+    return client.post('/ForgeGrid/upload_file', data={'file': (io.BytesIO(data), filename)},
+                       content_type='multipart/form-data')
+
+
+def test_form_upload_size_limit(app, client, monkeypatch):
+    """フォームからのアップロードも UPLOAD_MAX_SIZE を超える場合は413を返し、ファイルを保存しない"""
+    register(client, 'upload_user')
+    monkeypatch.setitem(app.config, 'UPLOAD_MAX_SIZE', 1024)
+
+    response = upload(client, 'large.txt', b'x' * 2048)
+
+    assert response.status_code == 413
+    user_folder = os.path.join(app.config['UPLOAD_FOLDER'], 'upload_user')
+    assert not any(name.endswith('large.txt') for name in os.listdir(user_folder))
+
+    assert upload(client, 'small.txt', b'x' * 1024).status_code == 302
+    # 保存したファイル名にはアップロードした日時が付く
+    assert any(name.endswith('_small.txt') for name in os.listdir(user_folder))